@@ -1,13 +1,17 @@
 import streamlit as st
-import json
-from openai import OpenAI
-from streamlit_folium import st_folium
-import streamlit.components.v1 as components 
+import functools
+import time
+import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 # 🟢 导入模块
+import clients
 import config
+import context
 import db
+import preferences
 import tools
+import tracing
 import utils
 
 # ==========================================
@@ -15,11 +19,17 @@ import utils
 # ==========================================
 st.set_page_config(page_title="AI 智能旅行管家 (Pro版)", page_icon="🌍", layout="wide")
 
-try:
-    client = OpenAI(api_key=config.DEEPSEEK_API_KEY, base_url="https://api.deepseek.com")
-except Exception as e:
-    st.error("API Key 配置有误，请检查代码。")
-    st.stop()
+# 🟢 [新增] 每次脚本运行一个 trace (LLM / 工具 / SerpAPI / Firestore / 地图渲染的耗时都记在里面)
+run_trace = tracing.begin_trace("turn")
+tracing.start_metrics_server()
+
+def get_client():
+    # 🟢 [修改] 进程级共享客户端，第一次真正调用 LLM 时才创建 (openai 导入较慢，登录页不用等)
+    try:
+        return clients.get_llm_client()
+    except Exception as e:
+        st.error("API Key 配置有误，请检查代码。")
+        st.stop()
 
 # ==========================================
 # 2. 状态管理
@@ -38,16 +48,36 @@ for k, v in initial_counts.items():
         st.session_state[k] = v
 
 if "chat_history" not in st.session_state: st.session_state["chat_history"] = []
+if "history_has_more" not in st.session_state: st.session_state["history_has_more"] = False
+if "chat_body_lru" not in st.session_state: st.session_state["chat_body_lru"] = []
+if "search_index" not in st.session_state: st.session_state["search_index"] = None  # 第一次搜索时才从 Firestore 建
 if "current_chat_id" not in st.session_state: st.session_state["current_chat_id"] = None
 if "messages" not in st.session_state:
     st.session_state["messages"] = [
         {"role": "system", "content": config.SYSTEM_PROMPT},
         {"role": "assistant", "content": "Hello! I am your AI Agent. Select your travel style on the left!"}
     ]
-if "download_buffer" not in st.session_state: st.session_state["download_buffer"] = None
-if "map_data" not in st.session_state: st.session_state["map_data"] = None
+if "download_content" not in st.session_state: st.session_state["download_content"] = None  # 行程 Markdown，点下载时才生成 docx
+if "transcript_window" not in st.session_state: st.session_state["transcript_window"] = config.TRANSCRIPT_WINDOW
 if "traffic_data" not in st.session_state: st.session_state["traffic_data"] = None
-if "saved_map_html" not in st.session_state: st.session_state["saved_map_html"] = None 
+if "saved_map_html" not in st.session_state: st.session_state["saved_map_html"] = None  # 旧版聊天记录里的整页 HTML
+if "route_spec" not in st.session_state: st.session_state["route_spec"] = None
+if "last_trace" not in st.session_state: st.session_state["last_trace"] = None
+
+# 🟢 [新增] 后台偏好分析的结果在这里写回 (要在侧边栏控件创建之前)
+if st.session_state["user_info"]:
+    learned_prefs = preferences.pop_learned_preferences(st.session_state["user_info"]["email"])
+    if learned_prefs:
+        st.session_state["user_info"]["preferences"] = learned_prefs
+        st.session_state["current_prefs"] = learned_prefs
+        st.session_state["sidebar_selector"] = learned_prefs
+
+# 🟢 [新增] SerpAPI 额度按用户公平排队 (未登录时按浏览器会话区分)
+if st.session_state["user_info"]:
+    clients.set_current_user(st.session_state["user_info"]["email"])
+else:
+    script_ctx = get_script_run_ctx()
+    clients.set_current_user(script_ctx.session_id if script_ctx else None)
 
 # ==========================================
 # 🟢 辅助函数区域
@@ -58,23 +88,90 @@ def sync_history_to_db():
     if st.session_state["user_info"]:
         email = st.session_state["user_info"]["email"]
         history = st.session_state["chat_history"]
-        db.save_chat_history(email, history)
+        db.save_chat_history(email, history, st.session_state["search_index"])
 
 # 2. 删除历史记录
 def delete_chat_history(index):
     if 0 <= index < len(st.session_state["chat_history"]):
-        st.session_state["chat_history"].pop(index)
+        removed = st.session_state["chat_history"].pop(index)
+        if st.session_state["user_info"]:
+            db.delete_chat(st.session_state["user_info"]["email"], removed)
+            if st.session_state["search_index"] is not None:
+                st.session_state["search_index"].remove(removed.get("chat_id"))
         if st.session_state["current_chat_id"] == index:
             st.session_state["current_chat_id"] = None
             st.session_state["messages"] = [{"role": "system", "content": config.SYSTEM_PROMPT},{"role": "assistant", "content": "Chat deleted."}]
-            st.session_state["download_buffer"] = None
-            st.session_state["map_data"] = None
+            st.session_state["download_content"] = None
             st.session_state["traffic_data"] = None
-            st.session_state["saved_map_html"] = None 
+            st.session_state["saved_map_html"] = None
+            st.session_state["route_spec"] = None
         elif st.session_state["current_chat_id"] is not None and st.session_state["current_chat_id"] > index:
             st.session_state["current_chat_id"] -= 1
         sync_history_to_db()
 
+# 3. 🟢 [新增] 按需加载历史对话正文 (每个会话只保留最近 N 份)
+def open_chat_body(chat):
+    if not db.is_chat_loaded(chat):
+        if not st.session_state["user_info"]: return False
+        if not db.load_chat_body(st.session_state["user_info"]["email"], chat): return False
+
+    lru = st.session_state["chat_body_lru"]
+    chat_id = chat.get("chat_id")
+    if chat_id in lru: lru.remove(chat_id)
+    lru.append(chat_id)
+
+    # 从最旧的开始释放；当前 chat 和还有未保存改动的 chat 留在 LRU 里，下次 (同步之后) 再试
+    for old_id in lru[:-1]:
+        if len(lru) <= config.HISTORY_BODY_CACHE_SIZE: break
+        for i, old_chat in enumerate(st.session_state["chat_history"]):
+            if old_chat.get("chat_id") == old_id:
+                if i != st.session_state["current_chat_id"] and db.unload_chat_body(old_chat):
+                    lru.remove(old_id)
+                break
+        else:
+            lru.remove(old_id)  # 已经删除的 chat
+    return True
+
+# 4. 🟢 [新增] 打开某个历史对话 (History 列表和搜索结果共用)
+def show_chat(i):
+    chat = st.session_state["chat_history"][i]
+    if not open_chat_body(chat): return False
+    st.session_state["messages"] = chat["messages"]
+    st.session_state["current_chat_id"] = i
+
+    st.session_state["route_spec"] = chat.get("route_spec")
+    st.session_state["saved_map_html"] = None if chat.get("route_spec") else chat.get("map_html")
+    st.session_state["traffic_data"] = chat.get("traffic_data")
+    st.session_state["transcript_window"] = config.TRANSCRIPT_WINDOW
+
+    st.session_state["download_content"] = chat.get("itinerary_content")
+    return True
+
+# 5. 🟢 [新增] 搜索历史对话 (倒排索引只读 search_tf，不读正文)
+def search_chats(query):
+    if st.session_state["search_index"] is None:
+        st.session_state["search_index"] = db.load_search_index(st.session_state["user_info"]["email"])
+        if st.session_state["search_index"] is None: return None
+    return st.session_state["search_index"].search(query, config.SEARCH_RESULT_LIMIT)
+
+def open_search_result(chat_id):
+    # 结果可能还在没翻到的页里: 按顺序往下翻 (只读索引)，保持 History 是连续的一段
+    history = st.session_state["chat_history"]
+    while True:
+        for i, chat in enumerate(history):
+            if chat.get("chat_id") == chat_id: return show_chat(i)
+        if not st.session_state["history_has_more"]: return False
+        load_more_history()
+
+def load_more_history():
+    if not st.session_state["user_info"]: return
+    history = st.session_state["chat_history"]
+    last_order = history[-1].get("order_index") if history else None
+    more, has_more = db.load_chat_index(st.session_state["user_info"]["email"], config.HISTORY_PAGE_SIZE, last_order)
+    known = {c.get("chat_id") for c in history}
+    history.extend(c for c in more if c["chat_id"] not in known)
+    st.session_state["history_has_more"] = has_more
+
 # 🟢 New Chat 的逻辑
 def handle_new_chat():
     # A. 尝试保存当前对话
@@ -88,59 +185,115 @@ def handle_new_chat():
                 user_first_msg = msg.content[:15] + "..."
                 break     
         
-        current_map_html = None
-        if st.session_state["map_data"]:
-            current_map_html = st.session_state["map_data"].get_root().render()
-        elif st.session_state["saved_map_html"]:
-            current_map_html = st.session_state["saved_map_html"]
-
-        if st.session_state["user_info"]:
-            learned_tags = tools.analyze_preferences_from_chat(st.session_state["messages"])
-            if learned_tags:
-                email = st.session_state["user_info"]["email"]
-                new_all_tags = db.merge_user_preferences(email, learned_tags)
-                if new_all_tags:
-                    st.session_state["user_info"]["preferences"] = new_all_tags
-                    st.session_state["current_prefs"] = new_all_tags
-                    st.session_state["sidebar_selector"] = new_all_tags
+        # 🟢 [修改] 只保存路线规格；旧版记录没有规格时才沿用整页 HTML
+        current_route_spec = st.session_state["route_spec"]
+        current_map_html = None if current_route_spec else st.session_state["saved_map_html"]
 
         history_item = {
             "title": user_first_msg, 
             "messages": st.session_state["messages"], 
             "itinerary_content": None,
+            "route_spec": current_route_spec,
             "map_html": current_map_html if current_map_html else None,  # 确保有值
             "traffic_data": st.session_state["traffic_data"] if st.session_state["traffic_data"] else None
         }
 
         if st.session_state["current_chat_id"] is None:
             st.session_state["chat_history"].insert(0, history_item)
+            chat = history_item
+        else:
+            chat = st.session_state["chat_history"][st.session_state["current_chat_id"]]
+
+        # 🟢 [修改] 偏好分析交给后台线程，只分析上次之后新增的消息，不再阻塞点击
+        if st.session_state["user_info"]:
+            preferences.queue_chat_analysis(st.session_state["user_info"]["email"], chat)
         
         sync_history_to_db()
     
     # B. 重置对话状态
     st.session_state["messages"] = [{"role": "system", "content": config.SYSTEM_PROMPT}, {"role": "assistant", "content": "Hello! Where are we going today?"}]
     st.session_state["current_chat_id"] = None
-    st.session_state["download_buffer"] = None
-    st.session_state["map_data"] = None 
+    st.session_state["download_content"] = None
     st.session_state["traffic_data"] = None 
-    st.session_state["saved_map_html"] = None 
+    st.session_state["saved_map_html"] = None
+    st.session_state["route_spec"] = None
+    st.session_state["transcript_window"] = config.TRANSCRIPT_WINDOW
+
+# 🟢 [新增] 流式调用 LLM
+@tracing.traced("llm", op="chat", model="deepseek-chat")
+def stream_llm_turn(messages, placeholder, on_tool_ready):
+    """
+    stream=True 调用 DeepSeek:
+    - 文本 delta 实时渲染到 placeholder
+    - tool_calls 的分片按 index 拼成完整调用
+    - 某个 tool_call 的参数一完整 (下一个开始 / stream 结束)，立刻回调 on_tool_ready 去执行
+    返回 (content, tool_calls)
+    """
+    started = time.perf_counter()
+    tracing.annotate(tokens_in=sum(context.count_message_tokens(m) for m in messages))
+    stream = get_client().chat.completions.create(model="deepseek-chat", messages=messages, tools=tools.tools_list, stream=True)
+    content = ""
+    tool_calls = []
+    ready_count = 0
+    last_paint = 0.0
+    for chunk in stream:
+        if not chunk.choices: continue
+        delta = chunk.choices[0].delta
+        if started is not None and (delta.content or delta.tool_calls):
+            tracing.annotate(ttft_ms=round((time.perf_counter() - started) * 1000, 1))
+            started = None
+
+        if delta.content:
+            content += delta.content
+            now = time.time()
+            if now - last_paint > 0.05:  # 限制刷新频率
+                placeholder.markdown(content + "▌")
+                last_paint = now
+
+        for tc in delta.tool_calls or []:
+            while tc.index >= len(tool_calls):
+                tool_calls.append({"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+            # 后面的 tool_call 开始了 -> 前面的参数已经完整
+            while ready_count < tc.index:
+                on_tool_ready(tool_calls[ready_count])
+                ready_count += 1
+            call = tool_calls[tc.index]
+            if tc.id: call["id"] = tc.id
+            if tc.function:
+                if tc.function.name: call["function"]["name"] += tc.function.name
+                if tc.function.arguments: call["function"]["arguments"] += tc.function.arguments
+
+    while ready_count < len(tool_calls):
+        on_tool_ready(tool_calls[ready_count])
+        ready_count += 1
+    if content: placeholder.markdown(content)
+    tracing.annotate(tokens_out=context.count_text_tokens(content) + sum(context.count_text_tokens(c["function"]["arguments"]) for c in tool_calls),
+                     tool_calls=len(tool_calls))
+    return content, tool_calls
 
 # ==========================================
 # 🟢 核心逻辑：UI 辅助函数
 # ==========================================
+def step_counter(session_key, step, min_val=0):
+    st.session_state[session_key] = max(min_val, st.session_state[session_key] + step)
+
 def render_counter(label, session_key, min_val=0):
+    # 🟢 [修改] 用 on_click 回调改数值: 回调在重跑之前执行，不用再 st.rerun() 整页
     c1, c2, c3, c4 = st.columns([2.5, 1, 0.8, 1])
     with c1: st.write(f"**{label}**") 
-    with c2:
-        if st.button("➖", key=f"dec_{session_key}"):
-            if st.session_state[session_key] > min_val:
-                st.session_state[session_key] -= 1
-                st.rerun() 
+    with c2: st.button("➖", key=f"dec_{session_key}", on_click=step_counter, args=(session_key, -1, min_val))
     with c3: st.markdown(f"<div style='text-align:center; padding-top:5px; font-weight:bold;'>{st.session_state[session_key]}</div>", unsafe_allow_html=True)
-    with c4:
-        if st.button("➕", key=f"inc_{session_key}"):
-            st.session_state[session_key] += 1
-            st.rerun() 
+    with c4: st.button("➕", key=f"inc_{session_key}", on_click=step_counter, args=(session_key, 1))
+
+# 🟢 [新增] 人数面板是独立的 fragment: 点 ➕/➖ 只重跑这一块，不重画聊天记录和地图
+# (人数写进 system prompt 是在下一次整页运行时，也就是发消息的时候)
+@st.fragment
+def group_size_panel():
+    render_counter("Adults", "count_Adults", min_val=1)
+    render_counter("Kids (4-12)", "count_Kids")
+    render_counter("Baby (0-3)", "count_Baby")
+    render_counter("Elder (60+)", "count_Elder")
+    render_counter("OKU (Disabled)", "count_OKU")
 
 def auto_sync_style():
     new_prefs = st.session_state.get("sidebar_selector", [])
@@ -166,14 +319,17 @@ def login_dialog():
             st.session_state["current_prefs"] = []
             st.session_state["sidebar_selector"] = [] 
             st.session_state["chat_history"] = []
+            st.session_state["history_has_more"] = False
+            st.session_state["chat_body_lru"] = []
+            st.session_state["search_index"] = None
             st.session_state["messages"] = [{"role": "system", "content": config.SYSTEM_PROMPT}, {"role": "assistant", "content": "Hello! I am your AI Agent. Select your travel style on the left!"}]
             st.session_state["current_chat_id"] = None
             
             # 🟢 [关键修复] 登出时必须手动清除地图数据，否则它们会残留在 Session 里
-            st.session_state["map_data"] = None
             st.session_state["traffic_data"] = None
             st.session_state["saved_map_html"] = None
-            st.session_state["download_buffer"] = None
+            st.session_state["route_spec"] = None
+            st.session_state["download_content"] = None
             
             for k in initial_counts.keys(): st.session_state[k] = initial_counts[k]
             st.rerun()
@@ -190,15 +346,18 @@ def login_dialog():
                     st.session_state["current_prefs"] = prefs
                     st.session_state["sidebar_selector"] = prefs 
                     try:
-                        history = db.load_chat_history(user["email"])
+                        history, has_more = db.load_chat_index(user["email"], config.HISTORY_PAGE_SIZE)
                         st.session_state["chat_history"] = history
+                        st.session_state["history_has_more"] = has_more
+                        st.session_state["chat_body_lru"] = []
+                        st.session_state["search_index"] = None
                     except: pass
                     st.session_state["messages"] = [{"role": "system", "content": config.SYSTEM_PROMPT}, {"role": "assistant", "content": "Hello! Welcome back! Where are we going today?"}]
                     st.session_state["current_chat_id"] = None
-                    st.session_state["download_buffer"] = None
-                    st.session_state["map_data"] = None 
+                    st.session_state["download_content"] = None
                     st.session_state["traffic_data"] = None 
-                    st.session_state["saved_map_html"] = None 
+                    st.session_state["saved_map_html"] = None
+                    st.session_state["route_spec"] = None
                     st.success(msg)
                     st.rerun()
                 else:
@@ -241,19 +400,31 @@ with st.sidebar:
     st.multiselect("Style (风格)", travel_tags, key="sidebar_selector", on_change=auto_sync_style)
     
     st.markdown("#### 👥 Group Size")
-    with st.container():
-        render_counter("Adults", "count_Adults", min_val=1)
-        render_counter("Kids (4-12)", "count_Kids")
-        render_counter("Baby (0-3)", "count_Baby")
-        render_counter("Elder (60+)", "count_Elder")
-        render_counter("OKU (Disabled)", "count_OKU")
+    group_size_panel()
 
     st.markdown("---")
     
     st.button("➕ New Chat", use_container_width=True, type="primary", on_click=handle_new_chat)
 
-    if st.session_state.get("download_buffer"):
-        st.download_button("📥 Download .docx", data=st.session_state["download_buffer"], file_name="Trip_Plan.docx", mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document", type="primary")
+    if st.session_state.get("download_content"):
+        # 🟢 [修改] 传入 callable: 真正点击下载时才生成 docx (按内容 hash 缓存)
+        st.download_button("📥 Download .docx", data=functools.partial(utils.word_doc_bytes, st.session_state["download_content"]), file_name="Trip_Plan.docx", mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document", type="primary")
+
+    # 🟢 [新增] 搜索历史对话 (标题 + 消息 + 行程正文，中英马混合)
+    if st.session_state["user_info"] and st.session_state["chat_history"]:
+        search_query = st.text_input("🔍 Search chats", key="chat_search", placeholder="Tokyo / 东京 / Melaka")
+        if search_query.strip():
+            hits = search_chats(search_query)
+            if hits is None:
+                st.caption("⚠️ 搜索暂时不可用，请稍后再试。")
+            elif not hits:
+                st.caption("No matching chats")
+            for hit in hits or []:
+                if st.button(f"🔎 {hit['title']}", key=f"s_{hit['chat_id']}", use_container_width=True):
+                    if not open_search_result(hit["chat_id"]):
+                        st.error("⚠️ 无法加载该对话，请稍后再试。")
+                        st.stop()
+                    st.rerun()
 
     if st.session_state["chat_history"]:
         st.caption("History")
@@ -261,18 +432,14 @@ with st.sidebar:
             col1, col2 = st.columns([0.8, 0.2]) 
             with col1:
                 if st.button(f"💬 {chat['title']}", key=f"h_{i}"):
-                     st.session_state["messages"] = chat["messages"]
-                     st.session_state["current_chat_id"] = i
-                     
-                     st.session_state["saved_map_html"] = chat.get("map_html") 
-                     st.session_state["traffic_data"] = chat.get("traffic_data")
-                     st.session_state["map_data"] = None 
-
-                     saved_content = chat.get("itinerary_content")
-                     st.session_state["download_buffer"] = utils.create_word_doc(saved_content) if saved_content else None
+                     if not show_chat(i):
+                         st.error("⚠️ 无法加载该对话，请稍后再试。")
+                         st.stop()
                      st.rerun()
             with col2:
                 st.button("✖", key=f"d_{i}", on_click=delete_chat_history, args=(i,))
+        if st.session_state["history_has_more"]:
+            st.button("⬇️ Load more", key="history_more", use_container_width=True, on_click=load_more_history)
 
 # ==========================================
 # 🧠 记忆注入
@@ -312,59 +479,78 @@ if curr_style or is_group_set:
 # ==========================================
 # 3. 主界面内容
 # ==========================================
-for i, msg in enumerate(st.session_state["messages"]):
-    if isinstance(msg, dict):
-        role = msg["role"]
-        content = msg.get("content")
-    else:
-        role = msg.role
-        content = msg.content
-    
-    if role == "system": continue
-
-    if st.session_state.get(f"editing_{i}", False):
-        with st.chat_message(role):
-            new_content = st.text_area("Edit your message:", value=content, key=f"edit_area_{i}")
-            col1, col2 = st.columns([1, 5])
-            if col1.button("Save & Regenerate", key=f"save_{i}"):
-                if isinstance(st.session_state["messages"][i], dict):
-                    st.session_state["messages"][i]["content"] = new_content
-                else:
-                    st.session_state["messages"][i].content = new_content
-                st.session_state["messages"] = st.session_state["messages"][:i+1]
-                st.session_state[f"editing_{i}"] = False
-                st.session_state["map_data"] = None
-                st.session_state["traffic_data"] = None
-                st.session_state["saved_map_html"] = None 
-                st.session_state["download_buffer"] = None
-                st.rerun()
-            if col2.button("Cancel", key=f"cancel_{i}"):
-                st.session_state[f"editing_{i}"] = False
-                st.rerun()
-    else:
-        if content:
+def _role_content(msg):
+    if isinstance(msg, dict): return msg["role"], msg.get("content")
+    return msg.role, msg.content
+
+def show_earlier_messages():
+    st.session_state["transcript_window"] += config.TRANSCRIPT_WINDOW
+
+def set_editing(i, editing):
+    st.session_state[f"editing_{i}"] = editing
+
+# 🟢 [新增] 聊天记录是独立的 fragment，只渲染最近 transcript_window 条 (长对话不再整段重画)
+# 编辑 / 取消 (on_click 回调) 只重跑这一块；"Save & Regenerate" 改了消息，需要整页重跑去调用 LLM
+@st.fragment
+def chat_transcript():
+    messages = st.session_state["messages"]
+    visible = []
+    for i, msg in enumerate(messages):
+        role, content = _role_content(msg)
+        if role != "system" and (content or st.session_state.get(f"editing_{i}", False)):
+            visible.append(i)
+
+    hidden = len(visible) - st.session_state["transcript_window"]
+    if hidden > 0:
+        st.button(f"⬆️ Load earlier ({hidden} more)", key="transcript_more", on_click=show_earlier_messages)
+        visible = visible[hidden:]
+
+    for i in visible:
+        role, content = _role_content(messages[i])
+        if st.session_state.get(f"editing_{i}", False):
+            with st.chat_message(role):
+                new_content = st.text_area("Edit your message:", value=content, key=f"edit_area_{i}")
+                col1, col2 = st.columns([1, 5])
+                if col1.button("Save & Regenerate", key=f"save_{i}"):
+                    if isinstance(messages[i], dict):
+                        messages[i]["content"] = new_content
+                    else:
+                        messages[i].content = new_content
+                    st.session_state["messages"] = messages[:i+1]
+                    st.session_state[f"editing_{i}"] = False
+                    st.session_state["traffic_data"] = None
+                    st.session_state["saved_map_html"] = None
+                    st.session_state["route_spec"] = None
+                    st.session_state["download_content"] = None
+                    st.rerun()
+                col2.button("Cancel", key=f"cancel_{i}", on_click=set_editing, args=(i, False))
+        else:
             with st.chat_message(role):
                 st.write(content)
                 if role == "user":
-                    if st.button("✏️ Edit", key=f"edit_btn_{i}", help="Edit this message"):
-                        st.session_state[f"editing_{i}"] = True
-                        st.rerun()
+                    st.button("✏️ Edit", key=f"edit_btn_{i}", help="Edit this message", on_click=set_editing, args=(i, True))
+
+# 🟢 [新增] 地图面板: 独立 fragment (位置固定，不随聊天记录变长而移动)
+# 地图 HTML 按路线规格 hash 缓存，同一路线每次 rerun 发给前端的内容完全相同，iframe 不会重新加载；
+# 只有路线变了才会重新渲染 / 挂载
+@st.fragment
+def route_map_panel():
+    if not (st.session_state.get("route_spec") or st.session_state.get("saved_map_html")): return
+    st.markdown("### 🗺️ Route Map")
+    if st.session_state.get("traffic_data"):
+        with st.expander("🚗 Traffic Details", expanded=True): st.markdown(st.session_state["traffic_data"])
+
+    if st.session_state.get("route_spec"):
+        components.html(tools.render_route_html(st.session_state["route_spec"]), height=400)
+    else:
+        components.html(st.session_state["saved_map_html"], height=400)
 
-if st.session_state.get("map_data") or st.session_state.get("saved_map_html"):
-    with st.container():
-        st.markdown("### 🗺️ Route Map")
-        if st.session_state.get("traffic_data"):
-            with st.expander("🚗 Traffic Details", expanded=True): st.markdown(st.session_state["traffic_data"])
-        
-        if st.session_state.get("map_data"):
-            try: st_folium(st.session_state["map_data"], width=700, height=400, returned_objects=[])
-            except: pass
-        elif st.session_state.get("saved_map_html"):
-            components.html(st.session_state["saved_map_html"], height=400)
+chat_transcript()
+route_map_panel()
 
 if prompt := st.chat_input("Plan my trip to..."):
     st.session_state["messages"].append({"role": "user", "content": prompt})
-    history_item = {"title": prompt[:15] + "...", "messages": st.session_state["messages"], "itinerary_content": None, "map_html": None, "traffic_data": None}
+    history_item = {"title": prompt[:15] + "...", "messages": st.session_state["messages"], "itinerary_content": None, "route_spec": None, "map_html": None, "traffic_data": None}
     
     if st.session_state["current_chat_id"] is None:
         st.session_state["chat_history"].insert(0, history_item)
@@ -385,44 +571,74 @@ if st.session_state["messages"]:
         with st.chat_message("assistant"):
             status_container = st.status("🧠 Agent is thinking...", expanded=True)
             messages = st.session_state["messages"]
+            answer_placeholder = st.empty()
             while True:
-                response = client.chat.completions.create(model="deepseek-chat", messages=messages, tools=tools.tools_list)
-                msg = response.choices[0].message
-                if msg.tool_calls:
-                    messages.append(msg)
+                dispatch = tools.ToolDispatch()
+
+                def start_tool(call):
+                    status_container.write(f"👉 Action: **{call['function']['name']}**")
+                    dispatch.submit(call["function"]["name"], call["function"]["arguments"])
+
+                # 🟢 [新增] 旧的工具输出压成摘要，控制每次请求的 token 数
+                payload, ctx_stats = context.compact_messages(messages)
+                if ctx_stats["saved"] > 0:
+                    status_container.caption(f"🧹 Context: {ctx_stats['tokens_before']} → {ctx_stats['tokens_after']} tokens (saved {ctx_stats['saved']})")
+                    print(f"[Context] saved {ctx_stats['saved']} tokens ({ctx_stats['digested']} digested, {ctx_stats['dropped']} dropped)")
+
+                content, tool_calls = stream_llm_turn(payload, answer_placeholder, start_tool)
+                if tool_calls:
+                    messages.append({"role": "assistant", "content": content or None, "tool_calls": tool_calls})
                     should_rerun = False 
-                    for tool in msg.tool_calls:
-                        fn, args = tool.function.name, json.loads(tool.function.arguments)
-                        status_container.write(f"👉 Action: **{fn}**")
-                        res = None
-                        if fn == "search_flights": res = tools.search_flights(args["origin"], args["destination"], args["date"], args.get("return_date"))
-                        elif fn == "search_hotels": res = tools.search_hotels(args["city"], args["check_in_date"], args.get("check_out_date"), args.get("adults", 1))
-                        elif fn == "search_attractions": res = tools.search_attractions(args["city"], args.get("keyword"))
-                        elif fn == "search_restaurants": res = tools.search_restaurants(args["city"], args.get("food_type"))
-                        elif fn == "search_general_web": res = tools.search_general_web(args["query"])
-                        elif fn == "save_itinerary": res = tools.save_itinerary(args["content"]); status_container.write("💾 Saved!")
-                        elif fn == "generate_map_with_traffic": 
-                            res = tools.generate_map_with_traffic(args["locations_list"])
-                            status_container.write("🗺️ Map Drawn!")
+
+                    # 🟢 [新增] 同一轮的多个工具并行执行，完成一个就在 status 里打勾
+                    def report_tool_done(fn, res):
+                        if fn == "save_itinerary": status_container.write("💾 Saved!")
+                        elif fn == "generate_map_with_traffic": status_container.write("🗺️ Map Drawn!")
+                        else: status_container.write(f"✅ Done: **{fn}**")
+
+                    results = dispatch.collect(on_done=report_tool_done)
+
+                    for call, res in zip(tool_calls, results):
+                        if call["function"]["name"] == "generate_map_with_traffic":
                             should_rerun = True
-                            if st.session_state.get("map_data") and st.session_state["current_chat_id"] is not None:
-                                html_str = st.session_state["map_data"].get_root().render()
+                            if st.session_state.get("route_spec") and st.session_state["current_chat_id"] is not None:
                                 if st.session_state["current_chat_id"] < len(st.session_state["chat_history"]):
-                                    st.session_state["chat_history"][st.session_state["current_chat_id"]]["map_html"] = html_str
+                                    st.session_state["chat_history"][st.session_state["current_chat_id"]]["route_spec"] = st.session_state["route_spec"]
+                                    st.session_state["chat_history"][st.session_state["current_chat_id"]]["map_html"] = None
                                     st.session_state["chat_history"][st.session_state["current_chat_id"]]["traffic_data"] = st.session_state["traffic_data"]
                                     sync_history_to_db()
 
-                        elif fn == "get_weather_forecast": res = tools.get_weather_forecast(args["city"]); status_container.write("🌤️ Checked Weather!")
-                        
-                        messages.append({"role": "tool", "tool_call_id": tool.id, "content": str(res)})
-                    if should_rerun: st.rerun()
+                        messages.append({"role": "tool", "tool_call_id": call["id"], "content": str(res)})
+                    if should_rerun:
+                        st.session_state["last_trace"] = run_trace.finish().summary()
+                        st.rerun()
                 else:
-                    final_content = msg.content
+                    final_content = content
                     status_container.update(label="✅ Response Ready", state="complete", expanded=False)
-                    st.markdown(final_content)
                     st.session_state["messages"].append({"role": "assistant", "content": final_content})
                     if st.session_state["current_chat_id"] is not None: 
                         if st.session_state["current_chat_id"] < len(st.session_state["chat_history"]):
                             st.session_state["chat_history"][st.session_state["current_chat_id"]]["messages"] = st.session_state["messages"]
                     sync_history_to_db()
-                    break
\ No newline at end of file
+                    st.session_state["last_trace"] = run_trace.finish().summary()
+                    break
+
+# ==========================================
+# 🟢 [新增] 本轮性能明细
+# ==========================================
+if config.SHOW_PERFORMANCE_PANEL and st.session_state.get("last_trace"):
+    last_trace = st.session_state["last_trace"]
+    with st.expander(f"⏱️ Performance (last turn: {last_trace['total_ms'] / 1000:.2f}s)", expanded=False):
+        st.caption("按类型汇总 (并行执行的 span 会重叠，合计可能大于总耗时)")
+        st.dataframe(last_trace["by_name"], hide_index=True)
+        st.caption("明细 (start = 相对本轮开始的秒数)")
+        st.dataframe(last_trace["spans"], hide_index=True)
+        quota_stats = clients.quota_stats()
+        if quota_stats:
+            st.caption(f"SerpAPI 额度 (进程级): 剩余令牌 {quota_stats['tokens']}，排队中 {sum(quota_stats['queue_depth'].values())}")
+            st.dataframe([{"priority": name, **stats} for name, stats in quota_stats["by_priority"].items()], hide_index=True)
+        dir_stats = tools.direction_stats()
+        if dir_stats["legs"]:
+            st.caption(f"路线查询 (进程级): {dir_stats['legs']} 段路，查询 {dir_stats['requested']} 次，按距离策略省掉 {dir_stats['skipped']} 次")
+        st.caption("缓存 (进程级，启动以来累计)")
+        st.dataframe([{"cache": "geocode", **tools.geocode_cache.stats()}, {"cache": "serpapi", **tools.response_cache.stats()}], hide_index=True)
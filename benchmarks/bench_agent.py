@@ -0,0 +1,218 @@
+"""
+离线端到端 benchmark: 本地假 SerpAPI + 假 DeepSeek，驱动真实的 tools.py 和 app.py 对话循环
+
+用法:
+    python benchmarks/bench_agent.py [--iterations 20] [--turns 8] [--stops 6] [--scale 1.0]
+                                     [--latency latency.json] [--serp-rate 2.0] [--out bench.json] [--compare old.json]
+
+三个阶段:
+1. tools: 逐个调用 tools.run_tool (每轮参数不同，不命中缓存)
+2. maps: tools.generate_map_with_traffic，每张图 --stops 个地点 (对话阶段画的图也算在内)
+3. turns: streamlit AppTest 跑 app.py，每轮在 chat_input 里发一句话，假 LLM 按剧本调用工具
+输出每个工具 / 每张地图 / 每轮对话的 p50/p95/p99 (ms)，写进 JSON 文件方便跨 commit 对比
+--scale 会按比例缩放所有假延迟 (例如 0.1 用来快速冒烟)
+--serp-rate 打开 SerpAPI 额度调度 (每秒令牌数)；默认不限速，只测应用本身
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import config
+import fakes
+
+# ==========================================
+# 🟢 剧本: 每轮先并行查机票/酒店/景点，再画地图 (app.py 画完图会 rerun 结束这一轮)
+#    奇数轮改成查餐厅后直接回答文字
+# ==========================================
+def turn_script(turn_id):
+    n = int(turn_id) if turn_id.isdigit() else 0
+    city = f"Penang {n}"
+    if n % 2:
+        return [
+            {"tool_calls": [{"name": "search_restaurants", "arguments": {"city": city, "food_type": "nasi kandar"}},
+                            {"name": "search_general_web", "arguments": {"query": f"{city} weather"}}]},
+            {"content": f"Here is a food plan for {city}.\n\n" + "- **Stop**: try the local food.\n" * 40},
+        ]
+    return [
+        {"tool_calls": [{"name": "search_flights", "arguments": {"origin": "KUL", "destination": "PEN", "date": f"2026-12-{n % 28 + 1:02d}", "return_date": f"2026-12-{n % 28 + 2:02d}"}},
+                        {"name": "search_hotels", "arguments": {"city": city, "check_in_date": "2026-12-01", "check_out_date": "2026-12-03", "adults": 2}},
+                        {"name": "search_attractions", "arguments": {"city": city}}]},
+        {"content": f"Day plan for {city}.",
+         "tool_calls": [{"name": "generate_map_with_traffic", "arguments": {"locations_list": [f"{city} stop {k}" for k in range(5)]}}]},
+    ]
+
+TOOL_CASES = {
+    "search_flights": lambda i: {"origin": "KUL", "destination": "PEN", "date": f"2027-01-{i % 28 + 1:02d}", "return_date": f"2027-02-{i % 28 + 1:02d}"},
+    "search_hotels": lambda i: {"city": f"Ipoh {i}", "check_in_date": "2027-01-01", "check_out_date": "2027-01-03", "adults": 2},
+    "search_attractions": lambda i: {"city": f"Melaka {i}"},
+    "search_restaurants": lambda i: {"city": f"Melaka {i}", "food_type": "cendol"},
+    "search_general_web": lambda i: {"query": f"visa rules {i}"},
+}
+
+def summarize(samples):
+    if not samples: return None
+    arr = np.asarray(samples) * 1000
+    return {"n": len(samples), "p50": round(float(np.percentile(arr, 50)), 1), "p95": round(float(np.percentile(arr, 95)), 1),
+            "p99": round(float(np.percentile(arr, 99)), 1), "mean": round(float(arr.mean()), 1)}
+
+class Recorder:
+    """
+    包一层 tools.run_tool / tools.generate_map_with_traffic 记录耗时 (AppTest 的脚本线程里也会调用，所以要加锁)
+    """
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def wrap(self, module, attr, name_of):
+        original = getattr(module, attr)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.add(name_of(*args, **kwargs), time.perf_counter() - start)
+        setattr(module, attr, timed)
+
+def setup_environment(serp, llm, cache_dir, serp_rate=None):
+    # 每次都用全新的缓存目录，避免上一次运行的缓存影响结果
+    config.GEOCODE_CACHE_PATH = os.path.join(cache_dir, "geocode.sqlite")
+    config.SERP_CACHE_PATH = os.path.join(cache_dir, "serpapi.sqlite")
+    config.POI_INDEX_PATH = os.path.join(cache_dir, "poi.sqlite")
+    config.TRACE_LOG_PATH = os.path.join(cache_dir, "trace.jsonl")
+    config.LLM_BASE_URL = llm.url
+    config.DEEPSEEK_API_KEY = "bench"
+    config.SERPAPI_API_KEY = "bench"
+    config.SERPAPI_RATE_PER_SEC = serp_rate
+
+    # db.get_db() 第一次调用时才连 Firestore: 提前用匿名凭据 + 模拟器地址初始化，避免去找 firebase_key.json
+    os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "127.0.0.1:9")
+    import firebase_admin
+    from firebase_admin import credentials
+    from google.auth.credentials import AnonymousCredentials
+
+    class _OfflineCredential(credentials.Base):
+        def get_credential(self):
+            return AnonymousCredentials()
+
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(_OfflineCredential(), options={"projectId": "bench"})
+
+    import clients
+    import tools
+    clients.SERPAPI_ENDPOINT = f"{serp.url}/search"
+    return tools
+
+def run_tools_phase(tools, recorder, iterations):
+    for i in range(iterations):
+        for fn, make_args in TOOL_CASES.items():
+            tools.run_tool(fn, make_args(i))
+
+def run_maps_phase(tools, iterations, stops):
+    for i in range(iterations):
+        tools.generate_map_with_traffic([f"Kuala Lumpur map{i} stop {k}" for k in range(stops)])
+
+def run_turns_phase(recorder, turns, session_turns, timeout):
+    from streamlit.testing.v1 import AppTest
+    app = None
+    for n in range(turns):
+        if app is None or n % session_turns == 0:
+            app = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=timeout)
+            start = time.perf_counter()
+            app.run()
+            recorder.add("startup", time.perf_counter() - start)
+        start = time.perf_counter()
+        app.chat_input[0].set_value(f"Plan my trip, bench turn #{n}").run()
+        recorder.add("turn", time.perf_counter() - start)
+        if app.exception:
+            raise RuntimeError(f"app.py raised during turn {n}: {app.exception[0].message}")
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+def compare(report, old_path):
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    print(f"\nvs {old_path} ({old.get('commit')}):")
+    for section in ("tools", "maps", "turns"):
+        for name, stats in report[section].items():
+            before = old.get(section, {}).get(name)
+            if not stats or not before: continue
+            deltas = [f"{q} {before[q]:.0f}->{stats[q]:.0f} ({(stats[q] / before[q] - 1) * 100:+.0f}%)" for q in ("p50", "p95", "p99") if before[q]]
+            print(f"  {section}/{name}: " + ", ".join(deltas))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20, help="tools / maps 阶段的重复次数")
+    parser.add_argument("--turns", type=int, default=8)
+    parser.add_argument("--session-turns", type=int, default=4, help="每个 AppTest 会话跑几轮后换新会话")
+    parser.add_argument("--stops", type=int, default=6)
+    parser.add_argument("--scale", type=float, default=1.0, help="假延迟缩放系数")
+    parser.add_argument("--latency", help="JSON: {engine: {median_ms, sigma, error_rate}, \"llm\": {...}}")
+    parser.add_argument("--serp-rate", type=float, help="SerpAPI 令牌桶速度 (每秒)，不传则不限速")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare")
+    args = parser.parse_args()
+
+    latency = {}
+    if args.latency:
+        with open(args.latency, encoding="utf-8") as f:
+            latency = json.load(f)
+    serp = fakes.FakeSerpAPI({k: v for k, v in latency.items() if k != "llm"}, args.scale).start()
+    llm = fakes.FakeLLM(turn_script, latency.get("llm"), args.scale).start()
+
+    with tempfile.TemporaryDirectory(prefix="bench_cache_") as cache_dir:
+        tools = setup_environment(serp, llm, cache_dir, args.serp_rate)
+        recorder = Recorder()
+        recorder.wrap(tools, "run_tool", lambda fn, args: fn)
+        recorder.wrap(tools, "generate_map_with_traffic", lambda *a, **k: "map")
+
+        started = time.perf_counter()
+        run_tools_phase(tools, recorder, args.iterations)
+        run_maps_phase(tools, args.iterations, args.stops)
+        run_turns_phase(recorder, args.turns, args.session_turns, args.timeout)
+        elapsed = time.perf_counter() - started
+
+    samples = recorder.samples
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": vars(args),
+        "elapsed_s": round(elapsed, 2),
+        "tools": {name: summarize(s) for name, s in sorted(samples.items()) if name not in ("map", "turn", "startup")},
+        "maps": {"generate_map_with_traffic": summarize(samples.get("map", []))},
+        "turns": {"turn": summarize(samples.get("turn", [])), "startup": summarize(samples.get("startup", []))},
+        "requests": {"serpapi": dict(sorted(serp.counts.items())), "llm": dict(sorted(llm.counts.items()))},
+        "quota": tools.clients.quota_stats(),
+    }
+    serp.stop()
+    llm.stop()
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps({k: report[k] for k in ("tools", "maps", "turns", "requests", "quota")}, ensure_ascii=False, indent=2))
+    print(f"\n📄 Results written to {args.out}")
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == "__main__":
+    main()
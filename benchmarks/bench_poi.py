@@ -0,0 +1,131 @@
+"""
+本地 POI 索引查询延迟: 先灌入 N 个合成地点 (默认 100 万)，再测附近 / 城市两类查询
+
+用法:
+    python benchmarks/bench_poi.py [--pois 1000000] [--queries 500] [--max-p95-ms 50] [--out poi.json]
+
+- 地点按高斯分布聚在 12 个马来西亚城市周围 (σ ≈ 5 km)，类别 / 关键词 / 评分随机
+- nearby: 随机城市中心附近一点，半径 config.POI_NEARBY_RADIUS_KM，分带关键词 / 不带关键词
+  (不带关键词的附近查询没有对应的 coverage，按新鲜度策略不命中，测的是扫描完再回退 SerpAPI 前的耗时)
+- area: 某城市的 top 景点 / 某种美食
+每类查询报告 p50 / p95 / p99 和本地命中率；任何一类 p95 超过 --max-p95-ms 时返回非 0
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import config
+
+CITIES = {
+    "kuala lumpur": (3.1390, 101.6869), "penang": (5.4141, 100.3288), "melaka": (2.1896, 102.2501),
+    "ipoh": (4.5975, 101.0901), "johor bahru": (1.4927, 103.7414), "kota kinabalu": (5.9804, 116.0735),
+    "kuching": (1.5535, 110.3593), "langkawi": (6.3500, 99.8000), "cameron highlands": (4.4718, 101.3767),
+    "kuantan": (3.8077, 103.3260), "alor setar": (6.1248, 100.3678), "kota bharu": (6.1254, 102.2381),
+}
+KEYWORDS = {
+    "restaurant": ["nasi lemak", "char kway teow", "dim sum", "sushi", "roti canai", "seafood", "肉骨茶", "laksa"],
+    "attraction": ["museum", "temple", "park", "beach", "night market", "heritage", "mosque", None],
+}
+TYPES = {"restaurant": "Restaurant", "attraction": "Tourist attraction"}
+
+def synthetic(n, rng):
+    for i in range(n):
+        city = rng.choice(list(CITIES))
+        lat0, lng0 = CITIES[city]
+        category = "restaurant" if rng.random() < 0.6 else "attraction"
+        keyword = rng.choice(KEYWORDS[category])
+        yield city, category, keyword, {
+            "place_id": f"bench{i}",
+            "title": f"{(keyword or 'spot').title()} {city.title()} {i}",
+            "type": TYPES[category],
+            "rating": round(rng.uniform(3.0, 5.0), 1),
+            "reviews": rng.randint(0, 5000),
+            "address": f"{i} Jalan Bench, {city.title()}",
+            "gps_coordinates": {"latitude": rng.gauss(lat0, 0.045), "longitude": rng.gauss(lng0, 0.045)},
+        }
+
+def fill(index, n, batch, rng):
+    """
+    按 (城市, 类别, 关键词) 分组成批 ingest，模拟一次次 SerpAPI 查询的结果写回
+    """
+    groups = {}
+    started = time.perf_counter()
+    for city, category, keyword, place in synthetic(n, rng):
+        group = groups.setdefault((city, category, keyword), [])
+        group.append(place)
+        if len(group) >= batch:
+            index.ingest(group, category, area=city, keyword=keyword)
+            group.clear()
+    for (city, category, keyword), group in groups.items():
+        if group: index.ingest(group, category, area=city, keyword=keyword)
+    return time.perf_counter() - started
+
+def measure(fn, queries):
+    latencies, hits = [], 0
+    for args in queries:
+        started = time.perf_counter()
+        places = fn(*args)
+        latencies.append((time.perf_counter() - started) * 1000)
+        hits += places is not None
+    latencies.sort()
+    pick = lambda q: round(latencies[min(len(latencies) - 1, int(q * len(latencies)))], 2)
+    return {"queries": len(queries), "hit_rate": round(hits / len(queries), 3),
+            "p50_ms": round(statistics.median(latencies), 2), "p95_ms": pick(0.95), "p99_ms": pick(0.99)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pois", type=int, default=1_000_000)
+    parser.add_argument("--batch", type=int, default=20, help="每次 ingest 的地点数 (一页 google_maps 结果约 20 个)")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--max-p95-ms", type=float, default=50.0)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--out")
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory(prefix="bench_poi_") as cache_dir:
+        config.POI_INDEX_PATH = os.path.join(cache_dir, "poi.sqlite")
+        import poi
+        index = poi.poi_index
+        seconds = fill(index, args.pois, args.batch, rng)
+        print(f"📥 Ingested {args.pois:,} POIs in {seconds:.1f}s ({args.pois / seconds:,.0f}/s), "
+              f"db {os.path.getsize(config.POI_INDEX_PATH) / 1e6:.0f} MB, fts={index.fts}")
+
+        radius = config.POI_NEARBY_RADIUS_KM
+        near = lambda: (lambda c: (rng.gauss(c[0], 0.03), rng.gauss(c[1], 0.03)))(CITIES[rng.choice(list(CITIES))])
+        cases = {
+            "nearby": (lambda lat, lng: index.search_nearby(lat, lng, radius, "restaurant"),
+                       [near() for _ in range(args.queries)]),
+            "nearby+keyword": (lambda lat, lng, kw: index.search_nearby(lat, lng, radius, "restaurant", kw, limit=3),
+                               [(*near(), rng.choice(KEYWORDS["restaurant"])) for _ in range(args.queries)]),
+            "area": (lambda city: index.search_area(city, "attraction"),
+                     [(rng.choice(list(CITIES)),) for _ in range(args.queries)]),
+            "area+keyword": (lambda city, kw: index.search_area(city, "restaurant", kw, limit=3),
+                             [(rng.choice(list(CITIES)), rng.choice(KEYWORDS["restaurant"])) for _ in range(args.queries)]),
+        }
+        report = {"pois": args.pois, "ingest_per_sec": round(args.pois / seconds), "results": {}}
+        for name, (fn, queries) in cases.items():
+            report["results"][name] = measure(fn, queries)
+
+    print(f"{'query':>16} | {'hit rate':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for name, row in report["results"].items():
+        print(f"{name:>16} | {row['hit_rate']:>8.1%} {row['p50_ms']:>6.2f}ms {row['p95_ms']:>6.2f}ms {row['p99_ms']:>6.2f}ms")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📄 Results written to {args.out}")
+
+    slow = [name for name, row in report["results"].items() if row["p95_ms"] > args.max_p95_ms]
+    print(f"❌ p95 over {args.max_p95_ms}ms: {', '.join(slow)}" if slow else f"✅ all p95 within {args.max_p95_ms}ms")
+    return 1 if slow else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
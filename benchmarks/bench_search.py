@@ -0,0 +1,102 @@
+"""
+聊天记录搜索: 建索引 / 增量更新 / 查询延迟 (纯内存，不连 Firestore)
+
+用法:
+    python benchmarks/bench_search.py [--chats 500] [--turns 30] [--queries 500] [--max-p95-ms 10] [--out search.json]
+
+- 合成 N 个中英马混合的对话 (每个 --turns 轮，助手回复较长)，算好 search_tf 字符串 (和 save_chat_history 写入的一样)
+- load: 从 search_tf 字符串建索引的耗时 (对应 db.load_search_index 读完之后的部分)
+- put: 单个 chat 追加消息后重新索引的耗时 (对应每次 save_chat_history: 只对新消息分词，累加到已有词频上)
+- search: 城市 / 美食 / 中文 / 前缀 / 多词查询的 p50 / p95
+p95 超过 --max-p95-ms 时返回非 0
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import search
+
+CITIES = ["Tokyo 东京", "Osaka 大阪", "Melaka 马六甲", "Penang 槟城", "Bangkok 曼谷", "Seoul 首尔", "Bali", "Langkawi 兰卡威", "Ipoh 怡保", "Taipei 台北"]
+FOODS = ["nasi lemak", "char kway teow", "sushi", "ramen", "cendol", "asam pedas", "肉骨茶", "拉面", "dim sum", "satay"]
+FILLER = ("Day {d}: pagi pergi ke {place}, then lunch at a local {food} stall. 下午去{city}的老街逛逛，晚上看夜景。"
+          "Budget around RM {rm} per person, transport by Grab. Jangan lupa bawa payung kalau hujan. ")
+QUERIES = ["tokyo", "东京", "melaka cendol", "肉骨茶", "pena", "槟", "sushi bangkok", "night market", "asam pedas 马六甲", "grab budget"]
+
+def synthetic_chat(i, turns, rng):
+    city = rng.choice(CITIES)
+    messages = []
+    for t in range(turns):
+        food = rng.choice(FOODS)
+        messages.append({"role": "user", "content": f"Plan {rng.randint(2, 7)} hari di {city}, nak cuba {food}"})
+        messages.append({"role": "assistant", "content": "".join(
+            FILLER.format(d=d, place=f"{city.split()[0]} Street {rng.randint(1, 500)}", food=rng.choice(FOODS),
+                          city=city.split()[-1], rm=rng.randint(50, 900)) for d in range(1, 4))})
+    return {"chat_id": f"chat{i}", "title": f"{city} trip {i}", "messages": messages}
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return {"p50_ms": round(statistics.median(latencies), 3), "p95_ms": round(latencies[int(0.95 * (len(latencies) - 1))], 3)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--max-p95-ms", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--out")
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    chats = [synthetic_chat(i, args.turns, rng) for i in range(args.chats)]
+    encoded = {c["chat_id"]: (c["title"], search.encode_terms(search.chat_terms(c))) for c in chats}
+    stored_kb = sum(len(raw.encode("utf-8")) for _, raw in encoded.values()) / 1024
+
+    started = time.perf_counter()
+    index = search.ChatSearchIndex()
+    for chat_id, (title, raw) in encoded.items():
+        index.put(chat_id, title, search.decode_terms(raw))
+    load_ms = (time.perf_counter() - started) * 1000
+
+    put_latencies = []
+    for chat in rng.sample(chats, min(50, len(chats))):
+        base = search.chat_terms(chat)
+        msg = {"role": "assistant", "content": "Tambah satu hari di Cameron Highlands 金马仑 strawberry farm"}
+        started = time.perf_counter()
+        index.put(chat["chat_id"], chat["title"], base + search.message_terms([msg]))
+        put_latencies.append((time.perf_counter() - started) * 1000)
+
+    report = {"chats": args.chats, "vocabulary": len(index.postings), "search_tf_kb": round(stored_kb, 1),
+              "load_ms": round(load_ms, 1), "put": percentiles(put_latencies), "search": {}}
+    for query in QUERIES:
+        latencies = []
+        for _ in range(max(1, args.queries // len(QUERIES))):
+            started = time.perf_counter()
+            hits = index.search(query, 8)
+            latencies.append((time.perf_counter() - started) * 1000)
+        report["search"][query] = dict(percentiles(latencies), hits=len(hits))
+
+    print(f"📚 {args.chats} chats, vocabulary {report['vocabulary']:,} terms, search_tf total {report['search_tf_kb']:.0f} KB")
+    print(f"   build from search_tf: {report['load_ms']:.1f} ms, re-index one chat: p50 {report['put']['p50_ms']:.2f} ms / p95 {report['put']['p95_ms']:.2f} ms")
+    print(f"{'query':>20} | {'hits':>4} {'p50':>9} {'p95':>9}")
+    for query, row in report["search"].items():
+        print(f"{query:>20} | {row['hits']:>4} {row['p50_ms']:>7.3f}ms {row['p95_ms']:>7.3f}ms")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📄 Results written to {args.out}")
+
+    worst = max(row["p95_ms"] for row in report["search"].values())
+    ok = worst <= args.max_p95_ms
+    print(f"✅ worst search p95 {worst:.2f}ms" if ok else f"❌ worst search p95 {worst:.2f}ms over {args.max_p95_ms}ms")
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
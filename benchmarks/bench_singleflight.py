@@ -0,0 +1,104 @@
+"""
+Single-flight 压力测试: 越来越多的会话同时发出完全相同的 SerpAPI 请求，上游请求数应该保持不变
+
+用法:
+    python benchmarks/bench_singleflight.py [--concurrency 1,2,4,8,16,32,64] [--scale 0.3] [--out sf.json]
+
+每一档并发:
+- N 个线程 (模拟 N 个 Streamlit 会话) 同时调用 search_attractions_async(同一个城市) 和 get_coordinates_async(同一个地点)
+- 每档用新的城市名，不命中响应缓存 / 坐标缓存
+- 分别在 single-flight 开 / 关 (config.SERPAPI_SINGLE_FLIGHT) 下跑一次，记录上游请求数和 p50/max 延迟
+开启时每档的上游请求数必须都是 2 (一次景点 + 一次坐标)，否则返回非 0
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import config
+import fakes
+
+def burst(tools, clients, n, city):
+    """
+    n 个线程在同一时刻开始，各自查同一个城市的景点 + 坐标，返回每个线程的耗时 (ms)
+    """
+    barrier = threading.Barrier(n)
+    latencies = [None] * n
+    errors = []
+
+    def session(i):
+        barrier.wait()
+        started = time.perf_counter()
+        try:
+            clients.run_async(tools.search_attractions_async(city))
+            clients.run_async(tools.get_coordinates_async(f"{city} Sentral"))
+        except Exception as e:
+            errors.append(e)
+        latencies[i] = (time.perf_counter() - started) * 1000
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(n)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    if errors: raise errors[0]
+    return latencies
+
+def run(tools, clients, serp, levels, single_flight, tag):
+    config.SERPAPI_SINGLE_FLIGHT = single_flight
+    rows = []
+    for n in levels:
+        before = sum(serp.counts.values())
+        latencies = burst(tools, clients, n, f"Penang {tag} {n}")
+        rows.append({"sessions": n, "upstream": sum(serp.counts.values()) - before,
+                     "p50_ms": round(statistics.median(latencies), 1), "max_ms": round(max(latencies), 1)})
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32,64")
+    parser.add_argument("--scale", type=float, default=0.3, help="假延迟缩放系数")
+    parser.add_argument("--out")
+    args = parser.parse_args()
+    levels = [int(x) for x in args.concurrency.split(",")]
+
+    serp = fakes.FakeSerpAPI(scale=args.scale).start()
+    with tempfile.TemporaryDirectory(prefix="bench_sf_") as cache_dir:
+        config.GEOCODE_CACHE_PATH = os.path.join(cache_dir, "geocode.sqlite")
+        config.SERP_CACHE_PATH = os.path.join(cache_dir, "serpapi.sqlite")
+        config.POI_INDEX_PATH = os.path.join(cache_dir, "poi.sqlite")
+        config.TRACE_LOG_PATH = None
+        config.SERPAPI_API_KEY = "bench"
+        config.SERPAPI_RATE_PER_SEC = None  # 只看合并效果，不让额度调度影响延迟
+        import clients
+        import tools
+        clients.SERPAPI_ENDPOINT = f"{serp.url}/search"
+
+        report = {
+            "single_flight": run(tools, clients, serp, levels, True, "on"),
+            "no_single_flight": run(tools, clients, serp, levels, False, "off"),
+            "stats": tools.serp_flight_stats(),
+        }
+    serp.stop()
+
+    print(f"{'sessions':>8} | {'upstream (on)':>13} {'p50':>8} {'max':>8} | {'upstream (off)':>14} {'p50':>8} {'max':>8}")
+    for on, off in zip(report["single_flight"], report["no_single_flight"]):
+        print(f"{on['sessions']:>8} | {on['upstream']:>13} {on['p50_ms']:>8.0f} {on['max_ms']:>8.0f} | {off['upstream']:>14} {off['p50_ms']:>8.0f} {off['max_ms']:>8.0f}")
+    print(f"\nsingle-flight stats: {report['stats']}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📄 Results written to {args.out}")
+
+    flat = all(row["upstream"] == 2 for row in report["single_flight"])
+    print("✅ upstream calls stay flat" if flat else "❌ upstream calls grew with concurrency")
+    return 0 if flat else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
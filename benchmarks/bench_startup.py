@@ -0,0 +1,177 @@
+"""
+冷启动 / rerun 开销 benchmark (带预算，超了就返回非 0，方便放进 CI)
+
+用法:
+    python benchmarks/bench_startup.py [--repeat 5] [--reruns 20] [--budget benchmarks/startup_budget.json]
+                                       [--out startup.json] [--write-budget]
+
+三项测量:
+1. import: 新进程里 `python -X importtime` 导入 app.py 用到的所有模块 (取 --repeat 次的中位数)，
+   拆成 streamlit 本身和我们自己的模块两部分，并列出最重的几个模块
+2. first_run: streamlit AppTest 第一次跑 app.py (登录页，模块还没导入)
+3. rerun: 同一个会话再跑 --reruns 次 (每次交互 Streamlit 都会从头执行 app.py)
+另外检查 lazy_modules 里的重模块 (openai / folium / firebase_admin / docx ...) 在登录页有没有被导入
+
+--write-budget: 按这次的测量值 * 1.5 重写预算文件 (有意的性能变化之后用)
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_BUDGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_budget.json")
+# app.py 顶部导入的模块 (cache / classifier 会被间接导入；routing 是画路线时才导入的)
+APP_MODULES = ["clients", "config", "context", "db", "preferences", "tools", "tracing", "utils"]
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+BUDGET_HEADROOM = 1.5
+
+# ==========================================
+# 🟢 1. 冷导入 (每次一个新进程)
+# ==========================================
+def parse_importtime(stderr):
+    """
+    返回 (顶层模块 -> 累计 ms, 模块 -> 累计 ms)
+    """
+    top, cumulative = {}, {}
+    for line in stderr.splitlines():
+        m = IMPORTTIME_RE.match(line)
+        if not m: continue
+        ms = int(m.group(2)) / 1000
+        cumulative[m.group(4)] = max(cumulative.get(m.group(4), 0), ms)
+        if len(m.group(3)) == 1:
+            top[m.group(4)] = ms
+    return top, cumulative
+
+def measure_import(lazy_modules):
+    code = (f"import sys; sys.path.insert(0, {ROOT!r}); import streamlit; "
+            + "; ".join(f"import {name}" for name in APP_MODULES)
+            + f"; import json; print(json.dumps(sorted(m for m in {lazy_modules!r} if m in sys.modules)))")
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, cwd=ROOT)
+    wall_ms = (time.perf_counter() - started) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError(f"import failed:\n{proc.stderr[-2000:]}")
+    top, cumulative = parse_importtime(proc.stderr)
+    streamlit_ms = top.get("streamlit", 0)
+    return {
+        "wall_ms": wall_ms,
+        "import_ms": sum(top.values()),
+        "streamlit_ms": streamlit_ms,
+        "app_modules_ms": sum(top.values()) - streamlit_ms,
+        "heaviest": sorted(((ms, name) for name, ms in cumulative.items() if not name.startswith("streamlit")), reverse=True)[:8],
+        "lazy_loaded": json.loads(proc.stdout.strip().splitlines()[-1]),
+    }
+
+# ==========================================
+# 🟢 2/3. AppTest 第一次运行 + rerun (单独的子进程，保证模块都是冷的)
+# ==========================================
+def _apptest_child(reruns, lazy_modules):
+    import config
+    config.TRACE_LOG_PATH = os.path.join(tempfile.mkdtemp(prefix="bench_startup_"), "trace.jsonl")
+    config.METRICS_PORT = None
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=60)
+    started = time.perf_counter()
+    app.run()
+    first_run_ms = (time.perf_counter() - started) * 1000
+    if app.exception:
+        raise RuntimeError(f"app.py raised: {app.exception[0].message}")
+    lazy_loaded = sorted(m for m in lazy_modules if m in sys.modules)
+
+    samples = []
+    for _ in range(reruns):
+        started = time.perf_counter()
+        app.run()
+        samples.append((time.perf_counter() - started) * 1000)
+    print(json.dumps({"first_run_ms": first_run_ms, "rerun_ms": statistics.median(samples),
+                      "rerun_max_ms": max(samples), "lazy_loaded_after_run": lazy_loaded}))
+
+def measure_apptest(reruns, lazy_modules):
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--_apptest-child", str(reruns), json.dumps(lazy_modules)],
+                          capture_output=True, text=True, cwd=ROOT)
+    if proc.returncode != 0:
+        raise RuntimeError(f"AppTest run failed:\n{proc.stderr[-2000:]}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+# ==========================================
+# 🟢 预算检查
+# ==========================================
+def check_budget(report, budget):
+    failures = []
+    for key in ("import_ms", "app_modules_ms", "first_run_ms", "rerun_ms"):
+        limit = budget.get(key)
+        if limit is None: continue
+        ok = report[key] <= limit
+        print(f"  {'✅' if ok else '❌'} {key:<15} {report[key]:8.1f} ms  (budget {limit:.0f})")
+        if not ok: failures.append(key)
+    loaded = sorted(set(report["lazy_loaded"]) | set(report["lazy_loaded_after_run"]))
+    print(f"  {'❌' if loaded else '✅'} lazy modules loaded at startup: {loaded or 'none'}")
+    if loaded: failures.append("lazy_modules")
+    return failures
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--_apptest-child":
+        return _apptest_child(int(sys.argv[2]), json.loads(sys.argv[3]))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="冷导入测几次 (取中位数)")
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--budget", default=DEFAULT_BUDGET)
+    parser.add_argument("--out")
+    parser.add_argument("--write-budget", action="store_true")
+    args = parser.parse_args()
+
+    with open(args.budget, encoding="utf-8") as f:
+        budget = json.load(f)
+    lazy_modules = budget.get("lazy_modules", [])
+
+    imports = [measure_import(lazy_modules) for _ in range(args.repeat)]
+    runs = measure_apptest(args.reruns, lazy_modules)
+    median = lambda key: round(statistics.median(r[key] for r in imports), 1)
+    report = {
+        "import_ms": median("import_ms"),
+        "streamlit_ms": median("streamlit_ms"),
+        "app_modules_ms": median("app_modules_ms"),
+        "import_wall_ms": median("wall_ms"),
+        "first_run_ms": round(runs["first_run_ms"], 1),
+        "rerun_ms": round(runs["rerun_ms"], 1),
+        "rerun_max_ms": round(runs["rerun_max_ms"], 1),
+        "lazy_loaded": imports[-1]["lazy_loaded"],
+        "lazy_loaded_after_run": runs["lazy_loaded_after_run"],
+        "heaviest": [{"module": name, "ms": round(ms, 1)} for ms, name in imports[-1]["heaviest"]],
+    }
+
+    print("Heaviest non-streamlit imports:")
+    for entry in report["heaviest"]:
+        print(f"  {entry['ms']:8.1f} ms  {entry['module']}")
+    print(f"\nstreamlit itself: {report['streamlit_ms']:.1f} ms, rerun max: {report['rerun_max_ms']:.1f} ms\n")
+    failures = check_budget(report, budget)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n📄 Results written to {args.out}")
+    if args.write_budget:
+        for key in ("import_ms", "app_modules_ms", "first_run_ms", "rerun_ms"):
+            budget[key] = round(report[key] * BUDGET_HEADROOM)
+        with open(args.budget, "w", encoding="utf-8") as f:
+            json.dump(budget, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"📄 Budget updated: {args.budget}")
+        return 0
+    if failures:
+        print(f"\n❌ Over budget: {', '.join(failures)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""
+本地偏好分类器 benchmark
+
+用法:
+    python benchmarks/bench_tags.py [recorded_chats.jsonl] [--repeat 200]
+
+recorded_chats.jsonl: 每行一个 chat (从 Firestore 导出的 {"messages": [...]}，可选 "tags": [...] 作为标注)
+不传文件时使用内置的示例对话
+输出: 每秒处理的对话数 / 标签数、本地就能拿准 (跳过 LLM) 的比例、有标注时的准确率
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import classifier
+import config
+
+SAMPLE_CHATS = [
+    {"messages": [{"role": "user", "content": "Plan a 3 day trip to Penang with my kids, we want cheap food"}], "tags": ["🍱 美食 (Foodie)", "🎒 穷游 (Budget)", "👨‍👩‍👧‍👦 亲子 (Family)"]},
+    {"messages": [{"role": "user", "content": "我想去曼谷购物，顺便找个按摩放松一下"}], "tags": ["🛍️ 购物 (Shopping)", "💆‍♂️ 放松 (Relax)"]},
+    {"messages": [{"role": "user", "content": "Nak cari tempat makan sedap dan murah di Ipoh"}], "tags": ["🍱 美食 (Foodie)", "🎒 穷游 (Budget)"]},
+    {"messages": [{"role": "user", "content": "Honeymoon in Bali, 5-star villa and fine dining please"}], "tags": ["💎 奢华 (Luxury)"]},
+    {"messages": [{"role": "user", "content": "想去马六甲看历史古迹和博物馆，顺便拍照打卡"}], "tags": ["🏛️ 历史 (History)", "📸 拍照打卡 (Insta-worthy)"]},
+    {"messages": [{"role": "user", "content": "Hiking in Cameron Highlands, any waterfall nearby?"}], "tags": ["🌲 大自然 (Nature)"]},
+    {"messages": [{"role": "user", "content": "Flights from KL to Tokyo next month"}], "tags": []},
+    {"messages": [{"role": "user", "content": "Where should we have dinner near the mall?"}], "tags": []},
+    {"messages": [{"role": "user", "content": "带娃去新加坡，动物园和水族馆怎么安排"}], "tags": ["👨‍👩‍👧‍👦 亲子 (Family)"]},
+    {"messages": [{"role": "user", "content": "Any nice sunset view spots in Langkawi?"}], "tags": []},
+    # 隐含偏好: 没有 (或只有很弱的) 关键词，但用户其实有明确倾向，必须交给 LLM
+    {"messages": [{"role": "user", "content": "We want a quiet getaway with our 5 year old son, somewhere with good seafood"}], "tags": ["💆‍♂️ 放松 (Relax)", "👨‍👩‍👧‍👦 亲子 (Family)", "🍱 美食 (Foodie)"]},
+    {"messages": [{"role": "user", "content": "Plan 3 days in Tokyo"}], "tags": []},
+    {"messages": [{"role": "user", "content": "Our anniversary trip, money is no object, want the best suite with a butler"}], "tags": ["💎 奢华 (Luxury)"]},
+    {"messages": [{"role": "user", "content": "I'm a student, trying to keep it under RM500 for the whole week"}], "tags": ["🎒 穷游 (Budget)"]},
+    {"messages": [{"role": "user", "content": "爸妈年纪大了，想找个不用走太多路、可以慢慢逛的地方"}], "tags": ["💆‍♂️ 放松 (Relax)"]},
+    {"messages": [{"role": "user", "content": "我老婆想买几个名牌包，顺便吃顿好的"}], "tags": ["🛍️ 购物 (Shopping)", "💎 奢华 (Luxury)", "🍱 美食 (Foodie)"]},
+    {"messages": [{"role": "user", "content": "Nak bawa mak ayah dan anak-anak ke Sabah, nak tengok orang utan"}], "tags": ["👨‍👩‍👧‍👦 亲子 (Family)", "🌲 大自然 (Nature)"]},
+    {"messages": [{"role": "user", "content": "Which hawker centre in Penang has the best char kway teow? We're on a budget"}], "tags": ["🍱 美食 (Foodie)", "🎒 穷游 (Budget)"]},
+    {"messages": [{"role": "user", "content": "Want to see the old shophouses and learn about the Peranakan story in Melaka"}], "tags": ["🏛️ 历史 (History)"]},
+    {"messages": [{"role": "user", "content": "Somewhere cool and green to escape the KL heat for a weekend"}], "tags": ["🌲 大自然 (Nature)", "💆‍♂️ 放松 (Relax)"]},
+]
+
+def load_chats(path):
+    if not path: return SAMPLE_CHATS
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def user_text(chat):
+    return "\n".join(m.get("content") or "" for m in chat.get("messages", []) if isinstance(m, dict) and m.get("role") == "user")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("chats", nargs="?")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    chats = load_chats(args.chats)
+    texts = [user_text(c) for c in chats]
+
+    # 1. 吞吐量
+    tag_count = 0
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for text in texts:
+            tag_count += len(classifier.classify(text)[0])
+    elapsed = time.perf_counter() - start
+    runs = args.repeat * len(texts)
+
+    # 2. 跳过 LLM 的比例 + 标注准确率
+    local = 0
+    labelled = correct = 0
+    for chat, text in zip(chats, texts):
+        tags, confidence, _ = classifier.classify(text)
+        if confidence >= config.PREF_LOCAL_CONFIDENCE:
+            local += 1
+            if "tags" in chat:
+                labelled += 1
+                correct += set(tags) == set(chat["tags"])
+
+    report = {
+        "chats": len(chats),
+        "chats_per_sec": round(runs / elapsed),
+        "tags_per_sec": round(tag_count / elapsed),
+        "us_per_chat": round(elapsed / runs * 1e6, 2),
+        "llm_calls_avoided": round(local / len(chats), 3),
+        "local_exact_match": round(correct / labelled, 3) if labelled else None,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
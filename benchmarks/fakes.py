@@ -0,0 +1,203 @@
+"""
+本地假服务 (离线 benchmark 用，不消耗真实额度)
+
+- FakeSerpAPI: 模拟 google_flights / google_hotels / google_maps / google_maps_directions / google / google_images，
+  每个 engine 的延迟按对数正态分布抽样 (中位数 + sigma)，可选按比例返回 503 触发重试
+- FakeLLM: OpenAI 兼容的 /chat/completions (支持 stream=True 的 SSE)，按剧本返回 tool_calls 或文本
+"""
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# engine -> {"median_ms", "sigma", "error_rate"}
+DEFAULT_LATENCY = {
+    "google_flights": {"median_ms": 900, "sigma": 0.35},
+    "google_hotels": {"median_ms": 700, "sigma": 0.35},
+    "google_maps": {"median_ms": 350, "sigma": 0.3},
+    "google_maps_directions": {"median_ms": 300, "sigma": 0.3},
+    "google": {"median_ms": 400, "sigma": 0.3},
+    "google_images": {"median_ms": 250, "sigma": 0.3},
+}
+DEFAULT_LLM_LATENCY = {"first_token_ms": 600, "sigma": 0.3, "chunk_ms": 15, "chunk_chars": 12}
+
+def sample_ms(profile, scale=1.0):
+    return profile["median_ms"] * math.exp(random.gauss(0, profile.get("sigma", 0))) * scale
+
+def _stable_unit(text, salt):
+    # 同一个地点名每次都落在同一个坐标上
+    digest = hashlib.sha1(f"{salt}:{text}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") / 2 ** 32
+
+def _coords(name):
+    return 3.05 + _stable_unit(name, "lat") * 0.25, 101.55 + _stable_unit(name, "lng") * 0.25
+
+class _Server:
+    """
+    ThreadingHTTPServer 跑在后台线程上，记录每种请求的次数
+    """
+
+    def __init__(self, handler_cls):
+        self.counts = {}
+        self.lock = threading.Lock()
+        handler = type(handler_cls.__name__, (handler_cls,), {"owner": self})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name=handler_cls.__name__, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class _Handler(BaseHTTPRequestHandler):
+    owner = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# ==========================================
+# 🟢 假 SerpAPI
+# ==========================================
+class _SerpHandler(_Handler):
+    def do_GET(self):
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        engine = params.get("engine", "google")
+        server = self.owner
+        server.count(engine)
+        profile = server.latency.get(engine, {"median_ms": 200, "sigma": 0.3})
+        time.sleep(sample_ms(profile, server.scale) / 1000)
+        if random.random() < profile.get("error_rate", 0):
+            server.count(f"{engine}:503")
+            return self._send_json(503, {"error": "fake upstream overloaded"})
+        self._send_json(200, serp_response(engine, params))
+
+def serp_response(engine, params):
+    q = params.get("q", "")
+    if engine == "google_flights":
+        return {"best_flights": [{"flights": [{"airline": "AirAsia"}], "price": 300 + int(_stable_unit(params.get("outbound_date", ""), "p") * 400), "total_duration": 125}]}
+    if engine == "google_hotels":
+        return {"properties": [{"name": f"Hotel {q[:20]} #{i}", "rate_per_night": {"lowest": f"RM {150 + i * 40}"}} for i in range(5)]}
+    if engine == "google_maps":
+        results = []
+        for i in range(10):
+            lat, lng = _coords(q if i == 0 else f"{q}#{i}")
+            results.append({"title": q if i == 0 else f"{q} #{i}", "rating": 4.5, "address": "Jalan Bench", "thumbnail": None,
+                            "gps_coordinates": {"latitude": lat, "longitude": lng}})
+        return {"local_results": results}
+    if engine == "google_maps_directions":
+        (lat1, lng1), (lat2, lng2) = [map(float, params[k].split(",")) for k in ("start_coords", "end_coords")]
+        km = math.hypot(lat2 - lat1, (lng2 - lng1) * math.cos(math.radians(lat1))) * 111
+        speed = {"0": 30, "3": 20, "2": 5}.get(params.get("travel_mode"), 30)
+        seconds = int(km / speed * 3600) + 60
+        return {"directions": [{"duration": seconds, "formatted_duration": f"{seconds // 60} min",
+                                "legs": [{"steps": [{"travel_mode": "TRANSIT", "transit_details": {"line": {"short_name": "LRT"}}}]}]}]}
+    if engine == "google_images":
+        return {"images_results": [{"thumbnail": "https://example.invalid/img.jpg"}]}
+    return {"organic_results": [{"title": f"{q} result {i}", "snippet": "Fake snippet."} for i in range(3)]}
+
+class FakeSerpAPI(_Server):
+    def __init__(self, latency=None, scale=1.0):
+        super().__init__(_SerpHandler)
+        self.latency = {**DEFAULT_LATENCY, **(latency or {})}
+        self.scale = scale
+
+# ==========================================
+# 🟢 假 DeepSeek (OpenAI 兼容)
+# ==========================================
+class _LLMHandler(_Handler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        req = json.loads(self.rfile.read(length) or b"{}")
+        server = self.owner
+        messages = req.get("messages", [])
+        step = server.script_step(messages) if req.get("tools") else {"content": server.preference_reply}
+        server.count("stream" if req.get("stream") else "complete")
+
+        profile = server.latency
+        time.sleep(sample_ms({"median_ms": profile["first_token_ms"], "sigma": profile["sigma"]}, server.scale) / 1000)
+        if req.get("stream"):
+            self._stream(step, profile)
+        else:
+            self._send_json(200, _completion(step))
+
+    def _stream(self, step, profile):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for chunk in _chunks(step, profile["chunk_chars"]):
+            self.wfile.write(b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n\n")
+            self.wfile.flush()
+            time.sleep(profile["chunk_ms"] * self.owner.scale / 1000)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+def _chunk(delta, finish=None):
+    return {"id": "bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": "deepseek-chat",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+
+def _chunks(step, chunk_chars):
+    yield _chunk({"role": "assistant", "content": ""})
+    text = step.get("content") or ""
+    for start in range(0, len(text), chunk_chars):
+        yield _chunk({"content": text[start:start + chunk_chars]})
+    for index, call in enumerate(step.get("tool_calls", [])):
+        args = json.dumps(call["arguments"], ensure_ascii=False)
+        yield _chunk({"tool_calls": [{"index": index, "id": f"call_{index}_{random.getrandbits(32):x}", "type": "function",
+                                      "function": {"name": call["name"], "arguments": ""}}]})
+        # 参数分成两片，模拟真实的增量拼接
+        half = len(args) // 2
+        for piece in (args[:half], args[half:]):
+            yield _chunk({"tool_calls": [{"index": index, "function": {"arguments": piece}}]})
+    yield _chunk({}, "tool_calls" if step.get("tool_calls") else "stop")
+
+def _completion(step):
+    return {"id": "bench", "object": "chat.completion", "created": int(time.time()), "model": "deepseek-chat",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": step.get("content") or ""}}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}}
+
+class FakeLLM(_Server):
+    """
+    script(turn_id) -> [step, ...]；step 是 {"tool_calls": [{"name", "arguments"}]} 或 {"content": "..."}
+    第几步 = 最后一条 user 消息之后已经有几条 assistant 消息
+    turn_id 从最后一条 user 消息里的 "#<n>" 解析，保证每轮参数不同 (不会命中缓存)
+    """
+
+    def __init__(self, script, latency=None, scale=1.0, preference_reply='["🍱 美食 (Foodie)"]'):
+        super().__init__(_LLMHandler)
+        self.script = script
+        self.latency = {**DEFAULT_LLM_LATENCY, **(latency or {})}
+        self.scale = scale
+        self.preference_reply = preference_reply
+
+    def script_step(self, messages):
+        last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=0)
+        done = sum(1 for m in messages[last_user:] if m.get("role") == "assistant")
+        text = (messages[last_user].get("content") or "") if messages else ""
+        turn_id = text.rsplit("#", 1)[-1].strip() if "#" in text else "0"
+        steps = self.script(turn_id)
+        return steps[min(done, len(steps) - 1)]
@@ -0,0 +1,323 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import config
+import tracing
+
+# ==========================================
+# 🟢 本地持久化缓存 (进程内所有 Streamlit 会话共享)
+# ==========================================
+
+def normalize_key(text):
+    """
+    统一地点字符串: 全角转半角、小写、合并空白
+    "  Petronas Twin Towers,  Kuala Lumpur " -> "petronas twin towers, kuala lumpur"
+    """
+    text = unicodedata.normalize("NFKC", str(text or ""))
+    return " ".join(text.lower().split())
+
+def _open_sqlite(path):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+# ==========================================
+# 1. 地理编码缓存 (get_coordinates 专用)
+# ==========================================
+class GeocodeCache:
+    """
+    location -> (lat, lng, title) 的 SQLite 持久化缓存
+    - 命中: 有效期 ttl 秒
+    - 查不到的地点做短期负缓存 (negative_ttl)，避免反复浪费额度
+    - 超过 max_entries 时按最近访问时间 (LRU) 淘汰
+    """
+
+    def __init__(self, path, ttl, negative_ttl, max_entries):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = _open_sqlite(path)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS geocode (
+                key TEXT PRIMARY KEY,
+                lat REAL,
+                lng REAL,
+                title TEXT,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_geocode_accessed ON geocode (accessed_at)")
+        self._size = self._conn.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+
+    def get(self, location):
+        """
+        返回 None 表示没有缓存；否则返回 (lat, lng, title)
+        负缓存条目的 lat/lng 为 None
+        """
+        key = normalize_key(location)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT lat, lng, title, created_at FROM geocode WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            lat, lng, title, created_at = row
+            ttl = self.ttl if lat is not None else self.negative_ttl
+            if now - created_at > ttl:
+                self._conn.execute("DELETE FROM geocode WHERE key = ?", (key,))
+                self._size -= 1
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE geocode SET accessed_at = ? WHERE key = ?", (now, key))
+            if lat is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return lat, lng, title or location
+
+    def put(self, location, lat, lng, title):
+        self._store(location, lat, lng, title)
+
+    def put_negative(self, location):
+        self._store(location, None, None, None)
+
+    def _store(self, location, lat, lng, title):
+        key = normalize_key(location)
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute("SELECT 1 FROM geocode WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO geocode (key, lat, lng, title, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, lat, lng, title, now, now),
+            )
+            if cur is None:
+                self._size += 1
+            if self._size > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        # 一次多删 10%，避免每次插入都触发淘汰
+        overflow = self._size - int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM geocode WHERE key IN (SELECT key FROM geocode ORDER BY accessed_at ASC LIMIT ?)",
+            (overflow,),
+        )
+        self._size = self._conn.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+
+    def stats(self):
+        total = self.hits + self.negative_hits + self.misses
+        return {
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.negative_hits) / total if total else 0.0,
+            "size": self._size,
+        }
+
+# 进程级单例
+geocode_cache = GeocodeCache(
+    config.GEOCODE_CACHE_PATH,
+    ttl=config.GEOCODE_CACHE_TTL,
+    negative_ttl=config.GEOCODE_NEGATIVE_TTL,
+    max_entries=config.GEOCODE_CACHE_MAX_ENTRIES,
+)
+
+# ==========================================
+# 2. SerpAPI 响应缓存 (内存 LRU + SQLite 两级)
+# ==========================================
+def params_key(params):
+    """
+    去掉 api_key 后规范化参数，生成稳定的缓存 key
+    """
+    canonical = {k: str(v) for k, v in params.items() if k != "api_key" and v is not None}
+    raw = json.dumps(canonical, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    GoogleSearch(params).get_dict() 的结果缓存
+    - 一级: 进程内 OrderedDict LRU，命中只需微秒级
+    - 二级: SQLite 磁盘缓存，重启后依然有效
+    - 每个 engine 单独设置 TTL (ttl_by_engine)，未配置的 engine 用 default_ttl
+    """
+
+    def __init__(self, path, ttl_by_engine, default_ttl, memory_entries, disk_entries):
+        self.ttl_by_engine = ttl_by_engine
+        self.default_ttl = default_ttl
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()  # key -> (expires_at, result)
+        self._lock = threading.Lock()
+        self._conn = _open_sqlite(path)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                engine TEXT,
+                payload TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at)")
+        self._size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def ttl_for(self, engine):
+        return self.ttl_by_engine.get(engine, self.default_ttl)
+
+    def get(self, key):
+        cached = self.get_memory(key)
+        return cached if cached is not None else self.get_disk(key)
+
+    def get_memory(self, key):
+        """
+        只查内存 LRU (不碰 SQLite，可以直接在事件循环里调用)；没命中不计入 misses
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[1]
+                del self._memory[key]
+        return None
+
+    def get_disk(self, key):
+        """
+        查 SQLite，命中后放进内存 LRU (异步代码里请用 asyncio.to_thread 调用)
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT payload, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._size -= 1
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            result = json.loads(row[0])
+            self._remember(key, row[1], result)
+            self.disk_hits += 1
+            return result
+
+    def peek_many(self, keys):
+        """
+        批量只读查看 (不计入命中统计、不更新 LRU)，返回 {key: result}
+        给路线优化之类的"有就用"场景，磁盘层只查一次
+        """
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._memory.get(key)
+                if entry is not None and entry[0] > now:
+                    found[key] = entry[1]
+            rest = [key for key in keys if key not in found]
+            for start in range(0, len(rest), 500):  # SQLite 参数个数有上限
+                chunk = rest[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, payload FROM responses WHERE key IN ({marks}) AND expires_at > ?", (*chunk, now)
+                ).fetchall()
+                for key, payload in rows:
+                    found[key] = json.loads(payload)
+        return found
+
+    def put(self, key, engine, result):
+        self.put_memory(key, engine, result)
+        self.put_disk(key, engine, result)
+
+    def put_memory(self, key, engine, result):
+        with self._lock:
+            self._remember(key, time.time() + self.ttl_for(engine), result)
+
+    def put_disk(self, key, engine, result):
+        # 异步代码里请用 asyncio.to_thread 调用
+        now = time.time()
+        expires_at = now + self.ttl_for(engine)
+        payload = json.dumps(result, ensure_ascii=False)
+        with self._lock:
+            cur = self._conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, engine, payload, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, engine, payload, expires_at, now),
+            )
+            if cur is None:
+                self._size += 1
+            if self._size > self.disk_entries:
+                self._evict(now)
+
+    def _remember(self, key, expires_at, result):
+        self._memory[key] = (expires_at, result)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now):
+        # 先清过期，再按最近访问时间淘汰到 90%
+        self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        self._size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        overflow = self._size - int(self.disk_entries * 0.9)
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at ASC LIMIT ?)",
+                (overflow,),
+            )
+            self._size -= overflow
+
+    def stats(self):
+        total = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / total if total else 0.0,
+            "memory_size": len(self._memory),
+            "disk_size": self._size,
+        }
+
+# 进程级单例
+response_cache = ResponseCache(
+    config.SERP_CACHE_PATH,
+    ttl_by_engine=config.SERP_CACHE_TTL_BY_ENGINE,
+    default_ttl=config.SERP_CACHE_DEFAULT_TTL,
+    memory_entries=config.SERP_CACHE_MEMORY_ENTRIES,
+    disk_entries=config.SERP_CACHE_DISK_ENTRIES,
+)
+
+def _cache_gauges():
+    # 🟢 命中 / 未命中计数导出到 /metrics (见 tracing.register_gauges)
+    geo, resp = geocode_cache.stats(), response_cache.stats()
+    return [
+        ("agent_geocode_cache_requests", {"status": "hit"}, geo["hits"]),
+        ("agent_geocode_cache_requests", {"status": "negative_hit"}, geo["negative_hits"]),
+        ("agent_geocode_cache_requests", {"status": "miss"}, geo["misses"]),
+        ("agent_geocode_cache_entries", {}, geo["size"]),
+        ("agent_serp_cache_requests", {"status": "memory_hit"}, resp["memory_hits"]),
+        ("agent_serp_cache_requests", {"status": "disk_hit"}, resp["disk_hits"]),
+        ("agent_serp_cache_requests", {"status": "miss"}, resp["misses"]),
+        ("agent_serp_cache_entries", {"tier": "memory"}, resp["memory_size"]),
+        ("agent_serp_cache_entries", {"tier": "disk"}, resp["disk_size"]),
+    ]
+
+tracing.register_gauges(_cache_gauges)
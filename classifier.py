@@ -0,0 +1,110 @@
+import re
+
+import config
+
+# ==========================================
+# 🟢 本地偏好标签分类器 (LLM 之前的快速通道)
+# ==========================================
+# 大部分偏好信号都是明显的关键词 ("kids" / "便宜" / "makan" / "shopping mall")，
+# 用一个预编译的正则一次扫完所有词表 (英文 / 中文 / 马来文)，
+# 每个关键词带权重，同一标签的多个关键词按 1 - Π(1 - w) 累加成置信度
+
+VALID_TAGS = ["🍱 美食 (Foodie)", "💆‍♂️ 放松 (Relax)", "🌲 大自然 (Nature)",
+              "🛍️ 购物 (Shopping)", "🏛️ 历史 (History)", "🎒 穷游 (Budget)",
+              "💎 奢华 (Luxury)", "👨‍👩‍👧‍👦 亲子 (Family)", "📸 拍照打卡 (Insta-worthy)"]
+
+STRONG, MEDIUM, WEAK = 0.9, 0.6, 0.3
+
+# 标签 -> {权重: [关键词, ...]}
+LEXICON = {
+    "🍱 美食 (Foodie)": {
+        STRONG: ["foodie", "food tour", "cheap food", "cheap eats", "street food", "local food", "must-eat", "美食", "小吃", "好吃的", "makanan", "kedai makan", "gerai makan"],
+        MEDIUM: ["food", "fine dining", "cuisine", "hawker", "restaurant", "restaurants", "delicious", "餐厅", "好吃", "吃什么", "makan", "sedap"],
+        WEAK: ["eat", "dinner", "lunch", "breakfast", "cafe", "吃", "晚餐", "午餐"],
+    },
+    "💆‍♂️ 放松 (Relax)": {
+        STRONG: ["relax", "relaxing", "spa", "massage", "slow pace", "放松", "按摩", "温泉", "慢节奏", "santai", "urut"],
+        MEDIUM: ["chill", "resort", "unwind", "休闲", "度假", "躺平", "rehat", "bercuti"],
+        WEAK: ["beach", "pool", "海边", "pantai"],
+    },
+    "🌲 大自然 (Nature)": {
+        STRONG: ["nature", "hiking", "hike", "trekking", "national park", "waterfall", "rainforest", "大自然", "徒步", "爬山", "国家公园", "瀑布", "alam semula jadi", "air terjun", "mendaki"],
+        MEDIUM: ["forest", "jungle", "mountain", "island", "wildlife", "森林", "雨林", "自然", "hutan", "gunung"],
+        WEAK: ["park", "outdoor", "公园", "户外", "taman"],
+    },
+    "🛍️ 购物 (Shopping)": {
+        STRONG: ["shopping", "shopping mall", "outlet", "duty free", "购物", "买买买", "逛街", "免税", "membeli-belah", "beli-belah"],
+        MEDIUM: ["mall", "souvenir", "souvenirs", "boutique", "商场", "纪念品", "奥特莱斯", "pusat beli-belah", "cenderahati"],
+        WEAK: ["market", "buy", "市场", "pasar"],
+    },
+    "🏛️ 历史 (History)": {
+        STRONG: ["history", "historical", "heritage", "museum", "museums", "unesco", "历史", "博物馆", "古迹", "文化遗产", "sejarah", "muzium", "warisan"],
+        MEDIUM: ["temple", "mosque", "colonial", "old town", "palace", "寺庙", "古城", "老街", "masjid", "kuil", "istana"],
+        WEAK: ["culture", "cultural", "文化", "budaya"],
+    },
+    "🎒 穷游 (Budget)": {
+        STRONG: ["cheap", "cheap food", "cheap eats", "budget", "backpacker", "backpacking", "hostel", "low cost", "save money", "便宜", "穷游", "省钱", "预算有限", "青旅", "murah", "bajet", "jimat"],
+        MEDIUM: ["affordable", "free entry", "inexpensive", "性价比", "划算", "平价", "berpatutan"],
+        WEAK: ["deal", "discount", "优惠", "折扣", "diskaun"],
+    },
+    "💎 奢华 (Luxury)": {
+        STRONG: ["luxury", "luxurious", "5-star", "five star", "five-star", "michelin", "first class", "private villa", "奢华", "豪华", "五星", "米其林", "头等舱", "mewah"],
+        MEDIUM: ["fine dining", "business class", "high-end", "premium", "suite", "高端", "商务舱", "套房", "eksklusif"],
+        WEAK: ["exclusive", "upscale", "高级"],
+    },
+    "👨‍👩‍👧‍👦 亲子 (Family)": {
+        STRONG: ["kids", "kid", "children", "child", "toddler", "family trip", "with my son", "with my daughter", "孩子", "小孩", "亲子", "儿童", "宝宝", "带娃", "anak-anak", "kanak-kanak"],
+        MEDIUM: ["family", "baby", "theme park", "family-friendly", "一家人", "家庭", "游乐园", "keluarga", "budak"],
+        WEAK: ["zoo", "aquarium", "动物园", "水族馆", "anak"],
+    },
+    "📸 拍照打卡 (Insta-worthy)": {
+        STRONG: ["instagram", "instagrammable", "insta-worthy", "photo spot", "photo spots", "photogenic", "拍照", "打卡", "出片", "网红", "tempat bergambar"],
+        MEDIUM: ["selfie", "photos", "viewpoint", "scenic", "拍照点", "观景台", "美照", "gambar cantik"],
+        WEAK: ["view", "sunset", "日落", "风景"],
+    },
+}
+
+# 🟢 多个标签共用一个关键词也可以 ("cheap food" -> 穷游 + 美食): keyword -> [(tag, weight), ...]
+KEYWORD_INDEX = {}
+for _tag, _tiers in LEXICON.items():
+    for _weight, _words in _tiers.items():
+        for _word in _words:
+            KEYWORD_INDEX.setdefault(_word.lower(), []).append((_tag, _weight))
+
+def _compile(words):
+    # 长词优先 ("shopping mall" 先于 "shopping")；拉丁字母词要求前后不是字母数字
+    # (不用 \b: "我想去shopping" 里中文也算 \w，会匹配不上)，中文不加边界
+    words = sorted(words, key=len, reverse=True)
+    latin = [re.escape(w) for w in words if w.isascii()]
+    cjk = [re.escape(w) for w in words if not w.isascii()]
+    parts = []
+    if latin: parts.append(r"(?<![a-z0-9])(?:" + "|".join(latin) + r")(?![a-z0-9])")
+    if cjk: parts.append("|".join(cjk))
+    return re.compile("|".join(parts), re.IGNORECASE)
+
+KEYWORD_RE = _compile(KEYWORD_INDEX)
+
+def score_text(text):
+    """
+    返回 {tag: 置信度 0~1}，同一关键词出现多次只算一次
+    """
+    found = {m.group(0).lower() for m in KEYWORD_RE.finditer(text or "")}
+    misses = {}
+    for word in found:
+        for tag, weight in KEYWORD_INDEX[word]:
+            misses[tag] = misses.get(tag, 1.0) * (1 - weight)
+    return {tag: 1 - miss for tag, miss in misses.items()}
+
+def classify(text, accept=None):
+    """
+    返回 (确定的标签列表, 整体置信度, 各标签分数)
+    - 分数 >= accept 的标签直接采用
+    - 整体置信度 = 没被采用的标签里 1 - s 的最小值 (有多确定它们确实不是用户偏好)；
+      一个标签都没采用时为 0.0: 没有关键词不代表没有偏好 ("带 5 岁儿子找个安静的地方")，要交给 LLM
+    """
+    accept = config.PREF_LOCAL_ACCEPT if accept is None else accept
+    scores = score_text(text)
+    tags = [tag for tag in VALID_TAGS if scores.get(tag, 0) >= accept]
+    if not tags: return tags, 0.0, scores
+    confidence = min((1 - s for s in scores.values() if s < accept), default=1.0)
+    return tags, confidence, scores
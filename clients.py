@@ -0,0 +1,237 @@
+import asyncio
+import contextvars
+import random
+import threading
+
+import streamlit as st
+
+import config
+import quota
+import tracing
+
+# ==========================================
+# 🟢 进程级共享客户端 (所有会话 / 所有 rerun 共用)
+# ==========================================
+# st.cache_resource 保证每个进程只建一次，连接池和 TLS 会话得以复用
+# 🟢 openai / httpx 导入很慢 (~0.9s)，放到第一次用到时再导入，登录页不用等
+
+SERPAPI_ENDPOINT = "https://serpapi.com/search"
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+@st.cache_resource(show_spinner=False)
+def get_llm_client():
+    """
+    DeepSeek (OpenAI 兼容) 客户端
+    SDK 自带 keep-alive 连接池，并对 429/5xx 做指数退避 + 抖动重试
+    """
+    from openai import OpenAI
+    return OpenAI(
+        api_key=config.DEEPSEEK_API_KEY,
+        base_url=config.LLM_BASE_URL,
+        timeout=config.LLM_TIMEOUT,
+        max_retries=config.LLM_MAX_RETRIES,
+    )
+
+# ==========================================
+# 🟢 共享事件循环 + 异步 HTTP 连接池 (tools 的 async 版本都跑在这里)
+# ==========================================
+class AsyncRuntime:
+    """
+    一个后台线程跑 asyncio 事件循环，所有会话共用:
+    - httpx.AsyncClient: keep-alive 连接池
+    - semaphore: 进程级 SerpAPI 并发上限 (config.SERPAPI_MAX_CONCURRENCY)
+    - quota: 令牌桶 + 优先级调度 (config.SERPAPI_RATE_PER_SEC 为 None 时不限速)
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="async_io_loop", daemon=True)
+        self.thread.start()
+        self.http = self.run(self._create_http_client())
+        self.semaphore = asyncio.Semaphore(config.SERPAPI_MAX_CONCURRENCY)
+        self.in_flight = 0
+        self.quota = None
+        if config.SERPAPI_RATE_PER_SEC:
+            self.quota = quota.QuotaScheduler(config.SERPAPI_RATE_PER_SEC, config.SERPAPI_BURST, config.SERPAPI_MAX_WAIT_BY_PRIORITY)
+
+    async def _create_http_client(self):
+        import httpx
+        return httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=config.HTTP_POOL_SIZE, max_keepalive_connections=config.HTTP_POOL_SIZE),
+            timeout=httpx.Timeout(config.SERPAPI_READ_TIMEOUT, connect=config.SERPAPI_CONNECT_TIMEOUT),
+        )
+
+    def run(self, coro):
+        """
+        在共享事件循环上执行协程，阻塞等待结果 (给同步代码用，不能在事件循环线程里调用)
+        """
+        return self.submit(coro).result()
+
+    def submit(self, coro):
+        """
+        不阻塞: 提交到共享事件循环，返回 concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+def get_async_runtime():
+    # 工作线程和事件循环线程都会用到，所以不用 st.cache_resource，而是普通的进程级单例
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = AsyncRuntime()
+    return _runtime
+
+# 🟢 [新增] 当前用户 (额度调度按用户公平排队)；app.py 每次运行时设置，run_async / submit_async 会带进事件循环
+_current_user = contextvars.ContextVar("serp_user", default=None)
+
+def set_current_user(user):
+    _current_user.set(user)
+
+async def _run_as_user(user, coro):
+    token = _current_user.set(user)
+    try:
+        return await coro
+    finally:
+        _current_user.reset(token)
+
+def _with_caller_context(coro):
+    # 🟢 当前 trace / 当前用户跟着协程一起进事件循环线程
+    trace = tracing.current_trace()
+    if trace is not None:
+        coro = tracing.run_in_trace(trace, coro)
+    user = _current_user.get()
+    if user is not None:
+        coro = _run_as_user(user, coro)
+    return coro
+
+def run_async(coro):
+    return get_async_runtime().run(_with_caller_context(coro))
+
+def submit_async(coro):
+    """
+    不阻塞地提交协程，返回 concurrent.futures.Future (并行执行工具用，见 tools.ToolDispatch)
+    """
+    return get_async_runtime().submit(_with_caller_context(coro))
+
+def _retry_delay(attempt, response=None):
+    # 优先遵守 Retry-After，否则指数退避 + 随机抖动
+    if response is not None:
+        try:
+            return float(response.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            pass
+    return config.SERPAPI_BACKOFF * (2 ** attempt) + random.uniform(0, config.SERPAPI_BACKOFF)
+
+def priority_of(params):
+    return config.SERPAPI_PRIORITY_BY_ENGINE.get(params.get("engine"), config.SERPAPI_DEFAULT_PRIORITY)
+
+async def serpapi_get_async(params, priority=None):
+    """
+    SerpAPI 请求 (异步): 复用连接池，受全局并发上限控制，429/5xx 指数退避重试
+    与 GoogleSearch 一样: 即使 HTTP 出错也返回 SerpAPI 的 JSON (里面带 "error")
+    每次尝试 (包括重试) 先从额度调度器拿令牌；低优先级排队太久会抛 quota.Shed
+    """
+    import httpx
+    runtime = get_async_runtime()
+    query = dict(params, output="json", source="python")
+    priority = priority_of(params) if priority is None else priority
+    with tracing.span("serpapi.http", engine=params.get("engine"), priority=quota.PRIORITY_NAMES[priority]) as sp:
+        queue_ms = 0.0
+        for attempt in range(config.SERPAPI_MAX_RETRIES + 1):
+            last_try = attempt == config.SERPAPI_MAX_RETRIES
+            response = None
+            sp.set(attempts=attempt + 1)
+            if runtime.quota is not None:
+                try:
+                    queue_ms += await runtime.quota.acquire(priority, _current_user.get())
+                except quota.Shed:
+                    sp.set(status="shed", queue_ms=round(queue_ms, 1))
+                    raise
+                sp.set(queue_ms=round(queue_ms, 1))
+            try:
+                async with runtime.semaphore:
+                    runtime.in_flight += 1
+                    try:
+                        response = await runtime.http.get(SERPAPI_ENDPOINT, params=query)
+                    finally:
+                        runtime.in_flight -= 1
+            except httpx.TransportError:
+                if last_try: raise
+            else:
+                if response.status_code not in RETRY_STATUS or last_try:
+                    sp.set(status=response.status_code, bytes=len(response.content))
+                    return response.json()
+            # 退避期间不占用并发名额；429 说明额度真的用完了，整个令牌桶一起暂停
+            delay = _retry_delay(attempt, response)
+            if response is not None and response.status_code == 429 and runtime.quota is not None:
+                runtime.quota.pause(delay)
+            await asyncio.sleep(delay)
+
+def serpapi_get(params):
+    return run_async(serpapi_get_async(params))
+
+def quota_stats():
+    """
+    排队深度 / 等待时间 / 被丢弃的请求数 (按优先级)，没有启动事件循环或不限速时返回 None
+    """
+    if _runtime is None or _runtime.quota is None: return None
+    return _runtime.run(_quota_stats_async())
+
+async def _quota_stats_async():
+    return _runtime.quota.stats()
+
+def _quota_gauges():
+    stats = quota_stats()
+    if stats is None: return []
+    gauges = [("agent_serpapi_tokens", {}, stats["tokens"])]
+    for name, depth in stats["queue_depth"].items():
+        gauges.append(("agent_serpapi_queue_depth", {"priority": name}, depth))
+    for name, s in stats["by_priority"].items():
+        gauges.append(("agent_serpapi_granted", {"priority": name}, s["granted"]))
+        gauges.append(("agent_serpapi_queue_wait_seconds_sum", {"priority": name}, s["wait_ms_total"] / 1000))
+        gauges.append(("agent_serpapi_shed", {"priority": name}, s["shed"]))
+    return gauges
+
+tracing.register_gauges(_quota_gauges)
+
+# ==========================================
+# 🟢 [新增] Single-flight: 相同 key 的并发请求只发一次
+# ==========================================
+class SingleFlight:
+    """
+    同一个 key 同时只有一个请求在飞，后来的调用者直接等它的结果 (成功 / 异常都共享)
+    只在共享事件循环上使用，字典只在事件循环线程里读写，所以不用加锁
+    请求本身是一个独立的 Task，某个调用者被取消不会影响其他等待者
+    """
+
+    def __init__(self):
+        self.in_flight = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key, factory):
+        """
+        返回 (结果, 是否搭了别人的车)
+        """
+        task = self.in_flight.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(factory())
+            self.in_flight[key] = task
+            self.leaders += 1
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task), shared
+
+    def _done(self, key, task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        # 所有等待者都被取消时，避免 "exception was never retrieved" 警告
+        if not task.cancelled(): task.exception()
+
+    def stats(self):
+        return {"requests": self.leaders, "coalesced": self.coalesced, "in_flight": len(self.in_flight)}
@@ -8,6 +8,18 @@ import streamlit as st
 DEEPSEEK_API_KEY = "YOUR_KEY_HERE" 
 SERPAPI_API_KEY = "YOUR_KEY_HERE"
 
+# 🟢 [新增] 共享客户端: 超时 / 重试 / 连接池
+LLM_BASE_URL = "https://api.deepseek.com"
+LLM_TIMEOUT = 120              # 秒 (长行程生成比较慢)
+LLM_MAX_RETRIES = 3            # 429/5xx 指数退避重试次数
+SERPAPI_CONNECT_TIMEOUT = 5
+SERPAPI_READ_TIMEOUT = 30
+SERPAPI_MAX_RETRIES = 3
+SERPAPI_BACKOFF = 0.5          # 退避基数 (秒): 0.5, 1, 2 ... 再加随机抖动
+HTTP_POOL_SIZE = 32            # keep-alive 连接池大小
+SERPAPI_MAX_CONCURRENCY = 8    # 进程级同时在途的 SerpAPI 请求上限 (所有会话共享)
+SERPAPI_SINGLE_FLIGHT = True   # 参数完全相同的在途请求合并成一次 (所有会话共享结果)
+
 # ==========================================
 # 2. 定义系统核心指令 (System Prompt)
 # ==========================================
@@ -56,4 +68,108 @@ Before answering or calling tools, you must **THINK** in steps.
 3. The tools will return images in Markdown format `![...](...)` along with a "[SYSTEM NOTE]".
 4. You **MUST** include these images in your final Day-by-Day plan.
 5. An itinerary WITHOUT images is **UNACCEPTABLE**.
-"""
\ No newline at end of file
+"""
+
+# ==========================================
+# 3. 本地缓存配置
+# ==========================================
+CACHE_DIR = ".cache"
+
+# 地理编码缓存 (get_coordinates)
+GEOCODE_CACHE_PATH = f"{CACHE_DIR}/geocode.sqlite"
+GEOCODE_CACHE_TTL = 30 * 24 * 3600      # 地点坐标基本不变，保留 30 天
+GEOCODE_NEGATIVE_TTL = 3600             # 查不到的地点只负缓存 1 小时
+GEOCODE_CACHE_MAX_ENTRIES = 50000
+
+# SerpAPI 响应缓存 (所有 GoogleSearch 调用)
+SERP_CACHE_PATH = f"{CACHE_DIR}/serpapi.sqlite"
+SERP_CACHE_TTL_BY_ENGINE = {
+    "google_flights": 15 * 60,              # 机票价格变化快: 15 分钟
+    "google_hotels": 30 * 60,               # 酒店房价: 30 分钟
+    "google_maps": 3 * 24 * 3600,           # 景点/餐厅 POI: 3 天
+    "google_maps_directions": 30 * 60,      # 路况相关: 30 分钟
+    "google_images": 7 * 24 * 3600,
+    "google": 24 * 3600,
+}
+SERP_CACHE_DEFAULT_TTL = 3600
+SERP_CACHE_MEMORY_ENTRIES = 512
+SERP_CACHE_DISK_ENTRIES = 20000
+
+# ==========================================
+# 4. 聊天记录加载
+# ==========================================
+HISTORY_PAGE_SIZE = 20          # 侧边栏每页加载多少条历史索引
+HISTORY_BODY_CACHE_SIZE = 5     # 每个会话最多在内存里保留几份历史对话正文
+
+# ==========================================
+# 5. LLM 上下文预算
+# ==========================================
+CONTEXT_TOKEN_BUDGET = 16000       # 每次请求的 messages 估算 token 上限
+CONTEXT_KEEP_RECENT_TURNS = 2      # 最近几个 user 回合原样保留
+CONTEXT_DIGEST_CHARS = 400         # 旧工具输出压缩后的最大长度
+
+# ==========================================
+# 6. 路线查询: 按直线距离裁剪出行方式
+# ==========================================
+# mode_code -> (最小 km, 最大 km)，None 表示不限；不在范围内的方式不发请求
+# 🚗 "0" 驾车 / 🚇 "3" 公交 / 🚶 "2" 步行
+TRAVEL_MODE_POLICY = {
+    "0": (0.3, None),    # 几百米内开车没意义
+    "3": (0.8, None),    # 太近坐公交不划算
+    "2": (None, 5.0),    # 超过 5 km 不考虑步行
+}
+TRAVEL_MODE_FALLBACK = "0"   # 所有方式都被裁掉时至少保留这一种
+
+# ==========================================
+# 7. 偏好标签: 本地分类器优先
+# ==========================================
+PREF_LOCAL_ACCEPT = 0.8        # 本地分数 >= 这个值的标签直接采用
+PREF_LOCAL_CONFIDENCE = 0.65   # 至少有一个标签 >= PREF_LOCAL_ACCEPT，且其余标签都 <= 0.35 (没有"拿不准"的) 才跳过 LLM
+
+# ==========================================
+# 8. 性能追踪
+# ==========================================
+TRACE_LOG_PATH = None                         # 例如 f"{CACHE_DIR}/trace.jsonl": 每个 span 一行 JSON (默认关闭)
+TRACE_LOG_MAX_BYTES = 50 * 1024 * 1024        # 超过就把旧文件改名为 .1 (只保留一份) 重新开始写
+METRICS_PORT = None                           # 例如 9464: 在 http://127.0.0.1:9464/metrics 暴露 Prometheus 指标
+SHOW_PERFORMANCE_PANEL = True                 # 页面底部显示本轮的 "⏱️ Performance" 明细
+
+# ==========================================
+# 9. 聊天记录渲染
+# ==========================================
+TRANSCRIPT_WINDOW = 20   # 主界面只渲染最近多少条消息；"Load earlier" 每次再多显示这么多条
+
+# ==========================================
+# 10. SerpAPI 额度调度 (令牌桶 + 优先级，见 quota.py)
+# ==========================================
+SERPAPI_RATE_PER_SEC = 2.0     # 令牌补充速度，按套餐额度换算；None 表示不限速
+SERPAPI_BURST = 20             # 桶容量: 允许的瞬时突发
+# engine -> 优先级 (0 最高): 机票 / 酒店 > 景点 / 网页搜索 > 路线 > 图片
+SERPAPI_PRIORITY_BY_ENGINE = {"google_flights": 0, "google_hotels": 0, "google_maps": 1, "google": 1,
+                              "google_maps_directions": 2, "google_images": 3}
+SERPAPI_DEFAULT_PRIORITY = 1
+# 排队超过这么多秒就放弃 (调用方降级: 不显示图片 / 跳过公交步行时间)；None 表示一直等
+SERPAPI_MAX_WAIT_BY_PRIORITY = {0: None, 1: 30, 2: 5, 3: 1}
+
+# ==========================================
+# 11. 机票价格日历 (search_flights 的 flex_days)
+# ==========================================
+FLIGHT_FLEX_MAX_DAYS = 7       # 最多查出发日前后各几天 (±7 天 = 15 次并发查询)
+
+# ==========================================
+# 12. 本地 POI 索引 (见 poi.py)
+# ==========================================
+POI_INDEX_ENABLED = True
+POI_INDEX_PATH = f"{CACHE_DIR}/poi.sqlite"
+POI_CELL_DEG = 0.01                 # 空间网格边长 (度)，约 1.1 km
+POI_FRESH_TTL = 14 * 24 * 3600      # 14 天内拉过 / 见过的地点算新鲜，可以直接回答
+POI_MAX_AGE = 180 * 24 * 3600       # 半年没再见到的地点清理掉
+POI_MIN_LOCAL_RESULTS = 5           # 没拉过同一查询时，本地至少有这么多新鲜匹配才不查 SerpAPI
+POI_NEARBY_RADIUS_KM = 2.0          # "附近" 默认半径
+
+# ==========================================
+# 13. 聊天记录搜索 (见 search.py)
+# ==========================================
+SEARCH_MAX_TERMS = 3000        # 每个 chat 最多存多少个不同的词 (按词频取前 N 个)
+SEARCH_MAX_DELTAS = 20         # 追加消息的词频增量 (search_tf_delta) 攒到多少条就合并回 search_tf
+SEARCH_RESULT_LIMIT = 8        # 侧边栏最多显示几条搜索结果
@@ -0,0 +1,113 @@
+import re
+
+import config
+
+# ==========================================
+# 🟢 上下文压缩: 控制每次发给 LLM 的 token 数
+# ==========================================
+# st.session_state["messages"] 本身保持完整 (界面/历史记录要用)，
+# 这里只生成一份压缩过的副本用于 chat.completions.create
+
+IMAGE_RE = re.compile(r"!\[[^\]]*\]\([^)]*\)")
+CJK_RE = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]")
+MESSAGE_OVERHEAD = 4  # 每条消息的 role/分隔符开销
+DIGEST_PREFIX = "[digest] "
+
+def count_text_tokens(text):
+    """
+    粗略估算 token 数 (不依赖 tokenizer):
+    中日韩字符约 1 token/字，其余约 4 字符/token
+    """
+    if not text: return 0
+    cjk = len(CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def _as_dict(msg):
+    if isinstance(msg, dict): return msg
+    if hasattr(msg, "model_dump"): return msg.model_dump(exclude_none=True)
+    return {"role": getattr(msg, "role", "assistant"), "content": getattr(msg, "content", "")}
+
+def count_message_tokens(msg):
+    msg = _as_dict(msg)
+    tokens = MESSAGE_OVERHEAD + count_text_tokens(msg.get("content") or "")
+    for call in msg.get("tool_calls") or []:
+        fn = call.get("function", {})
+        tokens += count_text_tokens(fn.get("name", "")) + count_text_tokens(fn.get("arguments", ""))
+    return tokens
+
+def digest_text(text, limit):
+    """
+    把工具输出/长回复压成一行摘要: 去掉图片和分割线，只留标题和要点
+    """
+    if not text or text.startswith(DIGEST_PREFIX): return text
+    text = IMAGE_RE.sub("", text)
+    lines = [line.strip() for line in text.splitlines()]
+    lines = [line.lstrip("#- ").replace("**", "") for line in lines if line and line != "---"]
+    digest = "; ".join(lines)
+    if len(digest) > limit:
+        digest = digest[:limit] + f" …(+{len(digest) - limit} chars)"
+    return DIGEST_PREFIX + digest
+
+def _recent_start(messages, keep_recent_turns):
+    """
+    找到最近 N 个 user 回合的起点，之后的消息原样保留
+    """
+    seen = 0
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i].get("role") == "user":
+            seen += 1
+            if seen >= keep_recent_turns:
+                return i
+    return 1 if messages and messages[0].get("role") == "system" else 0
+
+def compact_messages(messages, budget=None, keep_recent_turns=None, digest_chars=None):
+    """
+    返回 (压缩后的 messages 副本, stats)
+    1. system prompt 和最近 keep_recent_turns 个回合原样保留
+    2. 更早的工具输出换成摘要
+    3. 还超预算: 更早的长回复也换成摘要
+    4. 还超预算: 从最早的回合开始整回合丢弃 (保证 tool_call 和 tool 结果成对)
+    """
+    budget = budget or config.CONTEXT_TOKEN_BUDGET
+    keep_recent_turns = keep_recent_turns or config.CONTEXT_KEEP_RECENT_TURNS
+    digest_chars = digest_chars or config.CONTEXT_DIGEST_CHARS
+
+    msgs = [dict(_as_dict(m)) for m in messages]
+    tokens = [count_message_tokens(m) for m in msgs]
+    before = sum(tokens)
+    stats = {"tokens_before": before, "tokens_after": before, "saved": 0, "digested": 0, "dropped": 0}
+    if before <= budget:
+        return msgs, stats
+
+    head = 1 if msgs and msgs[0].get("role") == "system" else 0
+    recent = max(_recent_start(msgs, keep_recent_turns), head)
+    total = before
+
+    # 2 + 3: 先压工具输出，再压 assistant 长回复
+    for roles in (("tool",), ("assistant",)):
+        for i in range(head, recent):
+            if total <= budget: break
+            if msgs[i].get("role") not in roles or not msgs[i].get("content"): continue
+            digest = digest_text(msgs[i]["content"], digest_chars)
+            if len(digest) >= len(msgs[i]["content"]): continue
+            msgs[i]["content"] = digest
+            new_tokens = count_message_tokens(msgs[i])
+            total -= tokens[i] - new_tokens
+            tokens[i] = new_tokens
+            stats["digested"] += 1
+
+    # 4: 整回合丢弃 (从 user 消息到下一个 user 消息之前)
+    drop_end = head
+    while total > budget and drop_end < recent:
+        turn_end = drop_end + 1
+        while turn_end < recent and msgs[turn_end].get("role") != "user":
+            turn_end += 1
+        total -= sum(tokens[drop_end:turn_end])
+        stats["dropped"] += turn_end - drop_end
+        drop_end = turn_end
+    if drop_end > head:
+        msgs = msgs[:head] + msgs[drop_end:]
+
+    stats["tokens_after"] = total
+    stats["saved"] = before - total
+    return msgs, stats
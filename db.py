@@ -1,16 +1,31 @@
-import firebase_admin
-from firebase_admin import credentials, firestore
+import hashlib
+import json
+import uuid
 import streamlit as st
 
+import config
+import search
+import tracing
+
 # 1. 连接 Firebase
-if not firebase_admin._apps:
-    try:
-        cred = credentials.Certificate("firebase_key.json") 
-        firebase_admin.initialize_app(cred)
-    except Exception as e:
-        st.error(f"🔥 Firebase 连接失败: {e}")
+# 🟢 [修改] 不在导入时连接: firebase_admin 导入 + 建 client 要 ~0.5s，
+# 改成第一次读写时才初始化，进程内只建一次 (st.cache_resource)
+@st.cache_resource(show_spinner=False)
+def get_db():
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    if not firebase_admin._apps:
+        try:
+            cred = credentials.Certificate("firebase_key.json") 
+            firebase_admin.initialize_app(cred)
+        except Exception as e:
+            st.error(f"🔥 Firebase 连接失败: {e}")
+    return firestore.client()
 
-db = firestore.client()
+def _firestore():
+    # SERVER_TIMESTAMP / ArrayUnion / DELETE_FIELD 这些常量也从这里拿 (同样延迟导入)
+    from firebase_admin import firestore
+    return firestore
 
 # ==========================================
 # 🟢 辅助工具：数据清洗
@@ -38,8 +53,9 @@ def serialize_messages(messages):
 # 🟢 用户管理
 # ==========================================
 
+@tracing.traced("firestore.write", op="create_user")
 def create_user(email, password, preferences):
-    users_ref = db.collection("users")
+    users_ref = get_db().collection("users")
     doc = users_ref.document(email).get()
     
     if doc.exists:
@@ -49,12 +65,13 @@ def create_user(email, password, preferences):
         "email": email,
         "password": password,
         "preferences": preferences,
-        "created_at": firestore.SERVER_TIMESTAMP
+        "created_at": _firestore().SERVER_TIMESTAMP
     })
     return True, "✅ 注册成功！已自动登录。"
 
+@tracing.traced("firestore.read", op="authenticate_user")
 def authenticate_user(email, password):
-    doc_ref = db.collection("users").document(email)
+    doc_ref = get_db().collection("users").document(email)
     doc = doc_ref.get()
     
     if not doc.exists:
@@ -66,8 +83,9 @@ def authenticate_user(email, password):
     else:
         return None, "❌ 密码错误，请重试。"
 
+@tracing.traced("firestore.write", op="update_preferences")
 def update_preferences(email, new_preferences):
-    db.collection("users").document(email).update({
+    get_db().collection("users").document(email).update({
         "preferences": new_preferences
     })
 
@@ -75,103 +93,367 @@ def update_preferences(email, new_preferences):
 # 🟢 核心升级：改用 Subcollection (子集合) 存储
 # ==========================================
 
-def save_chat_history(email, history):
+# 🟢 [新增] 增量同步: 每个 chat 有稳定的文档 ID，并在 chat 字典上记录上次保存的指纹
+# (这些 _sync_ 开头的字段只存在于内存，不会写进 Firestore)
+# pref_analyzed_upto 不算 meta: 由偏好分析 worker 推进并单独写 (见 save_pref_progress)，保存时只和 _sync_pref_upto 比较
+META_FIELDS = ("title", "itinerary_content", "route_spec", "map_html", "traffic_data")
+BODY_FIELDS = ("messages", "itinerary_content", "route_spec", "map_html", "traffic_data", "pref_analyzed_upto")
+INDEX_FIELDS = ["title", "order_index", "updated_at"]
+_legacy_cleanup_pending = set()  # 从旧格式迁移过来、还需要删除 chat_history 字段的用户
+
+def _content_hash(obj):
+    raw = json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def _msgs_hash(clean_msgs):
+    # system 消息不算: app.py 每次运行都会用当天日期 + 侧边栏设置重写 messages[0]，
+    # 算进去的话每个打开过的 chat 都是"有改动"，既不能释放正文，也会让追加变成整段重写
+    return _content_hash([m for m in clean_msgs if m.get("role") != "system"])
+
+def _meta_of(chat):
+    return {field: chat.get(field) for field in META_FIELDS}
+
+def _mark_synced(chat, clean_msgs, order_index):
+    chat["_sync_meta_hash"] = _content_hash(_meta_of(chat))
+    chat["_sync_msg_count"] = len(clean_msgs)
+    chat["_sync_msgs_hash"] = _msgs_hash(clean_msgs)
+    chat["_sync_order"] = order_index
+
+def _payload_bytes(obj):
+    # 只用于 trace 里的 "bytes" 估算
+    return len(json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8"))
+
+def _with_seq(msgs, start):
+    # 追加时给每条消息带上序号，防止 ArrayUnion 把内容相同的消息去重
+    return [dict(m, _seq=start + k) for k, m in enumerate(msgs)]
+
+def _strip_seq(msgs):
+    return [{k: v for k, v in m.items() if k != "_seq"} if isinstance(m, dict) else m for m in msgs]
+
+def ensure_chat_id(chat):
+    # 稳定的文档 ID: 第一次保存 (或排队做偏好分析) 时生成
+    return chat.setdefault("chat_id", uuid.uuid4().hex)
+
+def is_chat_loaded(chat):
+    """
+    索引里的 chat 只有标题/顺序，点开后才会加载正文
+    """
+    return "messages" in chat
+
+def _assign_order(history):
+    """
+    保证 order_index 从上到下严格递增
+    新 chat 总是插在最前面，取比下一个 chat 更小的值，
+    这样插入新 chat 不用给后面所有 (可能还没加载的) chat 重新编号
+    """
+    next_order = None
+    for chat in reversed(history):
+        order = chat.get("order_index")
+        if order is None or (next_order is not None and order >= next_order):
+            chat["order_index"] = next_order - 1 if next_order is not None else 0
+        next_order = chat["order_index"]
+
+def _index_terms(chat, clean_msgs, indexed, tf=None):
+    if tf is None:
+        tf = search.chat_terms({"title": chat.get("title", "New Chat"), "itinerary_content": chat.get("itinerary_content"), "messages": clean_msgs})
+    indexed.append((chat["chat_id"], chat.get("title", "New Chat"), tf))
+    return search.encode_terms(tf)
+
+def _search_updates(chat, clean_msgs, indexed, appended_from=None):
+    """
+    🟢 内容有变化时要写的搜索字段，以及提交成功后记到 chat 上的 (完整词频, delta 条数)
+    - 只追加了消息 (appended_from = 之前已保存的条数) 且有上次的词频: 只对新消息分词，
+      增量用 ArrayUnion 追加到 search_tf_delta；攒够 SEARCH_MAX_DELTAS 条才把合并结果整体写回 search_tf
+    - 标题 / 行程变了、消息被编辑过、或者这次会话里还没算过词频: 整体重算
+    """
+    base, deltas = chat.get("_sync_tf"), chat.get("_sync_tf_deltas", 0)
+    if appended_from is None or base is None:
+        raw = _index_terms(chat, clean_msgs, indexed)
+        return {"search_tf": raw, "search_tf_delta": _firestore().DELETE_FIELD}, (indexed[-1][2], 0)
+
+    delta = search.message_terms(clean_msgs[appended_from:])
+    tf = base + delta
+    if deltas >= config.SEARCH_MAX_DELTAS:
+        raw = _index_terms(chat, clean_msgs, indexed, tf)
+        return {"search_tf": raw, "search_tf_delta": _firestore().DELETE_FIELD}, (tf, 0)
+    indexed.append((chat["chat_id"], chat.get("title", "New Chat"), tf))
+    if not delta:  # 新消息里没有可搜索的词 (例如只有工具输出)
+        return {}, (tf, deltas)
+    return {"search_tf_delta": _firestore().ArrayUnion([search.encode_delta(appended_from, delta)])}, (tf, deltas + 1)
+
+@tracing.traced("firestore.write", op="save_chat_history")
+def save_chat_history(email, history, search_index=None):
     """
-    将聊天记录列表拆分，保存到 users/{email}/chats/ 子集合中
+    增量保存聊天记录到 users/{email}/chats/{chat_id}
+    - 新 chat: 整篇写入
+    - 已保存的 chat: 只写有变化的字段；消息只是追加时用 ArrayUnion 只写新增部分
+    - 只是顺序变化 (或正文没加载): 只更新 order_index
+    - 🟢 内容有变化的 chat 重新计算搜索词频 (search_tf)；传入 search_index 时同时更新它
+    删除请用 delete_chat()
     """
     try:
-        # 1. 获取 'chats' 子集合的引用
-        chats_ref = db.collection("users").document(email).collection("chats")
-        
-        # 2. 批量写入 (Batch Write) 以提高性能
-        batch = db.batch()
-        
-        # 3. 先把旧的文档标记为删除
-        old_docs = chats_ref.list_documents()
-        for doc in old_docs:
-            batch.delete(doc)
-            
-        # 4. 遍历当前的 history 列表，一个个存进去
-        for i, chat in enumerate(history):
-            doc_ref = chats_ref.document(f"chat_{i}")
-            
-            clean_data = {
-                "title": chat.get("title", "New Chat"),
-                "itinerary_content": chat.get("itinerary_content"),
-                "messages": serialize_messages(chat["messages"]),
-                "order_index": i,
-                "updated_at": firestore.SERVER_TIMESTAMP,
-                # 🟢 [修改] 必须把这两个字段加进白名单，否则就被过滤掉了！
-                "map_html": chat.get("map_html"),
-                "traffic_data": chat.get("traffic_data")
-            }
-            batch.set(doc_ref, clean_data)
-        
-        # 5. 提交所有更改
-        batch.commit()
-        
-        # 清理旧数据
-        db.collection("users").document(email).update({
-            "chat_history": firestore.DELETE_FIELD
-        })
+        chats_ref = get_db().collection("users").document(email).collection("chats")
+        batch = get_db().batch()
+        writes = 0
+        bytes_out = 0
+        indexed = []  # 🟢 [新增] (chat_id, title, 词频): 提交成功后再更新内存里的搜索索引
+        synced = []   # (chat, 消息, order_index, 其他 _sync_ 字段): 提交成功后才记录同步状态，失败时 chat 保持"未保存"，下次重写
+        _assign_order(history)
+
+        for chat in history:
+            chat_id = ensure_chat_id(chat)
+            doc_ref = chats_ref.document(chat_id)
+            order_index = chat["order_index"]
+            # 偏好分析进度可能被后台 worker 随时推进: 这里取一次快照，写入的和记录为"已同步"的是同一个值
+            pref_upto = chat.get("pref_analyzed_upto")
+
+            # 1. 从未保存过 -> 整篇写入
+            if "_sync_order" not in chat:
+                clean_msgs = serialize_messages(chat["messages"])
+                clean_data = {
+                    "title": chat.get("title", "New Chat"),
+                    "itinerary_content": chat.get("itinerary_content"),
+                    "messages": _with_seq(clean_msgs, 0),
+                    "order_index": order_index,
+                    "updated_at": _firestore().SERVER_TIMESTAMP,
+                    # 🟢 [修改] 地图只存路线规格 (坐标/名称/每段耗时)，map_html 仅保留给旧记录
+                    "route_spec": chat.get("route_spec"),
+                    "map_html": chat.get("map_html"),
+                    "traffic_data": chat.get("traffic_data"),
+                    "pref_analyzed_upto": pref_upto,  # 偏好分析进度 (消息条数)
+                    "search_tf": _index_terms(chat, clean_msgs, indexed),
+                }
+                batch.set(doc_ref, clean_data)
+                synced.append((chat, clean_msgs, order_index, {"_sync_tf": indexed[-1][2], "_sync_tf_deltas": 0, "_sync_pref_upto": pref_upto}))
+                writes += 1
+                bytes_out += _payload_bytes(clean_data)
+                continue
+
+            # 2. 已保存过 -> 只挑变化的字段
+            updates = {}
+            extra = {}
+            if chat["_sync_order"] != order_index:
+                updates["order_index"] = order_index
+            if pref_upto != chat.get("_sync_pref_upto"):
+                updates["pref_analyzed_upto"] = extra["_sync_pref_upto"] = pref_upto
+
+            content_changed = False
+            appended_from = None  # 只追加了消息 (标题 / 行程没变) 时 = 之前已保存的条数
+            if is_chat_loaded(chat) and "_sync_msgs_hash" in chat:
+                meta_changed = _content_hash(_meta_of(chat)) != chat["_sync_meta_hash"]
+                if meta_changed:
+                    updates.update(_meta_of(chat))
+                    content_changed = True
+
+                clean_msgs = serialize_messages(chat["messages"])
+                saved_count = chat["_sync_msg_count"]
+                if _msgs_hash(clean_msgs) != chat["_sync_msgs_hash"]:
+                    content_changed = True
+                    if len(clean_msgs) > saved_count and _msgs_hash(clean_msgs[:saved_count]) == chat["_sync_msgs_hash"]:
+                        # 前缀没变，只追加新消息
+                        appended = _with_seq(clean_msgs[saved_count:], saved_count)
+                        updates["messages"] = _firestore().ArrayUnion(appended)
+                        bytes_out += _payload_bytes(appended)
+                        if not meta_changed: appended_from = saved_count
+                    else:
+                        # 中间被编辑/截断过 -> 整个 messages 重写
+                        updates["messages"] = _with_seq(clean_msgs, 0)
+                        bytes_out += _payload_bytes(updates["messages"])
+
+            if content_changed:
+                updates["updated_at"] = _firestore().SERVER_TIMESTAMP
+                search_fields, (extra["_sync_tf"], extra["_sync_tf_deltas"]) = _search_updates(chat, clean_msgs, indexed, appended_from)
+                updates.update(search_fields)
+                bytes_out += _payload_bytes({k: v for k, v in search_fields.items() if isinstance(v, str)})
+            if updates:
+                batch.update(doc_ref, updates)
+                synced.append((chat, serialize_messages(chat["messages"]) if is_chat_loaded(chat) else None, order_index, extra))
+                writes += 1
+
+        if writes:
+            batch.commit()
+        for chat, clean_msgs, order_index, extra in synced:
+            if clean_msgs is not None:
+                _mark_synced(chat, clean_msgs, order_index)
+            else:
+                chat["_sync_order"] = order_index
+            chat.update(extra)
+        if search_index is not None:
+            for chat_id, title, tf in indexed:
+                search_index.put(chat_id, title, tf)
+        tracing.annotate(chats=len(history), writes=writes, bytes=bytes_out)
+
+        # 清理旧数据 (只在从旧格式迁移后做一次)
+        if email in _legacy_cleanup_pending:
+            get_db().collection("users").document(email).update({
+                "chat_history": _firestore().DELETE_FIELD
+            })
+            _legacy_cleanup_pending.discard(email)
         
-        print(f"✅ [DB] Saved {len(history)} chats to subcollection for {email}")
+        print(f"✅ [DB] Synced {writes}/{len(history)} changed chats for {email}")
         return True
     except Exception as e:
         print(f"❌ [DB] Error saving history: {e}")
         return False
 
-def load_chat_history(email):
+@tracing.traced("firestore.write", op="delete_chat")
+def delete_chat(email, chat):
     """
-    从 users/{email}/chats/ 子集合读取聊天记录，并组装成列表
+    删除单个 chat 文档 (没保存过的 chat 直接忽略)
     """
+    chat_id = chat.get("chat_id")
+    if not chat_id or "_sync_order" not in chat: return True
     try:
-        # 1. 获取 'chats' 子集合
-        chats_ref = db.collection("users").document(email).collection("chats")
-        
-        # 2. 获取所有文档
-        docs = chats_ref.stream()
-        
-        # 3. 组装成列表
-        loaded_history = []
-        for doc in docs:
+        get_db().collection("users").document(email).collection("chats").document(chat_id).delete()
+        return True
+    except Exception as e:
+        print(f"❌ [DB] Error deleting chat {chat_id}: {e}")
+        return False
+
+@tracing.traced("firestore.read", op="load_chat_index")
+def load_chat_index(email, page_size=20, start_after_order=None):
+    """
+    🟢 [新增] 分页读取聊天索引 (只取 title/order_index/updated_at，不读正文)
+    返回 (chat 列表, 是否还有下一页)
+    """
+    try:
+        chats_ref = get_db().collection("users").document(email).collection("chats")
+        query = chats_ref.select(INDEX_FIELDS).order_by("order_index")
+        if start_after_order is not None:
+            query = query.start_after({"order_index": start_after_order})
+        docs = list(query.limit(page_size + 1).stream())
+        tracing.annotate(docs=len(docs))
+
+        index = []
+        for doc in docs[:page_size]:
             data = doc.to_dict()
-            if "messages" not in data: continue
-            
-            chat_obj = {
+            index.append({
+                "chat_id": doc.id,
                 "title": data.get("title", "New Chat"),
-                "itinerary_content": data.get("itinerary_content"),
-                "messages": data.get("messages", []),
                 "order_index": data.get("order_index", 0),
-                # 🟢 [修改] 读取时也要记得把它们捞出来
-                "map_html": data.get("map_html"),
-                "traffic_data": data.get("traffic_data")
-            }
-            loaded_history.append(chat_obj)
-            
-        # 4. 按 order_index 排序
-        loaded_history.sort(key=lambda x: x["order_index"])
-        
-        # 5. 兼容旧格式
-        if not loaded_history:
-            old_doc = db.collection("users").document(email).get()
+                "updated_at": data.get("updated_at"),
+                "_sync_order": data.get("order_index", 0),
+            })
+
+        # 兼容旧格式 (整份历史存在 user 文档里，直接当作已加载的 chat 返回)
+        if not index and start_after_order is None:
+            old_doc = get_db().collection("users").document(email).get()
             if old_doc.exists:
                 old_data = old_doc.to_dict()
                 if "chat_history" in old_data:
                     print("⚠️ [DB] Migrating from old format...")
-                    return old_data["chat_history"]
+                    _legacy_cleanup_pending.add(email)
+                    return old_data["chat_history"], False
 
-        return loaded_history
+        return index, len(docs) > page_size
     except Exception as e:
-        print(f"Error loading history: {e}")
-        return []
+        print(f"Error loading history index: {e}")
+        return [], False
+
+@tracing.traced("firestore.write", op="pref_progress")
+def save_pref_progress(email, chat, upto):
+    """
+    🟢 [新增] 偏好分析成功后马上记录进度 (只写 pref_analyzed_upto 一个字段)
+    文档还没写进 Firestore 时会失败: 没关系，save_chat_history 发现内存里的值和上次同步的不同，会在下次保存时补上
+    """
+    chat_id = chat.get("chat_id")
+    if not chat_id: return False
+    try:
+        get_db().collection("users").document(email).collection("chats").document(chat_id).update({"pref_analyzed_upto": upto})
+        chat["_sync_pref_upto"] = upto
+        return True
+    except Exception as e:
+        print(f"Error saving preference progress for {chat_id}: {e}")
+        return False
+
+@tracing.traced("firestore.read", op="load_chat_body")
+def load_chat_body(email, chat):
+    """
+    🟢 [新增] 点开某个历史对话时才读取正文，直接填回 chat 字典
+    """
+    if is_chat_loaded(chat): return True
+    try:
+        doc = get_db().collection("users").document(email).collection("chats").document(chat["chat_id"]).get()
+        if not doc.exists: return False
+        data = doc.to_dict()
+        tracing.annotate(bytes=_payload_bytes(data))
+        chat["title"] = data.get("title", chat.get("title", "New Chat"))
+        chat["messages"] = _strip_seq(data.get("messages", []))
+        chat["itinerary_content"] = data.get("itinerary_content")
+        # 🟢 [修改] 读取时也要记得把它们捞出来
+        chat["route_spec"] = data.get("route_spec")
+        chat["map_html"] = data.get("map_html")
+        chat["traffic_data"] = data.get("traffic_data")
+        chat["pref_analyzed_upto"] = chat["_sync_pref_upto"] = data.get("pref_analyzed_upto")
+        _mark_synced(chat, chat["messages"], chat.get("_sync_order", chat.get("order_index", 0)))
+        if data.get("search_tf") is not None:
+            # 之后追加消息时只需在这份词频上累加 (见 _search_updates)
+            chat["_sync_tf"] = search.merge_terms(data["search_tf"], data.get("search_tf_delta"))
+            chat["_sync_tf_deltas"] = len(data.get("search_tf_delta") or [])
+        return True
+    except Exception as e:
+        print(f"Error loading chat {chat.get('chat_id')}: {e}")
+        return False
+
+@tracing.traced("firestore.read", op="load_search_index")
+def load_search_index(email):
+    """
+    🟢 [新增] 只读各 chat 的 title + search_tf (不读正文)，建成内存倒排索引
+    这个功能上线前保存的 chat 还没有 search_tf: 读一次正文补上 (一次性迁移)
+    读取失败时返回 None
+    """
+    index = search.ChatSearchIndex()
+    try:
+        chats_ref = get_db().collection("users").document(email).collection("chats")
+        docs = list(chats_ref.select(["title", "search_tf", "search_tf_delta"]).stream())
+        missing = []
+        for doc in docs:
+            data = doc.to_dict()
+            if data.get("search_tf") is None:
+                missing.append(chats_ref.document(doc.id))
+            else:
+                index.put(doc.id, data.get("title", "New Chat"), search.merge_terms(data["search_tf"], data.get("search_tf_delta")))
+
+        bytes_in = 0
+        for start in range(0, len(missing), 400):  # 一个 batch 最多 500 次写入
+            batch = get_db().batch()
+            for doc in get_db().get_all(missing[start:start + 400]):
+                if not doc.exists: continue
+                data = doc.to_dict()
+                bytes_in += _payload_bytes(data)
+                chat = {"chat_id": doc.id, "title": data.get("title", "New Chat"), "itinerary_content": data.get("itinerary_content")}
+                indexed = []
+                batch.update(doc.reference, {"search_tf": _index_terms(chat, _strip_seq(data.get("messages", [])), indexed)})
+                index.put(*indexed[0])
+            batch.commit()
+        tracing.annotate(docs=len(docs), backfilled=len(missing), bytes=bytes_in)
+        if missing:
+            print(f"✅ [DB] Backfilled search terms for {len(missing)} chats of {email}")
+    except Exception as e:
+        print(f"Error loading search index: {e}")
+        return None
+    return index
+
+def unload_chat_body(chat):
+    """
+    把已同步的正文从内存里释放，只留索引 (有未保存改动时不释放)
+    """
+    if not is_chat_loaded(chat) or "_sync_msgs_hash" not in chat: return False
+    if _msgs_hash(serialize_messages(chat["messages"])) != chat["_sync_msgs_hash"]: return False
+    if _content_hash(_meta_of(chat)) != chat["_sync_meta_hash"]: return False
+    for field in BODY_FIELDS:
+        chat.pop(field, None)
+    for field in ("_sync_meta_hash", "_sync_msg_count", "_sync_msgs_hash", "_sync_tf", "_sync_tf_deltas", "_sync_pref_upto"):
+        chat.pop(field, None)
+    return True
 
 # ==========================================
 # 🟢 偏好学习功能：合并标签
 # ==========================================
+@tracing.traced("firestore.write", op="merge_preferences")
 def merge_user_preferences(email, new_tags):
     try:
-        doc_ref = db.collection("users").document(email)
+        doc_ref = get_db().collection("users").document(email)
         doc = doc_ref.get()
         
         if doc.exists:
@@ -185,4 +467,4 @@ def merge_user_preferences(email, new_tags):
         return []
     except Exception as e:
         print(f"Error merging preferences: {e}")
-        return []
\ No newline at end of file
+        return None  # 和"用户不存在"的 [] 区分开: 后台 worker 据此不推进分析进度
\ No newline at end of file
@@ -0,0 +1,271 @@
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+
+import config
+from cache import normalize_key, _open_sqlite
+
+# ==========================================
+# 🟢 本地 POI 索引 (google_maps 结果不再用完就扔)
+# ==========================================
+# - pois: 每个地点一行 (标题 / 地址 / 评分 / 缩略图 / 坐标)，按网格 cell 建空间索引
+#   (cell = 经纬度除以 config.POI_CELL_DEG 取整，附近查询只扫半径覆盖到的几个格子)
+# - poi_text: FTS5 (trigram) 全文索引，覆盖标题 + 搜索标签 (搜出这个地点的关键词和 Google 类型)，
+#   中英文子串都能匹配；由触发器和 pois 保持同步
+# - poi_coverage: 哪些查询 (城市 + 类别 + 关键词 / 附近格子 + 关键词) 什么时候从 SerpAPI 拉过
+#
+# 新鲜度策略:
+# 1. 同一查询在 POI_FRESH_TTL 内拉过 -> 直接用本地结果回答
+# 2. 带关键词的查询没拉过，但本地已有 >= POI_MIN_LOCAL_RESULTS 个新鲜 (POI_FRESH_TTL 内见过) 的匹配地点 -> 也用本地结果
+#    (不带关键词的 "top sights in X" 必须拉过同一查询: 否则会拿别人搜 "museum" 存下来的结果充数)
+# 3. 否则返回 None，调用方去查 SerpAPI，再把结果写回来
+# 超过 POI_MAX_AGE 没再见到的地点在启动时清理
+
+CATEGORY_HINTS = {
+    "restaurant": ("restaurant", "cafe", "coffee", "food", "bakery", "hawker", "bar", "kopitiam", "餐厅", "美食"),
+    "hotel": ("hotel", "resort", "hostel", "inn", "lodging", "酒店"),
+    "attraction": ("tourist attraction", "museum", "park", "temple", "mosque", "landmark", "historical", "gallery", "beach", "景点"),
+}
+
+FIELDS = ("title", "rating", "reviews", "address", "thumbnail", "lat", "lng")
+FTS_SELECTIVE = 2000  # 关键词匹配少于这么多个地点时由全文索引驱动查询，否则用 LIKE (见 PoiIndex._text_filter)
+NEARBY_CHUNK = 100    # 附近查询每批取多少个候选的详情
+
+def cell_of(lat, lng, cell_deg):
+    # 纬度 / 经度格子编号拼成一个整数 (经度方向最多 36000 / cell_deg 个格子)
+    return (math.floor(lat / cell_deg) + 100000) * 1000000 + math.floor(lng / cell_deg) + 100000
+
+def category_of(result, default):
+    """
+    用 Google 的 type 修正类别 (例如查坐标时顺带拿到的餐厅)
+    """
+    kind = normalize_key(result.get("type") or " ".join(result.get("types") or []))
+    for category, hints in CATEGORY_HINTS.items():
+        if any(h in kind for h in hints):
+            return category
+    return default
+
+def _text_sql(ids=None, pattern=None):
+    if ids is not None: return f" AND id IN ({','.join('?' * len(ids))})", ids
+    if pattern is not None: return " AND (lower(title) LIKE ? OR tags LIKE ?)", [pattern, pattern]
+    return "", []
+
+def _uid(result, lat, lng):
+    if result.get("place_id"): return result["place_id"]
+    raw = f"{normalize_key(result.get('title'))}|{lat:.4f}|{lng:.4f}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+class PoiIndex:
+    def __init__(self, path, cell_deg, fresh_ttl, max_age, min_results):
+        self.cell_deg = cell_deg
+        self.fresh_ttl = fresh_ttl
+        self.max_age = max_age
+        self.min_results = min_results
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = _open_sqlite(path)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pois (
+                id INTEGER PRIMARY KEY,
+                uid TEXT UNIQUE NOT NULL,
+                title TEXT NOT NULL,
+                address TEXT,
+                category TEXT NOT NULL,
+                area TEXT,
+                tags TEXT NOT NULL DEFAULT '',
+                rating REAL,
+                reviews INTEGER,
+                thumbnail TEXT,
+                lat REAL NOT NULL,
+                lng REAL NOT NULL,
+                cell INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_pois_cell ON pois (cell, category, lat, lng, rating, reviews, updated_at);  -- 覆盖附近查询的第一步
+            CREATE INDEX IF NOT EXISTS idx_pois_area ON pois (area, category, rating);
+            CREATE INDEX IF NOT EXISTS idx_pois_updated ON pois (updated_at);
+            CREATE TABLE IF NOT EXISTS poi_coverage (
+                key TEXT PRIMARY KEY,
+                count INTEGER NOT NULL,
+                fetched_at REAL NOT NULL
+            );
+        """)
+        self.fts = self._create_fts()
+        self.prune()
+
+    def _create_fts(self):
+        # 没有 FTS5 (或 trigram 分词器) 的 SQLite 退化成 LIKE 匹配
+        try:
+            self._conn.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS poi_text USING fts5(title, tags, content='pois', content_rowid='id', tokenize='trigram');
+                CREATE TRIGGER IF NOT EXISTS pois_ai AFTER INSERT ON pois BEGIN
+                    INSERT INTO poi_text (rowid, title, tags) VALUES (new.id, new.title, new.tags);
+                END;
+                CREATE TRIGGER IF NOT EXISTS pois_ad AFTER DELETE ON pois BEGIN
+                    INSERT INTO poi_text (poi_text, rowid, title, tags) VALUES ('delete', old.id, old.title, old.tags);
+                END;
+                CREATE TRIGGER IF NOT EXISTS pois_au AFTER UPDATE OF title, tags ON pois BEGIN
+                    INSERT INTO poi_text (poi_text, rowid, title, tags) VALUES ('delete', old.id, old.title, old.tags);
+                    INSERT INTO poi_text (rowid, title, tags) VALUES (new.id, new.title, new.tags);
+                END;
+            """)
+            return True
+        except sqlite3.OperationalError as e:
+            print(f"⚠️ [POI] FTS5 trigram unavailable, falling back to LIKE: {e}")
+            return False
+
+    # ---------- 写入 ----------
+    def coverage_key(self, category, keyword=None, area=None, near=None):
+        if near is not None:
+            return f"near|{category}|{cell_of(near[0], near[1], self.cell_deg)}|{normalize_key(keyword)}"
+        return f"area|{category}|{normalize_key(area)}|{normalize_key(keyword)}"
+
+    def ingest(self, results, category, area=None, keyword=None, near=None):
+        """
+        写入一批 google_maps local_results (有 gps_coordinates 的才要)，返回写入条数
+        同一地点再次出现时更新评分 / 时间，并把这次的关键词追加到标签里
+        一条都没写入时不记 coverage (否则空结果会让这个区域在 POI_FRESH_TTL 内都不再查 SerpAPI)
+        """
+        now = time.time()
+        rows = []
+        for r in results or []:
+            gps = r.get("gps_coordinates") or {}
+            lat, lng = gps.get("latitude"), gps.get("longitude")
+            if lat is None or lng is None or not r.get("title"): continue
+            tags = " | ".join(t for t in (normalize_key(keyword), normalize_key(r.get("type"))) if t)
+            rows.append((_uid(r, lat, lng), r["title"], r.get("address"), category_of(r, category), normalize_key(area) or None,
+                         tags, r.get("rating"), r.get("reviews"), r.get("thumbnail"), lat, lng, cell_of(lat, lng, self.cell_deg), now))
+        if not rows: return 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("""
+                    INSERT INTO pois (uid, title, address, category, area, tags, rating, reviews, thumbnail, lat, lng, cell, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (uid) DO UPDATE SET
+                        title = excluded.title,
+                        address = COALESCE(excluded.address, address),
+                        area = COALESCE(area, excluded.area),
+                        tags = CASE WHEN excluded.tags = '' OR instr(tags, excluded.tags) > 0 THEN tags
+                                    ELSE substr(tags || ' | ' || excluded.tags, 1, 500) END,
+                        rating = COALESCE(excluded.rating, rating),
+                        reviews = COALESCE(excluded.reviews, reviews),
+                        thumbnail = COALESCE(excluded.thumbnail, thumbnail),
+                        updated_at = excluded.updated_at
+                """, rows)
+                if keyword is not None or area is not None or near is not None:
+                    self._conn.execute("INSERT OR REPLACE INTO poi_coverage (key, count, fetched_at) VALUES (?, ?, ?)",
+                                       (self.coverage_key(category, keyword, area, near), len(rows), now))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def prune(self):
+        cutoff = time.time() - self.max_age
+        with self._lock:
+            self._conn.execute("DELETE FROM pois WHERE updated_at < ?", (cutoff,))
+            self._conn.execute("DELETE FROM poi_coverage WHERE fetched_at < ?", (cutoff,))
+
+    # ---------- 查询 ----------
+    def _covered(self, key, now):
+        row = self._conn.execute("SELECT fetched_at FROM poi_coverage WHERE key = ?", (key,)).fetchone()
+        return row is not None and now - row[0] <= self.fresh_ttl
+
+    def _answer(self, rows, covered, limit, keyword):
+        # 新鲜度策略: 拉过同一查询，或者 (带关键词时) 本地匹配结果足够多
+        if covered and rows or normalize_key(keyword) and len(rows) >= self.min_results:
+            self.hits += 1
+            return rows[:limit]
+        self.misses += 1
+        return None
+
+    def _text_filter(self, keyword):
+        """
+        返回 (ids, pattern)，按关键词的选择性选执行方式:
+        - 全文索引里匹配少于 FTS_SELECTIVE 个 -> ids: 直接用这些 id (罕见词，扫描范围最小)
+        - 匹配很多 (常见词) / 太短 / 没有 FTS -> pattern: LIKE，跟着评分顺序扫，凑够数量就停
+        """
+        keyword = normalize_key(keyword)
+        if not keyword: return None, None
+        if self.fts and len(keyword) >= 3:
+            phrase = '"' + keyword.replace('"', '""') + '"'
+            ids = [r[0] for r in self._conn.execute("SELECT rowid FROM poi_text WHERE poi_text MATCH ? LIMIT ?", (phrase, FTS_SELECTIVE))]
+            if len(ids) < FTS_SELECTIVE: return ids, None
+        return None, f"%{keyword}%"
+
+    def search_area(self, area, category, keyword=None, limit=10):
+        """
+        "top sights in Melaka": 某个城市 / 地区里某类地点，按评分排序
+        返回 [{"title", "rating", "reviews", "address", "thumbnail", "lat", "lng"}]；本地不够新鲜 / 不够多时返回 None
+        """
+        now = time.time()
+        with self._lock:
+            text_sql, text_args = _text_sql(*self._text_filter(keyword))
+            covered = self._covered(self.coverage_key(category, keyword, area=area), now)
+            cur = self._conn.execute(f"""
+                SELECT {", ".join(FIELDS)} FROM pois
+                WHERE area = ? AND category = ? AND updated_at >= ?{text_sql}
+                ORDER BY rating DESC, reviews DESC LIMIT ?
+            """, [normalize_key(area), category, now - self.fresh_ttl, *text_args, max(limit, self.min_results)])
+            rows = [dict(zip(FIELDS, r)) for r in cur]
+            return self._answer(rows, covered, limit, keyword)
+
+    def search_nearby(self, lat, lng, radius_km, category, keyword=None, limit=10):
+        """
+        "restaurants near my hotel": 半径内某类地点，按评分排序，带 distance_km
+        只扫半径外接矩形覆盖到的网格，凑够数量就停；本地不够新鲜 / 不够多时返回 None
+        """
+        import routing
+        now = time.time()
+        dlat = radius_km / 111.0
+        dlng = radius_km / (111.0 * max(math.cos(math.radians(lat)), 0.01))
+        lat_cells = range(math.floor((lat - dlat) / self.cell_deg), math.floor((lat + dlat) / self.cell_deg) + 1)
+        lng_cells = range(math.floor((lng - dlng) / self.cell_deg), math.floor((lng + dlng) / self.cell_deg) + 1)
+        cells = [(a + 100000) * 1000000 + b + 100000 for a in lat_cells for b in lng_cells]
+        need = max(limit, self.min_results)
+        with self._lock:
+            ids, pattern = self._text_filter(keyword)
+            id_sql, id_args = _text_sql(ids=ids)
+            like_sql, like_args = _text_sql(pattern=pattern)
+            covered = self._covered(self.coverage_key(category, keyword, near=(lat, lng)), now)
+            # 第一步只读覆盖索引 idx_pois_cell: 矩形内按评分排好序的候选 id
+            cur = self._conn.execute(f"""
+                SELECT id FROM pois
+                WHERE cell IN ({",".join("?" * len(cells))}) AND category = ?
+                  AND lat BETWEEN ? AND ? AND lng BETWEEN ? AND ? AND updated_at >= ?{id_sql}
+                ORDER BY rating DESC, reviews DESC
+            """, [*cells, category, lat - dlat, lat + dlat, lng - dlng, lng + dlng, now - self.fresh_ttl, *id_args])
+            # 第二步按这个顺序分批取详情 (常见关键词在这里 LIKE 过滤)，去掉矩形四角，凑够数量就停
+            rows = []
+            while len(rows) < need:
+                chunk = [r[0] for r in cur.fetchmany(NEARBY_CHUNK)]
+                if not chunk: break
+                found = {r[0]: r[1:] for r in self._conn.execute(
+                    f"SELECT id, {', '.join(FIELDS)} FROM pois WHERE id IN ({','.join('?' * len(chunk))}){like_sql}", [*chunk, *like_args])}
+                for pid in chunk:
+                    if pid not in found: continue
+                    poi = dict(zip(FIELDS, found[pid]))
+                    poi["distance_km"] = round(routing.haversine_km(lat, lng, poi["lat"], poi["lng"]), 2)
+                    if poi["distance_km"] > radius_km: continue
+                    rows.append(poi)
+                    if len(rows) >= need: break
+            return self._answer(rows, covered, limit, keyword)
+
+    def stats(self):
+        total = self.hits + self.misses
+        size = self._conn.execute("SELECT COUNT(*) FROM pois").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0, "size": size, "fts": self.fts}
+
+# 进程级单例
+poi_index = PoiIndex(
+    config.POI_INDEX_PATH,
+    cell_deg=config.POI_CELL_DEG,
+    fresh_ttl=config.POI_FRESH_TTL,
+    max_age=config.POI_MAX_AGE,
+    min_results=config.POI_MIN_LOCAL_RESULTS,
+)
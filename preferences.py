@@ -0,0 +1,88 @@
+import queue
+import threading
+
+import db
+import tools
+
+# ==========================================
+# 🟢 后台偏好分析 (不阻塞 New Chat)
+# ==========================================
+# handle_new_chat 只负责把"上次分析之后新增的消息"丢进队列，
+# 后台线程调用 LLM 提取标签并合并到 Firestore，
+# 结果按 email 暂存，下一次 rerun 时由 app.py 取走写回 session_state
+# 分析进度 (chat["pref_analyzed_upto"]) 只在分析 + 合并都成功后才推进并写回 Firestore
+# (写回失败时由下一次 save_chat_history 补上)，失败 (LLM 超时 / 合并出错) 的消息下次 New Chat 时会重新分析
+
+class PreferenceWorker:
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.updates = {}  # email -> 合并后的完整标签列表
+        self.lock = threading.Lock()
+        self.stats = {"queued": 0, "analyzed": 0, "merged": 0, "failed": 0}
+        self.thread = threading.Thread(target=self._loop, name="preference_worker", daemon=True)
+        self.thread.start()
+
+    def submit(self, email, chat, messages, upto):
+        with self.lock:
+            self.stats["queued"] += 1
+        self.jobs.put((email, chat, messages, upto))
+
+    def pop_update(self, email):
+        with self.lock:
+            return self.updates.pop(email, None)
+
+    def _loop(self):
+        while True:
+            email, chat, messages, upto = self.jobs.get()
+            try:
+                learned_tags = tools.analyze_preferences_from_chat(messages, strict=True)
+                with self.lock:
+                    self.stats["analyzed"] += 1
+                if learned_tags:
+                    new_all_tags = db.merge_user_preferences(email, learned_tags)
+                    if new_all_tags is None:
+                        raise RuntimeError("merge_user_preferences failed")
+                    if new_all_tags:
+                        with self.lock:
+                            self.updates[email] = new_all_tags
+                            self.stats["merged"] += 1
+                        print(f"✅ [Prefs] {email}: +{learned_tags}")
+                # 成功之后才推进进度 (只改这一个整数字段，不碰 session_state 里的其他东西)
+                if upto > (chat.get("pref_analyzed_upto") or 0):
+                    chat["pref_analyzed_upto"] = upto
+                    db.save_pref_progress(email, chat, upto)
+            except Exception as e:
+                with self.lock:
+                    self.stats["failed"] += 1
+                print(f"❌ [Prefs] Error analyzing chat for {email}: {e}")
+            finally:
+                self.jobs.task_done()
+
+_worker = None
+_worker_lock = threading.Lock()
+
+def get_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = PreferenceWorker()
+    return _worker
+
+def queue_chat_analysis(email, chat):
+    """
+    只提交 chat 里上次分析之后新增的消息 (进度记在 chat["pref_analyzed_upto"]，由 worker 成功后推进)
+    没有新的用户发言就不排队
+    """
+    messages = chat.get("messages") or []
+    start = chat.get("pref_analyzed_upto") or 0
+    new_msgs = messages[start:]
+    if not any(db.serialize_messages([m])[0].get("role") == "user" for m in new_msgs):
+        return False
+    db.ensure_chat_id(chat)  # worker 按 chat_id 写回进度，新 chat 这时可能还没保存过
+    get_worker().submit(email, chat, list(new_msgs), len(messages))
+    return True
+
+def pop_learned_preferences(email):
+    # 没有启动过 worker 就不用去创建它
+    if _worker is None: return None
+    return _worker.pop_update(email)
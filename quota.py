@@ -0,0 +1,125 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+# ==========================================
+# 🟢 SerpAPI 额度调度: 令牌桶 + 优先级 + 按用户公平排队
+# ==========================================
+# - 令牌桶: 每秒补 rate 个令牌，最多攒 burst 个；每次 HTTP 请求 (包括重试) 消耗一个
+# - 优先级: 令牌紧张时先发高优先级 (机票 / 酒店)，再发景点 / 路线，最后才是图片
+# - 同一优先级里按用户轮流取 (round-robin)，一个用户的一大批请求不会饿死其他用户
+# - 降级: 低优先级请求排队超过 max_wait 秒就抛 Shed，调用方跳过这部分内容，而不是让整轮失败
+# 只在共享事件循环上使用 (见 clients.AsyncRuntime)，所以不用加锁
+
+HIGH, NORMAL, LOW, BACKGROUND = 0, 1, 2, 3
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low", BACKGROUND: "background"}
+
+class Shed(Exception):
+    """
+    高峰期被丢弃的低优先级请求
+    """
+
+class QuotaScheduler:
+    def __init__(self, rate, burst, max_wait=None):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.max_wait = max_wait or {}
+        self.queues = {p: OrderedDict() for p in PRIORITY_NAMES}  # priority -> {user: deque([(future, enqueued_at)])}
+        self.depth = {p: 0 for p in PRIORITY_NAMES}                # 还在排队 (没拿到令牌、没放弃) 的请求数
+        self.stats_by_priority = {p: {"granted": 0, "queued": 0, "shed": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0} for p in PRIORITY_NAMES}
+        self._dispatcher = None
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _record(self, priority, wait_ms):
+        stats = self.stats_by_priority[priority]
+        stats["granted"] += 1
+        stats["wait_ms_total"] += wait_ms
+        stats["wait_ms_max"] = max(stats["wait_ms_max"], wait_ms)
+
+    def pause(self, seconds):
+        """
+        上游返回 429 时调用: 这段时间内不再放行任何请求，并清空已攒的令牌
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    async def acquire(self, priority=NORMAL, user=None):
+        """
+        拿到一个令牌才返回 (返回排队的毫秒数)；低优先级等太久时抛 Shed
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if not any(self.depth.values()) and self.tokens >= 1 and now >= self.paused_until:
+            self.tokens -= 1
+            self._record(priority, 0.0)
+            return 0.0
+
+        limit = self.max_wait.get(priority)
+        if limit is not None and limit <= 0:
+            self.stats_by_priority[priority]["shed"] += 1
+            raise Shed(f"{PRIORITY_NAMES[priority]} request shed (no quota left)")
+        future = asyncio.get_running_loop().create_future()
+        self.queues[priority].setdefault(user, deque()).append((future, now))
+        self.depth[priority] += 1
+        self.stats_by_priority[priority]["queued"] += 1
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), limit)
+        except asyncio.TimeoutError:
+            if future.done(): return future.result()  # 超时的同一刻刚好拿到令牌
+            future.cancel()
+            self.depth[priority] -= 1
+            self.stats_by_priority[priority]["shed"] += 1
+            raise Shed(f"{PRIORITY_NAMES[priority]} request shed after waiting {limit}s") from None
+        except BaseException:
+            # 调用方被取消: 退出队列 (令牌已经发出的话就浪费掉这一个)
+            if not future.done():
+                future.cancel()
+                self.depth[priority] -= 1
+            raise
+
+    def _next_waiter(self):
+        for priority in sorted(self.queues):
+            users = self.queues[priority]
+            while users:
+                user, waiters = next(iter(users.items()))
+                future, enqueued_at = waiters.popleft()
+                if waiters: users.move_to_end(user)   # 轮到下一个用户
+                else: del users[user]
+                if not future.done():
+                    return priority, future, enqueued_at
+        return None, None, None
+
+    async def _dispatch(self):
+        while any(self.depth.values()):
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            priority, future, enqueued_at = self._next_waiter()
+            if future is None: break
+            self.tokens -= 1
+            self.depth[priority] -= 1
+            wait_ms = (now - enqueued_at) * 1000
+            self._record(priority, wait_ms)
+            future.set_result(wait_ms)
+
+    def stats(self):
+        self._refill(time.monotonic())
+        return {
+            "tokens": round(self.tokens, 2),
+            "queue_depth": {PRIORITY_NAMES[p]: d for p, d in self.depth.items()},
+            "by_priority": {PRIORITY_NAMES[p]: dict(s, wait_ms_total=round(s["wait_ms_total"], 1), wait_ms_max=round(s["wait_ms_max"], 1))
+                            for p, s in self.stats_by_priority.items()},
+        }
@@ -0,0 +1,106 @@
+import math
+
+import numpy as np
+
+# ==========================================
+# 🟢 路线顺序优化 (generate_map_with_traffic 的 optimize 模式)
+# ==========================================
+# 1. NumPy 向量化 haversine 算两两距离，换算成估计驾车秒数
+# 2. 有缓存的真实驾车时长就覆盖估计值 (由调用方提供，不发新请求)
+# 3. 最近邻 + 2-opt 求开放路径 (不回到起点)，可固定第一站 (通常是酒店)
+
+EARTH_RADIUS_KM = 6371.0088
+CITY_SPEED_KMH = 25.0    # 市区平均车速估计
+DETOUR_FACTOR = 1.3      # 实际道路比直线绕远的系数
+
+def haversine_matrix(lats, lngs):
+    """
+    返回 n x n 的大圆距离矩阵 (km)
+    """
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lng = np.radians(np.asarray(lngs, dtype=float))
+    dlat = lat[:, None] - lat[None, :]
+    dlng = lng[:, None] - lng[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:, None]) * np.cos(lat[None, :]) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """
+    单段大圆距离 (km)，给逐段判断用，不值得走 NumPy
+    """
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, a)))
+
+def duration_matrix(points, known_seconds=None):
+    """
+    points: [(lat, lng), ...]
+    known_seconds: {(i, j): 已缓存的真实驾车秒数}，有就覆盖估计值
+    返回估计驾车秒数矩阵 (对称化后给 2-opt 用)
+    """
+    lats = [p[0] for p in points]
+    lngs = [p[1] for p in points]
+    seconds = haversine_matrix(lats, lngs) * DETOUR_FACTOR / CITY_SPEED_KMH * 3600
+    for (i, j), value in (known_seconds or {}).items():
+        seconds[i, j] = value
+    return (seconds + seconds.T) / 2
+
+def _nearest_neighbour(d, start):
+    n = len(d)
+    visited = np.zeros(n, dtype=bool)
+    order = [start]
+    visited[start] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, d[order[-1]])
+        nxt = int(np.argmin(row))
+        order.append(nxt)
+        visited[nxt] = True
+    return np.array(order)
+
+def _two_opt(order, d):
+    """
+    开放路径的 2-opt: 第一站固定，对每个 i 向量化地找最好的 j 翻转 order[i..j]
+    """
+    n = len(order)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            a, b = order[i - 1], order[i]
+            js = np.arange(i + 1, n)
+            c = order[js]
+            has_next = js + 1 < n
+            e = order[np.minimum(js + 1, n - 1)]
+            delta = d[a, c] - d[a, b] + np.where(has_next, d[b, e] - d[c, e], 0.0)
+            k = int(np.argmin(delta))
+            if delta[k] < -1e-9:
+                j = js[k]
+                order[i:j + 1] = order[i:j + 1][::-1].copy()
+                improved = True
+    return order
+
+def solve_order(d, keep_first=True):
+    """
+    d: n x n 对称代价矩阵；返回访问顺序 (下标列表)
+    keep_first=False 时起点也可以变: 加一个到所有点代价都为 0 的虚拟起点
+    """
+    n = len(d)
+    if n <= 2:
+        return list(range(n))
+    if not keep_first:
+        padded = np.zeros((n + 1, n + 1))
+        padded[:n, :n] = d
+        order = _two_opt(_nearest_neighbour(padded, n), padded)
+        return [int(i) for i in order if i != n]
+    return [int(i) for i in _two_opt(_nearest_neighbour(d, 0), d)]
+
+def route_cost(order, d):
+    return float(sum(d[order[k], order[k + 1]] for k in range(len(order) - 1)))
+
+def optimize_order(points, keep_first=True, known_seconds=None):
+    """
+    points: [(lat, lng), ...]，返回 (新顺序下标, 优化前估计秒数, 优化后估计秒数)
+    """
+    d = duration_matrix(points, known_seconds)
+    order = solve_order(d, keep_first)
+    return order, route_cost(list(range(len(points))), d), route_cost(order, d)
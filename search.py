@@ -0,0 +1,138 @@
+import json
+import math
+import re
+from collections import Counter
+
+import config
+
+# ==========================================
+# 🟢 聊天记录全文搜索 (每个用户一个内存倒排索引)
+# ==========================================
+# - 分词: 中日韩文字切成相邻两字 (bigram)，英文 / 马来文按单词，统一小写；图片 Markdown 和链接先去掉
+# - 每个 chat 的词频在 save_chat_history 时算好，和正文一起写进 chat 文档的 search_tf 字段
+#   (JSON 字符串而不是 map，Firestore 不会给每个词单独建索引)
+# - 只追加了消息时只对新消息分词，词频增量用 ArrayUnion 追加到 search_tf_delta (每条带起始消息序号 "@"，
+#   防止内容相同被去重)，攒够 config.SEARCH_MAX_DELTAS 条或标题 / 行程变化时才整体重写 search_tf
+# - 搜索时只读各 chat 的 search_tf + search_tf_delta (见 db.load_search_index)，不读正文；之后保存时增量更新
+# - 排序: 先按命中的查询词个数，再按 BM25 分数
+
+CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"  # 日文假名 / 汉字 / 韩文
+_TOKEN_RE = re.compile(f"([{CJK}]+)|([^\\W_{CJK}]+)")
+_NOISE_RE = re.compile(r"!\[[^\]]*\]\([^)]*\)|https?://\S+")
+STOPWORDS = {
+    "the", "and", "for", "you", "your", "are", "is", "in", "of", "to", "on", "at", "it", "be", "an", "or", "with", "this", "that", "from",
+    "di", "dan", "yang", "ke", "untuk", "ini", "itu", "dengan", "ada", "saya", "la", "lah",
+}
+TITLE_WEIGHT = 3           # 标题里的词按出现 3 次算
+MAX_EXPANSIONS = 50        # 查询词不在词表里时，最多展开成多少个前缀匹配的词 (边打字边搜)
+BM25_K1, BM25_B = 1.2, 0.75
+
+def tokenize(text):
+    tokens = []
+    for cjk, word in _TOKEN_RE.findall(_NOISE_RE.sub(" ", str(text or "")).lower()):
+        if cjk:
+            tokens.extend([cjk] if len(cjk) == 1 else [cjk[i:i + 2] for i in range(len(cjk) - 1)])
+        elif len(word) >= 2 and word not in STOPWORDS:
+            tokens.append(word)
+    return tokens
+
+def chat_terms(chat):
+    """
+    一个 chat 的词频: 标题 (加权) + 行程正文 + 用户 / 助手消息 (工具输出和系统提示不算)
+    """
+    tf = Counter()
+    for _ in range(TITLE_WEIGHT):
+        tf.update(tokenize(chat.get("title")))
+    tf.update(tokenize(chat.get("itinerary_content")))
+    tf.update(message_terms(chat.get("messages")))
+    return tf
+
+def message_terms(messages):
+    tf = Counter()
+    for msg in messages or []:
+        if isinstance(msg, dict) and msg.get("role") in ("user", "assistant") and isinstance(msg.get("content"), str):
+            tf.update(tokenize(msg["content"]))
+    return tf
+
+def encode_terms(tf, max_terms=None):
+    # 词太多时只留词频最高的 (长对话的一次性噪声词先丢)
+    max_terms = max_terms or config.SEARCH_MAX_TERMS
+    return json.dumps(dict(Counter(tf).most_common(max_terms)), ensure_ascii=False, separators=(",", ":"))
+
+def decode_terms(raw):
+    try:
+        return json.loads(raw) if raw else {}
+    except ValueError:
+        return {}
+
+def encode_delta(seq, tf):
+    # seq: 这批消息的起始序号，只用来让每条 delta 字符串互不相同 (tokenize 不会产生 "@")
+    return json.dumps({"@": seq, **tf}, ensure_ascii=False, separators=(",", ":"))
+
+def merge_terms(raw, deltas):
+    """
+    search_tf + search_tf_delta -> 完整词频
+    """
+    tf = Counter(decode_terms(raw))
+    for delta in deltas or []:
+        delta = decode_terms(delta)
+        delta.pop("@", None)
+        tf.update(delta)
+    return tf
+
+class ChatSearchIndex:
+    def __init__(self):
+        self.docs = {}       # chat_id -> (title, 总词数, 包含的词)
+        self.postings = {}   # term -> {chat_id: 词频}
+        self.total_len = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def put(self, chat_id, title, tf):
+        self.remove(chat_id)
+        length = sum(tf.values())
+        self.docs[chat_id] = (title, length, tuple(tf))
+        self.total_len += length
+        for term, count in tf.items():
+            self.postings.setdefault(term, {})[chat_id] = count
+
+    def remove(self, chat_id):
+        if chat_id not in self.docs: return
+        _, length, terms = self.docs.pop(chat_id)
+        self.total_len -= length
+        for term in terms:
+            chats = self.postings[term]
+            del chats[chat_id]
+            if not chats: del self.postings[term]
+
+    def _expand(self, term):
+        if term in self.postings: return [term]
+        # 没有完全一致的词: 单个汉字找包含它的词，英文找前缀 (例如还没打完的 "mela")
+        if len(term) == 1:
+            matches = (t for t in self.postings if term in t)
+        else:
+            matches = (t for t in self.postings if t.startswith(term))
+        return [t for _, t in zip(range(MAX_EXPANSIONS), matches)]
+
+    def search(self, query, limit=10):
+        """
+        返回 [{"chat_id", "title", "score", "matched"}]，matched = 命中的查询词个数
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.docs: return []
+        n = len(self.docs)
+        avg_len = self.total_len / n or 1
+        scores, matched = Counter(), Counter()
+        for term in terms:
+            hit = set()
+            for t in self._expand(term):
+                chats = self.postings[t]
+                idf = math.log(1 + (n - len(chats) + 0.5) / (len(chats) + 0.5))
+                for chat_id, tf in chats.items():
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * self.docs[chat_id][1] / avg_len)
+                    scores[chat_id] += idf * tf * (BM25_K1 + 1) / norm
+                    hit.add(chat_id)
+            matched.update(hit)
+        ranked = sorted(scores, key=lambda c: (-matched[c], -scores[c]))[:limit]
+        return [{"chat_id": c, "title": self.docs[c][0], "score": round(scores[c], 3), "matched": matched[c]} for c in ranked]
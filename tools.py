@@ -1,23 +1,96 @@
+import asyncio
+import datetime
+import hashlib
 import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import as_completed
 import streamlit as st
-from serpapi import GoogleSearch
-import folium
 import config
-from utils import create_word_doc
-from openai import OpenAI  # 🟢 [新增] 引入 OpenAI 库用于分析
-from folium.plugins import AntPath, BeautifyIcon # 🟢 [新增] 引入高级地图插件
+import classifier
+import clients
+import quota
+import tracing
+from cache import geocode_cache, response_cache, params_key
+from poi import poi_index
+# 🟢 folium (~0.5s) 和 routing (numpy) 在画图 / 排路线时才导入，冷启动不加载
 
-# 🟢 [新增] 初始化 DeepSeek Client (专用于 tools 内部分析)
-try:
-    client = OpenAI(api_key=config.DEEPSEEK_API_KEY, base_url="https://api.deepseek.com")
-except Exception as e:
-    client = None
-    print(f"Tools Client Init Error: {e}")
+# ==========================================
+# 🟢 [新增] SerpAPI 统一入口 (带缓存)
+# ==========================================
+# 🟢 高峰期很多会话同时查同一个目的地: 缓存还没写进去之前，相同参数的请求由 single-flight 合并成一次
+serp_flights = clients.SingleFlight()
+
+SERP_NO_RESULTS = "hasn't returned any results"  # SerpAPI 查无结果时的 error 文案
+
+async def _fetch_and_store(params, key, priority=None):
+    # 写缓存也放在共享的请求里，避免"请求已结束、缓存还没写"的空档里又发一次
+    res = await clients.serpapi_get_async(params, priority)
+    # SerpAPI 出错时返回 {"error": ...}，不缓存
+    # 🟢 内存 LRU 直接写；SQLite 读写放到线程池，不阻塞共享事件循环上其他会话的请求
+    if key and "error" not in res:
+        response_cache.put_memory(key, params.get("engine"), res)
+        await asyncio.to_thread(response_cache.put_disk, key, params.get("engine"), res)
+    return res
+
+async def serp_search_async(params, use_cache=True, priority=None):
+    """
+    所有 SerpAPI 调用都走这里 (共享异步连接池 + 全局并发上限 + 额度调度，见 clients.serpapi_get_async)
+    按 (去掉 api_key 的) 参数做缓存，TTL 按 engine 区分 (见 config.SERP_CACHE_TTL_BY_ENGINE)
+    不走缓存的调用 (例如查坐标) 也参与 single-flight
+    priority 默认按 engine 取 (config.SERPAPI_PRIORITY_BY_ENGINE)；额度紧张时低优先级请求会抛 quota.Shed
+    """
+    key = params_key(params) if use_cache else None
+    with tracing.span("serpapi", engine=params.get("engine"), cache="off" if not key else "miss") as sp:
+        if key:
+            cached = response_cache.get_memory(key)
+            if cached is None:
+                cached = await asyncio.to_thread(response_cache.get_disk, key)
+            if cached is not None:
+                sp.set(cache="hit")
+                return cached
+
+        if config.SERPAPI_SINGLE_FLIGHT:
+            res, shared = await serp_flights.do(key or params_key(params), lambda: _fetch_and_store(params, key, priority))
+            if shared: sp.set(cache="coalesced")
+        else:
+            res = await _fetch_and_store(params, key, priority)
+        if "error" in res: sp.set(status="error")
+        return res
+
+def serp_flight_stats():
+    # 合并次数也会体现在 Prometheus 指标里: span="serpapi", cache="coalesced"
+    return serp_flights.stats()
+
+def serp_search(params, use_cache=True):
+    return clients.run_async(serp_search_async(params, use_cache))
+
+# ==========================================
+# 🟢 本地 POI 索引 (poi.py): 本地结果够新鲜 / 够多就不查 SerpAPI
+# ==========================================
+# SQLite 读写放到线程里跑，不占用共享事件循环 (其他会话的 SerpAPI 请求还在上面跑)
+async def _poi_lookup(op, search, *args, **kwargs):
+    """
+    返回本地地点列表；索引关闭 / 不够新鲜时返回 None (调用方查 SerpAPI 再 _poi_ingest)
+    """
+    if not config.POI_INDEX_ENABLED: return None
+    with tracing.span("poi", op=op, cache="miss") as sp:
+        places = await asyncio.to_thread(search, *args, **kwargs)
+        if places is not None: sp.set(cache="hit")
+        return places
+
+async def _poi_ingest(places, category, **where):
+    if not config.POI_INDEX_ENABLED: return
+    try:
+        await asyncio.to_thread(poi_index.ingest, places, category, **where)
+    except Exception as e:
+        # 索引写失败不影响本次回答
+        print(f"⚠️ [POI] ingest failed: {e}")
 
 # ==========================================
 # 🟢 核心修复: 带兜底的图片获取器
 # ==========================================
-def fetch_google_image(query):
+async def fetch_google_image_async(query):
     """
     Plan A: 去 Google Images 搜图 (只取 thumbnail 防止防盗链)
     """
@@ -32,8 +105,7 @@ def fetch_google_image(query):
         "num": 1
     }
     try:
-        search = GoogleSearch(params)
-        results = search.get_dict()
+        results = await serp_search_async(params)
         if "images_results" in results and len(results["images_results"]) > 0:
             return results["images_results"][0].get("thumbnail")
     except Exception as e:
@@ -41,6 +113,9 @@ def fetch_google_image(query):
         pass
     return None
 
+def fetch_google_image(query):
+    return clients.run_async(fetch_google_image_async(query))
+
 def format_image_markdown(title, img_url):
     """
     格式化为 Markdown 图片。
@@ -53,26 +128,82 @@ def format_image_markdown(title, img_url):
 # ==========================================
 # 工具函数 (排版已优化)
 # ==========================================
+# 🟢 [新增] 每个工具都有 async 版本 (xxx_async)，跑在共享事件循环上；
+# 同名的同步函数只负责 st.toast，然后把 async 版本交给 clients.run_async
+# (toast 文案和参数映射在 network_tool_call 里，ToolDispatch 并行执行时也用它)
 
 # 1. 机票搜索 (保持不变)
-def search_flights(origin, destination, date, return_date):
-    st.toast(f"✈️ Checking Flights: {origin}->{destination} ({date})") 
+def _flight_params(origin, destination, date, return_date):
+    return {"engine": "google_flights", "departure_id": origin, "arrival_id": destination, "outbound_date": date, "return_date": return_date, "currency": "MYR", "hl": "en", "api_key": config.SERPAPI_API_KEY, "type": "1"}
+
+async def search_flights_async(origin, destination, date, return_date, flex_days=0):
+    if flex_days:
+        return await search_flight_calendar_async(origin, destination, date, return_date, flex_days)
     print(f"[后台] 查机票 {origin}-{destination} ({date})")
-    params = {"engine": "google_flights", "departure_id": origin, "arrival_id": destination, "outbound_date": date, "return_date": return_date, "currency": "MYR", "hl": "en", "api_key": config.SERPAPI_API_KEY, "type": "1"}
+    params = _flight_params(origin, destination, date, return_date)
     try:
-        res = GoogleSearch(params).get_dict()
+        res = await serp_search_async(params)
         if "best_flights" not in res: return f"RESULT: No specific flights found for {date}."
         f = res['best_flights'][0]
         return json.dumps({"date": date, "airline": f['flights'][0]['airline'], "price_per_adult": f['price'], "duration": f['total_duration']})
     except: return f"Error searching flights for {date}"
 
+def search_flights(origin, destination, date, return_date, flex_days=0):
+    return _run_network_tool("search_flights", {"origin": origin, "destination": destination, "date": date, "return_date": return_date, "flex_days": flex_days})
+
+# 🟢 [新增] 价格日历: "三月哪周最便宜" 一次工具调用查完 ±N 天，不用 LLM 一天一天地问
+def _cheapest_flight(res):
+    options = res.get("best_flights", []) + res.get("other_flights", [])
+    priced = [f for f in options if isinstance(f.get("price"), (int, float))]
+    if not priced: return None
+    f = min(priced, key=lambda f: f["price"])
+    return {"price": f["price"], "airline": f["flights"][0]["airline"], "duration": f.get("total_duration")}
+
+async def _flight_day_async(origin, destination, date, return_date):
+    try:
+        return _cheapest_flight(await serp_search_async(_flight_params(origin, destination, date, return_date)))
+    except Exception as e:
+        print(f"⚠️ Flight calendar {date} failed: {e}")
+        return None
+
+async def search_flight_calendar_async(origin, destination, date, return_date, flex_days):
+    """
+    出发日前后各 flex_days 天 (返程日同步平移，行程天数不变)，所有日期并发查询
+    (同样的参数会命中响应缓存 / single-flight，所以重复查同一个窗口基本不花额度)
+    返回 JSON: {"calendar": {出发日: {"price", "airline", "duration"} 或 null}, "cheapest": {...}}
+    """
+    try:
+        start = datetime.date.fromisoformat(date)
+        back = datetime.date.fromisoformat(return_date) if return_date else None
+        flex_days = max(1, min(int(flex_days), config.FLIGHT_FLEX_MAX_DAYS))
+    except ValueError:
+        return "Error: date / return_date must be YYYY-MM-DD and flex_days an integer"
+    today = datetime.date.today()
+    days = [start + datetime.timedelta(days=k) for k in range(-flex_days, flex_days + 1)]
+    days = [d for d in days if d >= today]  # 过去的日期不查
+    if not days: return f"RESULT: All dates around {date} are in the past."
+    print(f"[后台] 查机票日历 {origin}-{destination} ({days[0]} ~ {days[-1]})")
+
+    shift = lambda d: (back + (d - start)).isoformat() if back else None
+    found = await asyncio.gather(*(_flight_day_async(origin, destination, d.isoformat(), shift(d)) for d in days))
+    calendar = {d.isoformat(): entry for d, entry in zip(days, found)}
+    priced = [(d, entry) for d, entry in calendar.items() if entry]
+    if not priced: return f"RESULT: No specific flights found between {days[0]} and {days[-1]}."
+    cheapest_date, cheapest = min(priced, key=lambda item: item[1]["price"])
+    return json.dumps({
+        "route": f"{origin}-{destination}",
+        "trip_days": (back - start).days if back else None,
+        "currency": "MYR",
+        "calendar": calendar,
+        "cheapest": {"date": cheapest_date, "return_date": shift(datetime.date.fromisoformat(cheapest_date)), **cheapest},
+    }, ensure_ascii=False)
+
 # 2. 酒店搜索 (🟢 优化排版：标题 -> 图片 -> 价格)
-def search_hotels(city, check_in_date, check_out_date, adults):
-    st.toast(f"🏨 Checking Hotels: {city}")
+async def search_hotels_async(city, check_in_date, check_out_date, adults):
     search_type = "Vacation Rentals" if adults > 2 else "Hotels"
     params = {"engine": "google_hotels", "q": f"{city} {search_type}", "check_in_date": check_in_date, "check_out_date": check_out_date, "adults": adults, "currency": "MYR", "hl": "en", "gl": "my", "api_key": config.SERPAPI_API_KEY}
     try:
-        res = GoogleSearch(params).get_dict()
+        res = await serp_search_async(params)
         hotels = []
         if "properties" in res:
             for h in res["properties"][:3]:
@@ -80,10 +211,10 @@ def search_hotels(city, check_in_date, check_out_date, adults):
                 price = h.get("rate_per_night", {}).get("lowest", "N/A")
                 
                 # 🟡 尝试 1: 精准搜
-                safe_img = fetch_google_image(f"{name} {city} hotel building")
+                safe_img = await fetch_google_image_async(f"{name} {city} hotel building")
                 # 🟡 尝试 2: 兜底搜
                 if not safe_img:
-                    safe_img = fetch_google_image(f"{name} {city}")
+                    safe_img = await fetch_google_image_async(f"{name} {city}")
 
                 img_md = format_image_markdown(name, safe_img)
                 
@@ -97,22 +228,29 @@ def search_hotels(city, check_in_date, check_out_date, adults):
         print(f"Error: {e}") 
         return "Error searching hotels"
 
+def search_hotels(city, check_in_date, check_out_date, adults):
+    return _run_network_tool("search_hotels", {"city": city, "check_in_date": check_in_date, "check_out_date": check_out_date, "adults": adults})
+
 # 3. 景点搜索 (🟢 优化排版：标题 -> 图片 -> 评分)
-def search_attractions(city, keyword=None):
-    st.toast(f"🎡 Checking Sights: {city}")
+async def search_attractions_async(city, keyword=None):
     q = f"top sights in {city}" if not keyword else f"best {keyword} in {city}"
     params = {"engine": "google_maps", "q": q, "type": "search", "hl": "en", "api_key": config.SERPAPI_API_KEY}
     try:
-        res = GoogleSearch(params).get_dict()
+        places = await _poi_lookup("area", poi_index.search_area, city, "attraction", keyword, limit=10)
+        if places is None:
+            res = await serp_search_async(params)
+            places = res.get("local_results", [])
+            if "error" not in res:  # 额度用完 / 限流时不能记成"这个区域已覆盖"
+                await _poi_ingest(places, "attraction", area=city, keyword=keyword)
         results = []
         # 保持你想要的 10 个结果
-        for r in res.get("local_results", [])[:10]:
+        for r in places[:10]:
             title = r.get('title', 'Unknown')
             rating = r.get('rating', 'N/A')
             
             # 双重保险找图
             original_thumb = r.get("thumbnail")
-            high_res_img = fetch_google_image(f"{title} {city} scenery")
+            high_res_img = await fetch_google_image_async(f"{title} {city} scenery")
             final_img = high_res_img if high_res_img else original_thumb
             
             img_md = format_image_markdown(title, final_img)
@@ -124,13 +262,29 @@ def search_attractions(city, keyword=None):
         return "\n\n---\n\n".join(results)
     except: return "Error searching attractions"
 
-# 4. 美食搜索 (保持不变，因为之前已经优化过 Header Image 了)
-def search_restaurants(city, food_type):
-    st.toast(f"🍜 Checking Food: {food_type} in {city}")
-    universal_food_image = fetch_google_image(f"{food_type} {city} close up food")
+def search_attractions(city, keyword=None):
+    return _run_network_tool("search_attractions", {"city": city, "keyword": keyword})
+
+# 4. 美食搜索 (🟢 near: 某个地点附近，例如酒店)
+async def search_restaurants_async(city, food_type, near=None):
+    universal_food_image = await fetch_google_image_async(f"{food_type} {city} close up food")
     params = {"engine": "google_maps", "q": f"best {food_type} in {city}", "type": "search", "hl": "en", "api_key": config.SERPAPI_API_KEY}
     try:
-        res = GoogleSearch(params).get_dict()
+        center = None
+        if near:
+            lat, lng, _ = await get_coordinates_async(f"{near}, {city}")
+            if lat and lng:
+                center = (lat, lng)
+                params.update(q=f"{food_type} near {near}, {city}", ll=f"@{lat},{lng},15z")
+        if center:
+            places = await _poi_lookup("nearby", poi_index.search_nearby, *center, config.POI_NEARBY_RADIUS_KM, "restaurant", food_type, limit=3)
+        else:
+            places = await _poi_lookup("area", poi_index.search_area, city, "restaurant", food_type, limit=3)
+        if places is None:
+            res = await serp_search_async(params)
+            places = res.get("local_results", [])
+            if "error" not in res:
+                await _poi_ingest(places, "restaurant", area=city, keyword=food_type, near=center)
         results = []
         if universal_food_image:
             header_image = format_image_markdown(f"{food_type} Image", universal_food_image)
@@ -140,105 +294,254 @@ def search_restaurants(city, food_type):
         else:
             results.append(f"### 🍽️ {food_type} in {city}\n**Recommended Places:**\n")
         
-        for r in res.get("local_results", [])[:3]: 
+        for r in places[:3]: 
             title = r.get('title')
             rating = r.get('rating', 'N/A')
             address = r.get('address', '')
-            results.append(f"- **{title}** ({rating}⭐)\n  📍 {address}")
+            distance = f" ({r['distance_km']} km)" if r.get("distance_km") is not None else ""
+            results.append(f"- **{title}** ({rating}⭐)\n  📍 {address}{distance}")
         return "\n".join(results)
     except: return "Error searching food"
 
+def search_restaurants(city, food_type, near=None):
+    return _run_network_tool("search_restaurants", {"city": city, "food_type": food_type, "near": near})
+
 # 5. 通用搜索 (保持不变)
-def search_general_web(query):
-    st.toast(f"🧠 Brain: Googling '{query}'...")
+async def search_general_web_async(query):
     params = {"engine": "google", "q": query, "hl": "en", "gl": "my", "api_key": config.SERPAPI_API_KEY}
     try:
-        res = GoogleSearch(params).get_dict()
+        res = await serp_search_async(params)
         snippets = [f"- {r.get('title')}: {r.get('snippet')}" for r in res.get("organic_results", [])[:3]]
         return "\n".join(snippets) if snippets else "No web results found."
     except: return "Web search error."
 
+def search_general_web(query):
+    return _run_network_tool("search_general_web", {"query": query})
+
 # --- 辅助函数：获取经纬度 (🟢 全面升级版: 列表+详情页双重检测) ---
-def get_coordinates(location):
+async def get_coordinates_async(location):
+    # 🟢 [新增] 先查本地持久化缓存 (含负缓存)
+    with tracing.span("geocode", cache="miss") as sp:
+        cached = await asyncio.to_thread(geocode_cache.get, location)
+        if cached is not None: sp.set(cache="hit" if cached[0] is not None else "negative")
+    if cached is not None:
+        return cached
+
     print(f"🔍 Searching coordinates for: {location}")
     params = {"engine": "google_maps", "q": location, "type": "search", "api_key": config.SERPAPI_API_KEY}
     try:
-        res = GoogleSearch(params).get_dict()
+        res = await serp_search_async(params, use_cache=False)
+
+        # 🟢 SerpAPI 出错 (额度用完 / Key 无效 / 上游故障) 也是 {"error": ...}: 不做负缓存，下次还会重试
+        # 只有 "没有结果" 这一种 error 才是真的查不到
+        if "error" in res and SERP_NO_RESULTS not in str(res["error"]):
+            print(f"⚠️ Coord Error for {location}: {res['error']}")
+            return None, None, location
         
         # 🟢 情况 1: Google 返回了一个列表 (local_results)
         if "local_results" in res and res["local_results"]:
+            await _poi_ingest(res["local_results"], "place")  # 顺带收进本地 POI 索引
             gps = res["local_results"][0].get("gps_coordinates", {})
-            return gps.get("latitude"), gps.get("longitude"), res["local_results"][0].get("title", location)
+            lat, lng, title = gps.get("latitude"), gps.get("longitude"), res["local_results"][0].get("title", location)
             
         # 🟢 情况 2: Google 直接返回了详情页 (place_results) -> 这就是你缺失的部分！
-        if "place_results" in res:
+        elif "place_results" in res:
+            await _poi_ingest([res["place_results"]], "place")
             gps = res["place_results"].get("gps_coordinates", {})
             title = res["place_results"].get("title", location)
-            return gps.get("latitude"), gps.get("longitude"), title
+            lat, lng = gps.get("latitude"), gps.get("longitude")
+
+        else:
+            lat, lng, title = None, None, location
+
+        if lat and lng:
+            await asyncio.to_thread(geocode_cache.put, location, lat, lng, title)
+        else:
+            await asyncio.to_thread(geocode_cache.put_negative, location)
+        return lat, lng, title
             
     except Exception as e:
+        # 网络/额度错误不做负缓存，下次还会重试
         print(f"⚠️ Coord Error for {location}: {e}")
         pass
     return None, None, location
 
+async def get_coordinates_many_async(locations):
+    return await asyncio.gather(*(get_coordinates_async(loc) for loc in locations))
+
+def get_coordinates(location):
+    return clients.run_async(get_coordinates_async(location))
+
 # 2. 交通查询
-def get_directions(start_lat, start_lng, end_lat, end_lng):
-    start = f"{start_lat},{start_lng}"
-    end = f"{end_lat},{end_lng}"
-    results = {
-        "0": {"icon": "🚗", "text": "驾车", "time": "N/A", "details": ""},
-        "3": {"icon": "🚇", "text": "公交", "time": "N/A", "details": ""},
-        "2": {"icon": "🚶", "text": "步行", "time": "N/A", "details": ""}
-    }
-    for mode_code, info in results.items():
-        params = {"engine": "google_maps_directions", "start_coords": start, "end_coords": end, "travel_mode": mode_code, "api_key": config.SERPAPI_API_KEY}
-        try:
-            res = GoogleSearch(params).get_dict()
-            if "directions" in res and res["directions"]:
-                route = res["directions"][0]
-                results[mode_code]["time"] = route.get("formatted_duration", "N/A")
-                if mode_code == "3" and "legs" in route:
-                    steps = route["legs"][0].get("steps", [])
-                    transit_segs = [s["transit_details"]["line"]["short_name"] for s in steps if s.get("travel_mode") == "TRANSIT" and "transit_details" in s]
-                    if transit_segs: results[mode_code]["details"] = f" ➤ [{' > '.join(transit_segs)}]"
-        except: pass
+# 三种出行方式: mode_code -> (图标, 文字)
+TRAVEL_MODES = {"0": ("🚗", "驾车"), "3": ("🚇", "公交"), "2": ("🚶", "步行")}
+def _directions_params(start, end, mode_code):
+    return {"engine": "google_maps_directions", "start_coords": start, "end_coords": end, "travel_mode": mode_code, "api_key": config.SERPAPI_API_KEY}
+
+# 🟢 [新增] 按直线距离裁剪出行方式 (config.TRAVEL_MODE_POLICY)，被裁掉的方式标记为 skipped
+DIRECTION_STATS = {"legs": 0, "requested": 0, "skipped": 0}
+_direction_stats_lock = threading.Lock()
+
+def modes_for_distance(km):
+    modes = []
+    for code in TRAVEL_MODES:
+        low, high = config.TRAVEL_MODE_POLICY.get(code, (None, None))
+        if (low is None or km >= low) and (high is None or km <= high):
+            modes.append(code)
+    return modes or [config.TRAVEL_MODE_FALLBACK]
+
+def direction_stats():
+    with _direction_stats_lock:
+        return dict(DIRECTION_STATS)
+
+def _direction_gauges():
+    # legs: 路段数；requested: 实际查询的 (路段, 方式)；skipped: 按距离策略省掉的查询
+    return [("agent_direction_queries", {"kind": name}, value) for name, value in direction_stats().items()]
+
+tracing.register_gauges(_direction_gauges)
+
+def cached_drive_seconds(pairs):
+    """
+    pairs: {(i, j): (start, end)}，只从响应缓存里找驾车时长 (秒)，不会发请求
+    返回 {(i, j): seconds}
+    """
+    keys = {pair: params_key(_directions_params(start, end, "0")) for pair, (start, end) in pairs.items()}
+    found = response_cache.peek_many(list(keys.values()))
+    known = {}
+    for pair, key in keys.items():
+        res = found.get(key)
+        if res and res.get("directions"):
+            duration = res["directions"][0].get("duration")
+            if isinstance(duration, (int, float)):
+                known[pair] = duration
+    return known
+
+async def _fetch_direction_async(start, end, mode_code):
+    """
+    查询单个路段的单一出行方式，返回 (time, details)
+    """
+    params = _directions_params(start, end, mode_code)
+    # 🟢 驾车时间是路线的主要信息，按普通优先级；公交 / 步行是锦上添花，额度紧张时先跳过
+    priority = quota.NORMAL if mode_code == "0" else None
+    try:
+        res = await serp_search_async(params, priority=priority)
+        if "directions" in res and res["directions"]:
+            route = res["directions"][0]
+            details = ""
+            if mode_code == "3" and "legs" in route:
+                steps = route["legs"][0].get("steps", [])
+                transit_segs = [s["transit_details"]["line"]["short_name"] for s in steps if s.get("travel_mode") == "TRANSIT" and "transit_details" in s]
+                if transit_segs: details = f" ➤ [{' > '.join(transit_segs)}]"
+            return route.get("formatted_duration", "N/A"), details
+    except quota.Shed:
+        return "⏭️ 高峰期已跳过", ""
+    except: pass
+    return "N/A", ""
+
+def _skipped_str(code, result):
+    icon, label = TRAVEL_MODES[code]
+    return f"{icon} {label}: ⏭️ 已跳过 (直线 {result.get('km', 0):.1f} km)"
+
+def _format_directions(results):
     line1 = f"🚗 **驾车**: {results['0']['time']}" if results["0"]["time"] != "N/A" else "🚗 驾车: 无法到达"
     transit_str = f"🚇 **公交**: {results['3']['time']}{results['3']['details']}" if results["3"]["time"] != "N/A" else "🚇 公交: N/A"
     walk_str = f"🚶 **步行**: {results['2']['time']}" if results["2"]["time"] != "N/A" else "🚶 步行: N/A"
+    if results["0"].get("skipped"): line1 = _skipped_str("0", results["0"])
+    if results["3"].get("skipped"): transit_str = _skipped_str("3", results["3"])
+    if results["2"].get("skipped"): walk_str = _skipped_str("2", results["2"])
     
     # 🟢 [修复] 定义 line2，修复 NameError
     line2 = f"{transit_str} | {walk_str}"
     
     return f"{line1}\n\n{line2}"
 
-def generate_map_with_traffic(locations_list):
-    if len(locations_list) < 1: return "Need at least 1 location."
-    st.toast(f"🗺️ Visualizing Route: {', '.join(locations_list)}...")
-    
-    # 1. 获取坐标
-    coords = []
-    for loc in locations_list:
-        lat, lng, name = get_coordinates(loc)
-        if lat and lng: 
-            coords.append([lat, lng, name])
-        else:
-            # 🟢 [新增] 如果找不到，在界面上弹窗警告
-            st.warning(f"⚠️ 无法找到地点: '{loc}'，已自动跳过。")
-            print(f"❌ Failed to find: {loc}")
-    
-    if not coords: return "Could not find valid coordinates for any location."
-    if len(coords) < 2: 
-        st.warning("⚠️ 只找到了 1 个有效地点，无法绘制路线。请尝试提供更准确的地点名称。")
+async def fetch_directions_batch_async(legs):
+    """
+    🟢 [新增] 批量路线引擎
+    legs: [(start_lat, start_lng, end_lat, end_lng), ...]
+    把所有 (路段, 出行方式) 请求一次性并发发出 (受全局 SerpAPI 并发上限限制)，
+    按路线顺序返回每段的 {mode_code: {"time", "details"}}
+    距离策略裁掉的方式不发请求，返回 {"time": "N/A", "details": "", "skipped": True, "km": 直线距离}
+    """
+    import routing
+    jobs = []
+    leg_modes = []
+    for start_lat, start_lng, end_lat, end_lng in legs:
+        start = f"{start_lat},{start_lng}"
+        end = f"{end_lat},{end_lng}"
+        km = routing.haversine_km(start_lat, start_lng, end_lat, end_lng)
+        modes = modes_for_distance(km)
+        leg_modes.append((km, modes))
+        for mode_code in modes:
+            jobs.append(_fetch_direction_async(start, end, mode_code))
+
+    skipped = len(legs) * len(TRAVEL_MODES) - len(jobs)
+    with _direction_stats_lock:
+        DIRECTION_STATS["legs"] += len(legs)
+        DIRECTION_STATS["requested"] += len(jobs)
+        DIRECTION_STATS["skipped"] += skipped
+    if skipped:
+        print(f"[Directions] policy skipped {skipped}/{len(legs) * len(TRAVEL_MODES)} calls (total saved: {DIRECTION_STATS['skipped']})")
+    answers = iter(await asyncio.gather(*jobs))
+
+    leg_results = []
+    for km, modes in leg_modes:
+        results = {}
+        for code in TRAVEL_MODES:
+            if code in modes:
+                results[code] = dict(zip(("time", "details"), next(answers)))
+            else:
+                results[code] = {"time": "N/A", "details": "", "skipped": True, "km": round(km, 2)}
+        leg_results.append(results)
+    return leg_results
+
+def fetch_directions_batch(legs):
+    return clients.run_async(fetch_directions_batch_async(legs))
+
+def get_directions_batch(legs):
+    return [_format_directions(results) for results in fetch_directions_batch(legs)]
+
+async def get_directions_async(start_lat, start_lng, end_lat, end_lng):
+    results = await fetch_directions_batch_async([(start_lat, start_lng, end_lat, end_lng)])
+    return _format_directions(results[0])
+
+def get_directions(start_lat, start_lng, end_lat, end_lng):
+    return clients.run_async(get_directions_async(start_lat, start_lng, end_lat, end_lng))
 
+# ==========================================
+# 🟢 [新增] 路线规格 (route spec)
+# ==========================================
+# 聊天记录里只存一份很小的路线描述，不再存整页 folium HTML:
+# {"points": [{"lat", "lng", "name"}, ...], "legs": [{mode_code: {"time", "details"}}, ...]}
+# (Firestore 不支持嵌套数组，所以都用 dict)
+
+def route_spec_hash(spec):
+    raw = json.dumps(spec, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def format_traffic_data(spec):
+    traffic_info = []
+    points = spec["points"]
+    for i, leg in enumerate(spec["legs"]):
+        traffic_info.append(f"🚩 **{points[i]['name']} ➡️ {points[i+1]['name']}**")
+        traffic_info.append(_format_directions(leg))
+    return "\n\n".join(traffic_info)
+
+def build_route_map(spec):
+    """
+    根据路线规格画 folium 地图 (标记 + 蚂蚁行军路线)
+    """
+    import folium
+    from folium.plugins import AntPath # 🟢 [新增] 引入高级地图插件
+    points = spec["points"]
     # 2. 创建地图中心
-    m = folium.Map(location=[coords[0][0], coords[0][1]], zoom_start=13)
+    m = folium.Map(location=[points[0]["lat"], points[0]["lng"]], zoom_start=13)
 
     # 3. 绘制路线和标记
     route_points = [] # 只存纯经纬度用于画线
-    traffic_info = []
 
-    for i in range(len(coords)):
-        lat, lng, name = coords[i]
+    for i, point in enumerate(points):
+        lat, lng, name = point["lat"], point["lng"], point["name"]
         route_points.append([lat, lng])
         
         # 🟢 [升级] 智能图标样式
@@ -249,7 +552,7 @@ def generate_map_with_traffic(locations_list):
             icon_color = 'green'
             icon_shape = 'play'
             marker_html = f'<div style="font-size: 12pt; color: white; text-align: center;">🚀</div>'
-        elif i == len(coords) - 1:
+        elif i == len(points) - 1:
             icon_color = 'red'
             icon_shape = 'flag'
             marker_html = f'<div style="font-size: 12pt; color: white; text-align: center;">🏁</div>'
@@ -287,13 +590,6 @@ def generate_map_with_traffic(locations_list):
             icon=icon
         ).add_to(m)
 
-        # 4. 计算路段信息 (保持原有逻辑)
-        if i < len(coords) - 1:
-            next_lat, next_lng, next_name = coords[i+1]
-            travel_str = get_directions(lat, lng, next_lat, next_lng)
-            traffic_info.append(f"🚩 **{name} ➡️ {next_name}**")
-            traffic_info.append(travel_str)
-
     # 🟢 [核心升级] 蚂蚁行军路线 (AntPath)
     # 这会在地图上画出一条流动的虚线，指示方向，非常有科技感
     AntPath(
@@ -305,16 +601,86 @@ def generate_map_with_traffic(locations_list):
         weight=5,
         opacity=0.8
     ).add_to(m)
+    return m
+
+# 渲染好的 HTML 按 spec hash 缓存 (进程级，所有会话共享)
+ROUTE_HTML_CACHE_SIZE = 32
+_route_html_cache = OrderedDict()
+_route_html_lock = threading.Lock()
+
+def render_route_html(spec):
+    """
+    打开历史对话时才按规格重建地图，同一路线只渲染一次
+    """
+    key = route_spec_hash(spec)
+    with _route_html_lock:
+        html = _route_html_cache.get(key)
+        if html is not None:
+            _route_html_cache.move_to_end(key)
+            return html
+
+    with tracing.span("folium.render", op="route_html", stops=len(spec["points"])) as sp:
+        html = build_route_map(spec).get_root().render()
+        sp.set(bytes=len(html))
+    with _route_html_lock:
+        _route_html_cache[key] = html
+        while len(_route_html_cache) > ROUTE_HTML_CACHE_SIZE:
+            _route_html_cache.popitem(last=False)
+    return html
+
+def optimize_stops(coords, keep_first=True):
+    """
+    🟢 [新增] 按估计驾车时间重排访问顺序 (haversine + 已缓存的真实时长, 最近邻 + 2-opt)
+    coords: [[lat, lng, name], ...]
+    """
+    import routing
+    keys = [f"{lat},{lng}" for lat, lng, _ in coords]
+    pairs = {(i, j): (keys[i], keys[j]) for i in range(len(keys)) for j in range(len(keys)) if i != j}
+    known = cached_drive_seconds(pairs)
+    order, before, after = routing.optimize_order([(c[0], c[1]) for c in coords], keep_first, known)
+    print(f"[Route] optimized order {order}: ~{before / 60:.0f} min -> ~{after / 60:.0f} min")
+    return [coords[i] for i in order]
+
+def generate_map_with_traffic(locations_list, optimize_route=False, keep_first_stop=True):
+    if len(locations_list) < 1: return "Need at least 1 location."
+    st.toast(f"🗺️ Visualizing Route: {', '.join(locations_list)}...")
+    
+    # 1. 获取坐标 (🟢 所有地点并发查询)
+    coords = []
+    located = clients.run_async(get_coordinates_many_async(locations_list))
+    for loc, (lat, lng, name) in zip(locations_list, located):
+        if lat and lng: 
+            coords.append([lat, lng, name])
+        else:
+            # 🟢 [新增] 如果找不到，在界面上弹窗警告
+            st.warning(f"⚠️ 无法找到地点: '{loc}'，已自动跳过。")
+            print(f"❌ Failed to find: {loc}")
+    
+    if not coords: return "Could not find valid coordinates for any location."
+    if len(coords) < 2: 
+        st.warning("⚠️ 只找到了 1 个有效地点，无法绘制路线。请尝试提供更准确的地点名称。")
+
+    # 🟢 [新增] 可选: 优化访问顺序，避免来回折返
+    if optimize_route and len(coords) > 2:
+        coords = optimize_stops(coords, keep_first_stop)
+
+    # 2. 所有路段的交通信息一次性并发查询
+    legs = [(coords[i][0], coords[i][1], coords[i+1][0], coords[i+1][1]) for i in range(len(coords) - 1)]
+    spec = {
+        "points": [{"lat": lat, "lng": lng, "name": name} for lat, lng, name in coords],
+        "legs": fetch_directions_batch(legs),
+    }
 
     # 保存数据
-    st.session_state["map_data"] = m
-    st.session_state["traffic_data"] = "\n\n".join(traffic_info)
+    st.session_state["route_spec"] = spec
+    st.session_state["traffic_data"] = format_traffic_data(spec)
+    if optimize_route:
+        return "Map Generated with Animated Route! Optimized visiting order: " + " -> ".join(c[2] for c in coords)
     return "Map Generated with Animated Route!"
 
-# 👇 保存函数 (保持不变)
+# 👇 保存函数 (🟢 docx 推迟到点击下载时再生成)
 def save_itinerary(content):
-    doc_buffer = create_word_doc(content)
-    st.session_state["download_buffer"] = doc_buffer
+    st.session_state["download_content"] = content
     if st.session_state["current_chat_id"] is not None:
         chat_id = st.session_state["current_chat_id"]
         if 0 <= chat_id < len(st.session_state["chat_history"]):
@@ -327,16 +693,20 @@ def save_itinerary(content):
 # ==========================================
 # 🟢 [新增] AI 自动分析偏好
 # ==========================================
-def analyze_preferences_from_chat(messages):
+# 🟢 [新增] 本地分类器能拿准就不调用 LLM
+PREF_STATS = {"local": 0, "llm": 0}
+
+def analyze_preferences_from_chat(messages, strict=False):
     """
     分析聊天记录，提取用户的潜在偏好标签
+    strict=True 时 LLM 出错直接抛出 (后台 worker 据此判断这次分析没完成，下次重试)，否则退回本地标签
     """
-    if not client: return []
     if not messages or len(messages) < 2:
         return []
 
     # 把聊天记录压缩成一段文本
     conversation_text = ""
+    user_text = ""
     for msg in messages:
         # 兼容 dict 和 object
         if isinstance(msg, dict):
@@ -349,13 +719,26 @@ def analyze_preferences_from_chat(messages):
         # 只看用户的发言和 AI 的核心建议
         if role in ["user", "assistant"] and content:
             conversation_text += f"{role}: {content}\n"
+        if role == "user" and content:
+            user_text += f"{content}\n"
+
+    # 🟢 [新增] 先用本地关键词分类器 (只看用户发言)，置信度够就直接返回
+    local_tags, confidence, _ = classifier.classify(user_text)
+    if confidence >= config.PREF_LOCAL_CONFIDENCE:
+        PREF_STATS["local"] += 1
+        return local_tags
+    PREF_STATS["llm"] += 1
+
+    # 🟢 [修改] 使用进程级共享的 DeepSeek 客户端
+    try:
+        client = clients.get_llm_client()
+    except Exception as e:
+        print(f"Tools Client Init Error: {e}")
+        if strict: raise
+        return local_tags
 
     # 预定义的标签池
-    valid_tags = ["🍱 美食 (Foodie)", "💆‍♂️ 放松 (Relax)", "🌲 大自然 (Nature)", 
-                  "🛍️ 购物 (Shopping)", "🏛️ 历史 (History)", "🎒 穷游 (Budget)", 
-                  "💎 奢华 (Luxury)", "👨‍👩‍👧‍👦 亲子 (Family)", "📸 拍照打卡 (Insta-worthy)"]
-    
-    tags_str = ", ".join(valid_tags)
+    tags_str = ", ".join(classifier.VALID_TAGS)
 
     prompt = f"""
     Analyze the following travel conversation. 
@@ -373,11 +756,14 @@ def analyze_preferences_from_chat(messages):
     """
 
     try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.1
-        )
+        with tracing.span("llm", op="preferences", model="deepseek-chat") as sp:
+            response = client.chat.completions.create(
+                model="deepseek-chat",
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.1
+            )
+            if response.usage:
+                sp.set(tokens_in=response.usage.prompt_tokens, tokens_out=response.usage.completion_tokens)
         content = response.choices[0].message.content
         
         # 清洗数据
@@ -385,19 +771,139 @@ def analyze_preferences_from_chat(messages):
             content = content.replace("```json", "").replace("```", "")
         
         extracted_tags = json.loads(content)
-        return extracted_tags if isinstance(extracted_tags, list) else []
+        extracted_tags = extracted_tags if isinstance(extracted_tags, list) else []
+        return local_tags + [tag for tag in extracted_tags if tag not in local_tags]
     except Exception as e:
         print(f"Error analyzing chat: {e}")
-        return []
+        if strict: raise
+        return local_tags
+
+# ==========================================
+# 🟢 [新增] 并行工具调度器
+# ==========================================
+# 会写 st.session_state 的工具，必须留在 Streamlit 主脚本线程执行
+MAIN_THREAD_TOOLS = {"save_itinerary", "generate_map_with_traffic"}
+# 其余都是网络类工具: 在共享事件循环上执行，见 network_tool_call
+NETWORK_TOOLS = {"search_flights", "search_hotels", "search_attractions", "search_restaurants", "search_general_web"}
+
+def network_tool_call(fn, args):
+    """
+    网络类工具: 返回 (toast 文案, 协程)；其他工具返回 None
+    """
+    if fn == "search_flights":
+        flex_days = args.get("flex_days", 0)
+        window = f" ±{flex_days}d" if flex_days else ""
+        return (f"✈️ Checking Flights: {args['origin']}->{args['destination']} ({args['date']}{window})",
+                search_flights_async(args["origin"], args["destination"], args["date"], args.get("return_date"), flex_days))
+    if fn == "search_hotels":
+        return f"🏨 Checking Hotels: {args['city']}", search_hotels_async(args["city"], args["check_in_date"], args.get("check_out_date"), args.get("adults", 1))
+    if fn == "search_attractions":
+        return f"🎡 Checking Sights: {args['city']}", search_attractions_async(args["city"], args.get("keyword"))
+    if fn == "search_restaurants":
+        return f"🍜 Checking Food: {args.get('food_type')} in {args['city']}", search_restaurants_async(args["city"], args.get("food_type"), args.get("near"))
+    if fn == "search_general_web":
+        return f"🧠 Brain: Googling '{args['query']}'...", search_general_web_async(args["query"])
+    return None
+
+def _run_network_tool(fn, args):
+    toast, coro = network_tool_call(fn, args)
+    st.toast(toast)
+    return clients.run_async(coro)
+
+def run_tool(fn, args):
+    """
+    按名称执行单个工具 (原 app.py 里的 if/elif 分发)
+    """
+    if fn in NETWORK_TOOLS: return _run_network_tool(fn, args)
+    if fn == "save_itinerary": return save_itinerary(args["content"])
+    if fn == "generate_map_with_traffic": return generate_map_with_traffic(args["locations_list"], args.get("optimize_route", False), args.get("keep_first_stop", True))
+    return None
+
+def _run_tool_safely(fn, args):
+    with tracing.span("tool", tool=fn) as sp:
+        try:
+            res = run_tool(fn, args)
+            sp.set(result_chars=len(str(res)) if res is not None else 0)
+            return res
+        except Exception as e:
+            sp.set(error=type(e).__name__)
+            print(f"❌ Tool {fn} failed: {e}")
+            return f"Error running {fn}: {e}"
+
+async def _run_tool_async(fn, coro):
+    # 和 _run_tool_safely 一样记 span / 吞异常，只是跑在共享事件循环上
+    with tracing.span("tool", tool=fn) as sp:
+        try:
+            res = await coro
+            sp.set(result_chars=len(str(res)) if res is not None else 0)
+            return res
+        except Exception as e:
+            sp.set(error=type(e).__name__)
+            print(f"❌ Tool {fn} failed: {e}")
+            return f"Error running {fn}: {e}"
+
+class ToolDispatch:
+    """
+    同时执行同一轮 LLM 返回的多个 tool_calls
+    - submit(): 参数一完整就把网络类工具的协程提交到共享事件循环 (流式模式下边收边跑)，
+      不占线程: 所有会话的工具调用只受 SerpAPI 并发上限和额度调度 (按用户轮流) 约束
+    - collect(): MAIN_THREAD_TOOLS 在主线程执行 (与事件循环上的请求重叠)，
+      on_done(fn, res) 在主线程按完成顺序回调，用于刷新 status_container
+    - 返回值按 submit 的顺序排列，保证 tool_call_id 顺序不变
+    """
+
+    def __init__(self):
+        self._jobs = []  # [(fn, args, future 或 None)]
+
+    def submit(self, fn, arguments):
+        try:
+            args = json.loads(arguments or "{}")
+        except ValueError:
+            args = {}
+        future = None
+        try:
+            call = network_tool_call(fn, args)
+        except Exception:
+            call = None  # 参数缺失等: 留给 collect 里的 _run_tool_safely 报错
+        if call is not None:
+            toast, coro = call
+            st.toast(toast)
+            future = clients.submit_async(_run_tool_async(fn, coro))
+        self._jobs.append((fn, args, future))
+
+    def collect(self, on_done=None):
+        results = [None] * len(self._jobs)
+        futures = {}
+        for i, (fn, args, future) in enumerate(self._jobs):
+            if future is None:
+                results[i] = _run_tool_safely(fn, args)
+                if on_done: on_done(fn, results[i])
+            else:
+                futures[future] = i
+
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            if on_done: on_done(self._jobs[i][0], results[i])
+        return results
+
+def dispatch_tool_calls(tool_calls, on_done=None):
+    """
+    非流式版本: 一次性提交整轮的 tool_calls
+    """
+    dispatch = ToolDispatch()
+    for tool in tool_calls:
+        dispatch.submit(tool.function.name, tool.function.arguments)
+    return dispatch.collect(on_done)
 
 # 工具列表 (Tools List - 保持不变)
 tools_list = [
-    {"type": "function", "function": {"name": "search_flights", "description": "Search flights", "parameters": {"type": "object", "properties": {"origin": {"type": "string"}, "destination": {"type": "string"}, "date": {"type": "string"}, "return_date": {"type": "string"}}, "required": ["origin", "destination", "date", "return_date"]}}},
+    {"type": "function", "function": {"name": "search_flights", "description": "Search flights. For flexible dates (e.g. 'cheapest week in March') call this ONCE with flex_days instead of once per date.", "parameters": {"type": "object", "properties": {"origin": {"type": "string"}, "destination": {"type": "string"}, "date": {"type": "string"}, "return_date": {"type": "string"}, "flex_days": {"type": "integer", "description": "Also search up to this many days before and after `date` (max 7; trip length stays the same) and return a price calendar: departure date -> cheapest price / airline / duration."}}, "required": ["origin", "destination", "date", "return_date"]}}},
     {"type": "function", "function": {"name": "search_hotels", "description": "Search hotels", "parameters": {"type": "object", "properties": {"city": {"type": "string"}, "check_in_date": {"type": "string"}, "check_out_date": {"type": "string"}, "adults": {"type": "integer"}}, "required": ["city", "check_in_date", "check_out_date", "adults"]}}},
     {"type": "function", "function": {"name": "search_attractions", "description": "Search attractions", "parameters": {"type": "object", "properties": {"city": {"type": "string"}, "keyword": {"type": "string"}}, "required": ["city"]}}},
-    {"type": "function", "function": {"name": "search_restaurants", "description": "Search for best restaurants serving a specific food type (e.g. 'Nasi Lemak', 'Sushi').", "parameters": {"type": "object", "properties": {"city": {"type": "string"}, "food_type": {"type": "string"}}, "required": ["city", "food_type"]}}},
+    {"type": "function", "function": {"name": "search_restaurants", "description": "Search for best restaurants serving a specific food type (e.g. 'Nasi Lemak', 'Sushi'). Set `near` (e.g. the hotel name) for places within walking distance of it.", "parameters": {"type": "object", "properties": {"city": {"type": "string"}, "food_type": {"type": "string"}, "near": {"type": "string", "description": "Landmark or hotel to search around"}}, "required": ["city", "food_type"]}}},
     {"type": "function", "function": {"name": "search_general_web", "description": "Search Google for general info", "parameters": {"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]}}},
     {"type": "function", "function": {"name": "save_itinerary", "description": "Generate Word document", "parameters": {"type": "object", "properties": {"content": {"type": "string"}}, "required": ["content"]}}},
     # 🟢 [核心修改] 修改了 description，强制要求 AI 必须带上 City/Country，防止定位跑偏！
-    {"type": "function", "function": {"name": "generate_map_with_traffic", "description": "Generate a map. ⚠️ ONLY use this if user explicitly asks for 'map'. IMPORTANT: You MUST append the City/Country to EACH location name in 'locations_list' to ensure accurate geocoding (e.g. use 'Ya Kun Kaya Toast, Singapore' instead of just 'Ya Kun Kaya Toast').", "parameters": {"type": "object", "properties": {"locations_list": {"type": "array", "items": {"type": "string"}}}, "required": ["locations_list"]}}}
+    {"type": "function", "function": {"name": "generate_map_with_traffic", "description": "Generate a map. ⚠️ ONLY use this if user explicitly asks for 'map'. IMPORTANT: You MUST append the City/Country to EACH location name in 'locations_list' to ensure accurate geocoding (e.g. use 'Ya Kun Kaya Toast, Singapore' instead of just 'Ya Kun Kaya Toast').", "parameters": {"type": "object", "properties": {"locations_list": {"type": "array", "items": {"type": "string"}}, "optimize_route": {"type": "boolean", "description": "Reorder the stops to minimise travel time (use when the user asks for the best/fastest route or the order does not matter)."}, "keep_first_stop": {"type": "boolean", "description": "Keep the first location (e.g. the hotel) as the starting point when optimizing. Default true."}}, "required": ["locations_list"]}}}
 ]
\ No newline at end of file
@@ -0,0 +1,235 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+# ==========================================
+# 🟢 结构化计时: span / trace / 指标导出
+# ==========================================
+# - span(name, **attrs): 一段计时 (LLM 调用 / 工具 / SerpAPI / Firestore / folium 渲染)
+# - Trace: 一轮对话的所有 span，用 contextvars 传递；
+#   共享事件循环 (clients.run_async / submit_async，ToolDispatch 也走这里) 会把当前 trace 带过去
+# - 每个 span 结束时: 追加到当前 trace、写 JSONL (config.TRACE_LOG_PATH，按 TRACE_LOG_MAX_BYTES 轮换)、累加到 Prometheus 指标
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+# Prometheus 标签: span 名 + 这些属性里有的那个
+METRIC_LABELS = ("engine", "tool", "op", "cache", "status", "priority")
+
+class Span:
+    __slots__ = ("name", "attrs", "start", "duration_ms", "thread")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.duration_ms = None
+        self.thread = threading.current_thread().name
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self, origin=None):
+        return {"name": self.name, "start": round(self.start - origin, 4) if origin else self.start,
+                "ms": round(self.duration_ms, 2), "thread": self.thread, **self.attrs}
+
+class Trace:
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.duration_ms = None
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def finish(self):
+        if self.duration_ms is None:
+            self.duration_ms = (time.time() - self.start) * 1000
+        return self
+
+    def summary(self):
+        """
+        给界面用: 总耗时 + 按 span 名汇总 + 明细 (按开始时间排序)
+        """
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        totals = {}
+        for s in spans:
+            entry = totals.setdefault(s.name, {"name": s.name, "count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] = round(entry["total_ms"] + s.duration_ms, 2)
+            entry["max_ms"] = round(max(entry["max_ms"], s.duration_ms), 2)
+        return {
+            "name": self.name,
+            "total_ms": round(self.duration_ms or 0, 1),
+            "by_name": sorted(totals.values(), key=lambda e: -e["total_ms"]),
+            "spans": [s.to_dict(self.start) for s in spans],
+        }
+
+def current_trace():
+    return _current_trace.get()
+
+def begin_trace(name, **attrs):
+    """
+    给 Streamlit 脚本用: 每次脚本运行开头调用，直接替换脚本线程上的当前 trace
+    (脚本被 st.rerun 打断时没有地方收尾，所以不用 with)
+    """
+    trace = Trace(name, **attrs)
+    _current_trace.set(trace)
+    return trace
+
+@contextmanager
+def use_trace(trace):
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+async def run_in_trace(trace, coro):
+    # 给 clients.run_async 用: 协程跑在事件循环线程上，手动把 trace 带过去 (gather 出来的子任务会继承)
+    token = _current_trace.set(trace)
+    try:
+        return await coro
+    finally:
+        _current_trace.reset(token)
+
+@contextmanager
+def span(name, **attrs):
+    s = Span(name, attrs)
+    token = _current_span.set(s)
+    started = time.perf_counter()
+    try:
+        yield s
+    except BaseException as e:
+        s.attrs.setdefault("error", type(e).__name__)
+        raise
+    finally:
+        s.duration_ms = (time.perf_counter() - started) * 1000
+        _current_span.reset(token)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(s)
+        _export(s, trace)
+
+def traced(name, **attrs):
+    """
+    装饰器版 span；函数里用 annotate() 补充属性
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, **attrs):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def annotate(**attrs):
+    s = _current_span.get()
+    if s is not None:
+        s.set(**attrs)
+
+# ==========================================
+# 🟢 导出: JSONL 日志 + Prometheus 文本
+# ==========================================
+_export_lock = threading.Lock()
+_log_file = None
+_metrics = {}  # (name, labels) -> [count, sum_ms]
+_gauge_sources = []  # fn() -> [(metric, {label: value}, number), ...]
+
+def register_gauges(fn):
+    """
+    其他模块的即时指标 (例如 SerpAPI 排队深度)，导出 Prometheus 时调用
+    """
+    _gauge_sources.append(fn)
+
+def _labels(s):
+    return tuple((k, str(s.attrs[k])) for k in METRIC_LABELS if k in s.attrs)
+
+def _export(s, trace):
+    global _log_file
+    key = (s.name, _labels(s))
+    with _export_lock:
+        entry = _metrics.setdefault(key, [0, 0.0])
+        entry[0] += 1
+        entry[1] += s.duration_ms
+        if not config.TRACE_LOG_PATH: return
+        try:
+            if _log_file is not None and config.TRACE_LOG_MAX_BYTES and _log_file.tell() >= config.TRACE_LOG_MAX_BYTES:
+                _log_file.close()
+                _log_file = None
+                os.replace(config.TRACE_LOG_PATH, config.TRACE_LOG_PATH + ".1")
+            if _log_file is None:
+                os.makedirs(os.path.dirname(config.TRACE_LOG_PATH) or ".", exist_ok=True)
+                _log_file = open(config.TRACE_LOG_PATH, "a", encoding="utf-8", buffering=1)
+            record = s.to_dict()
+            if trace is not None: record["trace"] = f"{trace.name}@{trace.start:.3f}"
+            _log_file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            print(f"⚠️ [Trace] log write failed: {e}")
+
+def prometheus_text():
+    """
+    Prometheus 文本格式: agent_span_seconds_count / _sum (按 span 名 + 标签)
+    """
+    lines = ["# HELP agent_span_seconds Duration of traced operations.", "# TYPE agent_span_seconds summary"]
+    with _export_lock:
+        items = sorted(_metrics.items())
+    for (name, labels), (count, total_ms) in items:
+        label_str = ",".join([f'span="{name}"'] + [f'{k}="{v}"' for k, v in labels])
+        lines.append(f"agent_span_seconds_count{{{label_str}}} {count}")
+        lines.append(f"agent_span_seconds_sum{{{label_str}}} {total_ms / 1000:.6f}")
+    gauges = [g for source in _gauge_sources for g in source()]
+    typed = set()
+    # 同名指标的样本必须连在一起
+    for metric, labels, value in sorted(gauges, key=lambda g: g[0]):
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} gauge")
+            typed.add(metric)
+        label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+        lines.append(f"{metric}{{{label_str}}} {value}" if label_str else f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200 if self.path.startswith("/metrics") else 404)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+def start_metrics_server(port=None):
+    """
+    进程级启动一次 /metrics (config.METRICS_PORT 为 None 时不启动)
+    """
+    global _metrics_server
+    port = config.METRICS_PORT if port is None else port
+    if port is None: return None
+    with _metrics_server_lock:
+        if _metrics_server is None:
+            try:
+                _metrics_server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+            except OSError as e:
+                print(f"⚠️ [Trace] metrics server not started on :{port}: {e}")
+                _metrics_server = False  # 不要每次 rerun 都重试
+                return None
+            threading.Thread(target=_metrics_server.serve_forever, name="metrics_http", daemon=True).start()
+    return _metrics_server or None
@@ -1,32 +1,188 @@
+import hashlib
 import io
+import re
+import threading
+from collections import OrderedDict
+
 import streamlit as st
 
 # 👇 用于生成 Word 文档 (保持原本的 try-except 逻辑)
-try:
-    from docx import Document
-    from docx.shared import Pt
-    from docx.oxml.ns import qn 
-except ImportError:
-    st.error("请先安装 python-docx 库: pip install python-docx")
-    st.stop()
+# 🟢 [修改] python-docx (连带 lxml) 只有点下载时才用到，第一次生成文档时再导入
+Document = OxmlElement = qn = RT = CT_Tbl = Table = Paragraph = None
 
-def create_word_doc(content):
+def _import_docx():
+    global Document, OxmlElement, qn, RT, CT_Tbl, Table, Paragraph
+    if Document is not None: return
+    try:
+        from docx.oxml import OxmlElement
+        from docx.oxml.ns import qn
+        from docx.opc.constants import RELATIONSHIP_TYPE as RT
+        from docx.oxml.table import CT_Tbl
+        from docx.table import Table
+        from docx.text.paragraph import Paragraph
+        from docx import Document  # 最后赋值: 其他线程看到 Document 不为 None 时其余名字都已就绪
+    except ImportError:
+        st.error("请先安装 python-docx 库: pip install python-docx")
+        st.stop()
+
+# ==========================================
+# 🟢 [新增] Markdown -> docx 单遍转换
+# ==========================================
+# 逐行扫描一次: 标题 / 列表 / 表格 / 分割线 / 普通段落；
+# 行内的 **粗体** / *斜体* / [链接](url) 用一个正则 finditer 切成 run，不做重复的字符串替换
+
+HEADING_RE = re.compile(r"^(#{1,6})\s+(.*)$")
+BULLET_RE = re.compile(r"^[-*+]\s+(.*)$")
+NUMBERED_RE = re.compile(r"^\d+[.)]\s+(.*)$")
+TABLE_SEP_RE = re.compile(r"^\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)*\|?$")
+RULE_RE = re.compile(r"^(-{3,}|\*{3,}|_{3,})$")
+INLINE_RE = re.compile(r"!\[([^\]]*)\]\(([^)\s]+)[^)]*\)|\[([^\]]+)\]\(([^)\s]+)[^)]*\)|\*\*(.+?)\*\*|__(.+?)__|\*(.+?)\*")
+
+def _add_hyperlink(paragraph, url, text):
+    r_id = paragraph.part.relate_to(url, RT.HYPERLINK, is_external=True)
+    link = OxmlElement("w:hyperlink")
+    link.set(qn("r:id"), r_id)
+    run = OxmlElement("w:r")
+    r_pr = OxmlElement("w:rPr")
+    color = OxmlElement("w:color")
+    color.set(qn("w:val"), "0563C1")
+    underline = OxmlElement("w:u")
+    underline.set(qn("w:val"), "single")
+    r_pr.append(color)
+    r_pr.append(underline)
+    run.append(r_pr)
+    t = OxmlElement("w:t")
+    t.text = text
+    t.set(qn("xml:space"), "preserve")
+    run.append(t)
+    link.append(run)
+    paragraph._p.append(link)
+
+def _add_run(paragraph, text, bold=False, italic=False):
+    # 只在需要时才写 rPr (run.bold = False 也会生成一个 <w:b w:val="0"/>)
+    run = paragraph.add_run(text)
+    if bold: run.bold = True
+    if italic: run.italic = True
+
+def add_inline(paragraph, text, bold=False):
+    """
+    把一行里的行内格式写成多个 run
+    """
+    pos = 0
+    for m in INLINE_RE.finditer(text):
+        if m.start() > pos:
+            _add_run(paragraph, text[pos:m.start()], bold)
+        img_alt, img_url, link_text, link_url, strong, strong2, em = m.groups()
+        if img_url: _add_hyperlink(paragraph, img_url, f"🖼️ {img_alt or 'image'}")
+        elif link_url: _add_hyperlink(paragraph, link_url, link_text)
+        elif strong or strong2: _add_run(paragraph, strong or strong2, bold=True)
+        else: _add_run(paragraph, em, bold, italic=True)
+        pos = m.end()
+    if pos < len(text):
+        _add_run(paragraph, text[pos:], bold)
+
+# 🟢 python-docx 的 add_paragraph / add_table 每次都要在 body 里找 sectPr 插到它前面 (O(n))，
+# 按名字设置样式还会遍历全部样式；长文档里这两处会变成平方级。
+# 这里先把 sectPr 摘掉，段落/表格直接 append 到 body 末尾，样式直接写 style id
+def _add_paragraph(doc, style_id=None):
+    p = OxmlElement("w:p")
+    doc.element.body.append(p)
+    paragraph = Paragraph(p, doc._body)
+    if style_id: p.style = style_id
+    return paragraph
+
+def _style_ids(doc):
+    names = ["List Bullet", "List Number", "Table Grid"] + [f"Heading {n}" for n in range(1, 10)]
+    return {name: doc.styles[name].style_id for name in names}
+
+def _split_row(line):
+    return [cell.strip() for cell in line.strip().strip("|").split("|")]
+
+def _add_table(doc, rows, style_ids, block_width):
+    # 第二行是 |---|---| 分隔线时当作表头
+    header = len(rows) > 1 and TABLE_SEP_RE.match(rows[1])
+    cells = [_split_row(r) for i, r in enumerate(rows) if not (header and i == 1)]
+    width = max(len(r) for r in cells)
+    tbl = CT_Tbl.new_tbl(0, width, block_width)
+    doc.element.body.append(tbl)
+    table = Table(tbl, doc._body)
+    tbl.tblStyle_val = style_ids["Table Grid"]
+    for i, values in enumerate(cells):
+        row_cells = table.add_row().cells  # 逐行取 cells，避免 table.cell(i, j) 每次重算整张表
+        for j, value in enumerate(values):
+            add_inline(row_cells[j].paragraphs[0], value, bold=bool(header) and i == 0)
+
+def markdown_to_docx(content):
+    """
+    单遍把 Markdown 行程转成 docx，返回 bytes
+    """
+    _import_docx()
     doc = Document()
     style = doc.styles['Normal']
     style.font.name = 'Microsoft YaHei'
     style._element.rPr.rFonts.set(qn('w:eastAsia'), 'Microsoft YaHei')
-    
+
     doc.add_heading('Travel Itinerary (AI Generated)', 0)
+    style_ids = _style_ids(doc)
+    block_width = doc._block_width  # 要在摘掉 sectPr 之前取
+    body = doc.element.body
+    sect_pr = body.sectPr
+    if sect_pr is not None: body.remove(sect_pr)
+    table_rows = []
     for line in content.split('\n'):
         line = line.strip()
+        if line.startswith('|'):
+            table_rows.append(line)
+            continue
+        if table_rows:
+            _add_table(doc, table_rows, style_ids, block_width)
+            table_rows = []
         if not line: continue
-        if line.startswith('### '): doc.add_heading(line.replace('### ', ''), level=2)
-        elif line.startswith('## '): doc.add_heading(line.replace('## ', ''), level=1)
-        elif line.startswith('**') and line.endswith('**'): doc.add_paragraph().add_run(line.replace('**', '')).bold = True
-        elif line.startswith('- '): doc.add_paragraph(line.replace('- ', ''), style='List Bullet')
-        else: doc.add_paragraph(line)
-            
+
+        heading = HEADING_RE.match(line)
+        if heading:
+            # "#" 和 "##" 都是一级标题 (沿用原来的 ## -> 1, ### -> 2)
+            level = max(1, min(len(heading.group(1)) - 1, 9))
+            add_inline(_add_paragraph(doc, style_ids[f"Heading {level}"]), heading.group(2))
+        elif RULE_RE.match(line):
+            continue
+        elif line.startswith('**') and line.endswith('**') and len(line) > 4:
+            add_inline(_add_paragraph(doc), line[2:-2], bold=True)
+        elif BULLET_RE.match(line):
+            add_inline(_add_paragraph(doc, style_ids["List Bullet"]), BULLET_RE.match(line).group(1))
+        elif NUMBERED_RE.match(line):
+            add_inline(_add_paragraph(doc, style_ids["List Number"]), NUMBERED_RE.match(line).group(1))
+        else:
+            add_inline(_add_paragraph(doc), line)
+    if table_rows:
+        _add_table(doc, table_rows, style_ids, block_width)
+    if sect_pr is not None: body.append(sect_pr)
+
     buffer = io.BytesIO()
     doc.save(buffer)
-    buffer.seek(0)
-    return buffer
\ No newline at end of file
+    return buffer.getvalue()
+
+# ==========================================
+# 🟢 [新增] 按内容 hash 缓存生成好的 docx (进程级 LRU)
+# ==========================================
+DOCX_CACHE_SIZE = 16
+_docx_cache = OrderedDict()
+_docx_lock = threading.Lock()
+
+def word_doc_bytes(content):
+    key = hashlib.sha1(content.encode("utf-8")).hexdigest()
+    with _docx_lock:
+        data = _docx_cache.get(key)
+        if data is not None:
+            _docx_cache.move_to_end(key)
+            return data
+
+    data = markdown_to_docx(content)
+    with _docx_lock:
+        _docx_cache[key] = data
+        while len(_docx_cache) > DOCX_CACHE_SIZE:
+            _docx_cache.popitem(last=False)
+    return data
+
+def create_word_doc(content):
+    return io.BytesIO(word_doc_bytes(content))